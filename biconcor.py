@@ -7,111 +7,250 @@ $Id: $
 #----------------------------------------------------------------------------------------------------------------------------------
 # includes
 
-import datetime
+import collections
 import pprint
 import re
 import os
-import subprocess
-import threading
 import time
 
+from tornado import gen, ioloop
+from tornado.process import Subprocess
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+
+from predictpool import with_deadline
+
 #----------------------------------------------------------------------------------------------------------------------------------
 # constants
 
 MAX_TRANSLATIONS = 10
 MAX_EXAMPLES_PER_TRANS = 4
 
-#----------------------------------------------------------------------------------------------------------------------------------
+BICONCOR_START = '-|||- BICONCOR START -|||-'
+BICONCOR_END = '-|||- BICONCOR END -|||-'
 
-class KillerThread (threading.Thread):
-    """
-    Takes a child process as argument, and kills it if a delay longer than INACTIVE_TIMEOUT passes without `record_activity' being
-    called.
-    """
+# Number of biconcor binaries per model. They all load the same model files, so most of their memory is shared page cache
+BICONCOR_WORKERS = 2
 
-    # When this long has passed since the last activity was recorded, the child is killed
-    INACTIVE_TIMEOUT = datetime.timedelta (hours=24)
+# Seconds allowed for biconcor to answer a query, counted from when it starts working on it (i.e. once it has loaded its model
+# and answered the queries before it)
+BICONCOR_TIMEOUT = 10.0
 
-    def __init__ (self, child_proc):
-        super(KillerThread,self).__init__ ()
-        self.child_proc = child_proc
-        self.last_activity = datetime.datetime.now()
-        self.daemon = True
-        self.aborted = False
+# Seconds allowed for biconcor to load its model. A binary that takes longer is killed
+BICONCOR_LOAD_TIMEOUT = 300.0
 
-    def record_activity (self):
-        self.last_activity = datetime.datetime.now()
+# When a binary has been idle this long, it is killed (it is started again on the next query)
+INACTIVE_TIMEOUT = 24 * 3600
 
-    def abort (self):
-        self.aborted = True
+# How often the pool looks for idle binaries, in seconds
+REAP_INTERVAL = 60
 
-    def run (self):
-        while not self.aborted:
-            time.sleep (60)
-            last_activity = self.last_activity
-            if last_activity is not None:
-                now = datetime.datetime.now()
-                elapsed = now - last_activity
-                if elapsed > self.INACTIVE_TIMEOUT:
-                    print "%s since last activity, killing biconcor binary" % self.INACTIVE_TIMEOUT
-                    self.child_proc.terminate()
-                    self.child_proc.wait()
-                    break
+#----------------------------------------------------------------------------------------------------------------------------------
 
+class BiconcorTimeout (Exception):
+    """ Raised when biconcor doesn't answer a query in time """
+    pass
+
+class BiconcorError (Exception):
+    """ Raised when the biconcor binary is gone, e.g. it crashed or was killed while a query was pending """
+    pass
+
+
+class BiconcorWorker (object):
+    """
+    A running biconcor binary. It answers its queries in order, so the Futures of the pending queries are kept in a queue and
+    resolved as the answers come in. All communication goes through non-blocking pipes on the IOLoop.
+    """
+
+    def __init__ (self, cmd):
+        self.proc = Subprocess (
+            cmd,
+            stdin = Subprocess.STREAM,
+            stdout = Subprocess.STREAM,
+            preexec_fn = lambda: os.nice(10),
+            )
+        self.pid = self.proc.pid
+        self.ready = False # True once the model is loaded
+        self.started = Future() # resolved at the same time
+        self.answered = 0
+        self.last_used = time.time()
+        # (answer, turn) Futures of the queries that are waiting for their output, oldest first, see `query'
+        self.pending = collections.deque()
+        self.proc.stdout.set_close_callback (self._on_stdout_closed)
+        self.proc.stdout.read_until (BICONCOR_START, self._on_start)
+
+    def is_alive (self):
+        return self.proc.proc.poll() is None
+
+    def query (self, src_phrase):
+        """
+        Returns two Futures: one for the raw output for the given source phrase, as a list of lines, and one that is resolved when
+        the binary starts working on the query, i.e. once it has loaded its model and answered the queries before it. Both fail
+        with BiconcorError if the process dies first.
+        """
+        self.last_used = time.time()
+        answer, turn = Future(), Future()
+        try:
+            self.proc.stdin.write (src_phrase.encode ('UTF-8') + '\n')
+        except StreamClosedError:
+            for future in (answer, turn):
+                future.set_exception (BiconcorError ("biconcor process %d is gone" % self.pid))
+            return answer, turn
+        self.pending.append ((answer, turn))
+        if self.ready and len (self.pending) == 1:
+            self._read_next()
+        return answer, turn
+
+    def _read_next (self):
+        """ Starts reading the output of the oldest pending query """
+        turn = self.pending[0][1]
+        if not turn.done():
+            turn.set_result (None)
+        self.proc.stdout.read_until (BICONCOR_END, self._on_output)
+
+    def _on_start (self, data):
+        self.ready = True
+        self.started.set_result (None)
+        if self.pending:
+            self._read_next()
+
+    def _on_output (self, data):
+        self.last_used = time.time()
+        self.answered += 1
+        answer, turn = self.pending.popleft()
+        if not answer.done():
+            answer.set_result ([line.rstrip() for line in data.decode ('UTF-8').strip().split ('\n')])
+        if self.pending:
+            self._read_next()
+
+    def _on_stdout_closed (self):
+        if not self.started.done():
+            self.started.set_exception (BiconcorError ("biconcor process %d exited while loading its model" % self.pid))
+        while self.pending:
+            for future in self.pending.popleft():
+                if not future.done():
+                    future.set_exception (BiconcorError ("biconcor process %d is gone" % self.pid))
+
+    def kill (self):
+        """ Kills the process and reaps it. Pending queries fail with BiconcorError """
+        if self.is_alive():
+            try:
+                self.proc.proc.kill()
+            except OSError:
+                pass # already gone
+        self.proc.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+    def info (self):
+        return {
+            'pid': self.pid,
+            'ready': self.ready,
+            'pending': len (self.pending),
+            'answered': self.answered,
+            'idle': time.time() - self.last_used,
+            }
 
-#----------------------------------------------------------------------------------------------------------------------------------
 
 class BiconcorProcess (object):
     """
-    Convenience object that encapsulates all interaction with the biconcor binaries.
+    Convenience object that encapsulates all interaction with the biconcor binaries of a model: a pool of `workers' binaries, each
+    query going to the one with the fewest queries pending. Binaries that die, take longer than `load_timeout' seconds to load
+    their model, time out on a query or sit idle for `idle_timeout' seconds are killed, and started again when they're next
+    needed.
     """
 
-    def __init__ (self, command, model):
+    def __init__ (self, command, model, workers=BICONCOR_WORKERS, query_timeout=BICONCOR_TIMEOUT,
+                  load_timeout=BICONCOR_LOAD_TIMEOUT, idle_timeout=INACTIVE_TIMEOUT):
         self.cmd = [ command, '--load', model, '--stdio',
                      '--translations', str(MAX_TRANSLATIONS),
                      '--examples', str(MAX_EXAMPLES_PER_TRANS) ]
-        self.child = None
-        self.killer = None
-        self.child_lock = threading.Lock()
+        self.workers = [None] * workers
+        self.query_timeout = query_timeout
+        self.load_timeout = load_timeout
+        self.idle_timeout = idle_timeout
+        self.counters = collections.Counter()
+        self.reaper = None
 
     def is_warm (self):
-        """ The object is 'warm' when the binary is running, loaded, and ready to accept requests. """
-        if self.child is not None:
-            assert self.killer is not None, repr(self.killer)
-            child_is_running = self.child.poll() is None
-            if not child_is_running:
-                self.killer.abort()
-                self.child = self.killer = None
-        return self.child is not None
+        """ The object is 'warm' when a binary is running, loaded, and ready to accept requests. """
+        return any (worker is not None and worker.ready and worker.is_alive() for worker in self.workers)
 
     def warm_up (self):
-        """ Blocks until we have a biconcor process running and ready to accept requests """
-        with self.child_lock:
-            if not self.is_warm():
-                assert self.child is None, repr(self.child)
-                assert self.killer is None, repr(self.killer)
-                self.child = subprocess.Popen (
-                    self.cmd,
-                    stdin = subprocess.PIPE,
-                    stdout = subprocess.PIPE,
-                    preexec_fn = lambda: os.nice(10),
-                    )
-                expect (self.child.stdout, '-|||- BICONCOR START -|||-')
-                self.killer = KillerThread (self.child)
-                self.killer.start()
-
+        """ Starts the binaries that aren't running. Doesn't wait for them to load their model """
+        for i,worker in enumerate (self.workers):
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    worker.kill()
+                    self.counters['restarts'] += 1
+                self.workers[i] = BiconcorWorker (self.cmd)
+                self.counters['started'] += 1
+        if self.reaper is None and self.idle_timeout:
+            self.reaper = ioloop.PeriodicCallback (self.reap_idle, REAP_INTERVAL * 1000)
+            self.reaper.start()
+
+    @gen.coroutine
     def get_concordance (self, src_phrase):
         """
-        Returns the raw biconcor output for the given source phrase. Output is returned as a list of strings, one per line.
+        Returns (as a Future) the raw biconcor output for the given source phrase, as a list of strings, one per line. Fails with
+        BiconcorTimeout if the binary doesn't load its model within `load_timeout' seconds, or doesn't answer within
+        `query_timeout' seconds of starting on the query, in which case that binary is killed.
         """
         self.warm_up()
-        with self.child_lock:
-            self.killer.record_activity()
-            print >> self.child.stdin, src_phrase.encode ('UTF-8')
-            self.child.stdin.flush()
-            output = expect (self.child.stdout, '-|||- BICONCOR END -|||-')
-            self.killer.record_activity()
-            return output
+        # binaries that are still loading their model come last
+        worker = min (self.workers, key=lambda worker: (not worker.ready, len (worker.pending)))
+        self.counters['queries'] += 1
+        answer, turn = worker.query (src_phrase)
+        if not worker.ready:
+            try:
+                yield with_deadline (worker.started, self.load_timeout, error=BiconcorTimeout (
+                    "biconcor didn't load its model within %g seconds" % self.load_timeout))
+            except BiconcorTimeout:
+                # the other queries waiting for the same binary time out with this one
+                if worker in self.workers:
+                    self.counters['load_timeouts'] += 1
+                    self.discard (worker)
+                raise
+        # neither the loading nor the queries before this one count against it (they have deadlines of their own)
+        yield turn
+        try:
+            output = yield with_deadline (answer, self.query_timeout, error=BiconcorTimeout (
+                "no answer from biconcor within %g seconds" % self.query_timeout))
+        except BiconcorTimeout:
+            self.counters['timeouts'] += 1
+            self.discard (worker)
+            raise
+        raise gen.Return (output)
+
+    def discard (self, worker):
+        if worker in self.workers:
+            self.workers[self.workers.index (worker)] = None
+        worker.kill()
+
+    def reap_idle (self):
+        """ Kills the binaries that have been idle for longer than `idle_timeout' """
+        now = time.time()
+        for worker in self.workers:
+            if worker is not None and not worker.pending and now - worker.last_used > self.idle_timeout:
+                print "%d seconds since last activity, killing biconcor binary %d" % (self.idle_timeout, worker.pid)
+                self.discard (worker)
+                self.counters['reaped'] += 1
+
+    def shutdown (self):
+        if self.reaper is not None:
+            self.reaper.stop()
+            self.reaper = None
+        for worker in self.workers:
+            if worker is not None:
+                self.discard (worker)
+
+    def stats (self):
+        workers = [worker.info() for worker in self.workers if worker is not None]
+        return dict (self.counters,
+            warm = self.is_warm(),
+            pending = sum (worker['pending'] for worker in workers),
+            workers = workers,
+            )
 
 
 #----------------------------------------------------------------------------------------------------------------------------------
@@ -125,6 +264,17 @@ def parse_biconcor_output_into_json_struct (raw_output, detokenize_and_postproce
     Takes the raw output of the biconcor binary, as a list of strings (one per line), and returns plain data structures to be
     serialized to JSON
     """
+    concor_struct = parse_biconcor_output (raw_output)
+    detokenized = map (detokenize_and_postprocess, concordance_token_lists (concor_struct))
+    return fill_in_concordance_sentences (concor_struct, detokenized)
+
+
+def parse_biconcor_output (raw_output):
+    """
+    Parses the raw output of the biconcor binary into the same structure as `parse_biconcor_output_into_json_struct', except that
+    each sentence is left as a list of tokens, with the phrase to be highlighted delimited by marker tokens. This lets callers
+    detokenize all the sentences at once (e.g. with parallel requests) before calling `fill_in_concordance_sentences'.
+    """
 
     iter_raw_output_lines = iter (raw_output)
     re_cover (r'TOTAL: (\d+)', next(iter_raw_output_lines))
@@ -136,7 +286,7 @@ def parse_biconcor_output_into_json_struct (raw_output, detokenize_and_postproce
             header_line = next (iter_raw_output_lines)
         except StopIteration:
             break # means the binary is inconsistent in how many translations it announces vs. outputs
-        if header_line == '-|||- BICONCOR END -|||-':
+        if header_line == BICONCOR_END:
             break
         tgt_phrase,sent_pair_count = re_cover (r'(.+?)\((\d+)\)', header_line)
         sent_pair_count = int (sent_pair_count)
@@ -171,44 +321,48 @@ def parse_biconcor_output_into_json_struct (raw_output, detokenize_and_postproce
                 for p in (src_phrase_pos,tgt_phrase_pos)
                 )
 
-            # Detokenize the text, keeping track of the position of the phrases to be highlighted (the positions are given as token
-            # indices). In the output struct the phrases will be identified in the string with <concord>...</concord> tags
+            # Keep track of the position of the phrases to be highlighted (the positions are given as token indices) by inserting
+            # marker tokens, which survive detokenization
             pair_struct = []
             for tokens,pos in ((src_tokens,src_phrase_pos),(tgt_tokens,tgt_phrase_pos)):
                 tokens.insert (pos[1]+1, BICONCOR_PHRASE_STOPS_HERE)
                 tokens.insert (pos[0], BICONCOR_PHRASE_STARTS_HERE)
-                sent_str = detokenize_and_postprocess (tokens)
-                sent_str = re.sub (BICONCOR_PHRASE_STARTS_HERE + r'\s*', '<concord>', sent_str)
-                sent_str = re.sub (r'\s*' + BICONCOR_PHRASE_STOPS_HERE, '</concord>', sent_str)
-                pair_struct.append (sent_str)
+                pair_struct.append (tokens)
 
             sent_pair_structs.append (pair_struct)
 
     return ret_struct
 
 
-#----------------------------------------------------------------------------------------------------------------------------------
-# utils
+def concordance_token_lists (concor_struct):
+    """ Returns the token lists of all sentences in a struct returned by `parse_biconcor_output', in a fixed order """
+    return [
+        tokens
+        for tgt_phrase_struct in concor_struct
+        for pair_struct in tgt_phrase_struct['sent_pairs']
+        for tokens in pair_struct
+        ]
+
 
-def expect (fh, expected, encoding='UTF-8', do_rstrip=True):
+def fill_in_concordance_sentences (concor_struct, detokenized):
     """
-    Reads lines from `fh', saving them all into a list, until one contains the string in `expected', at which point the accumulated
-    line buffer is returned. Also performs decoding if `encoding' is not None.
+    Replaces, in place, the token lists in a struct returned by `parse_biconcor_output' with the corresponding detokenized strings
+    from `detokenized' (given in the order of `concordance_token_lists'). In the output struct the phrases are identified in the
+    string with <concord>...</concord> tags. Returns the struct.
     """
-    ret = []
-    while True:
-        line = fh.readline()
-        if not line:
-            break
-        else:
-            if encoding:
-                line = line.decode (encoding)
-            if do_rstrip:
-                line = line.rstrip() # remove EOL chars
-            ret.append (line)
-            if expected in line:
-                break
-    return ret
+    iter_detokenized = iter (detokenized)
+    for tgt_phrase_struct in concor_struct:
+        for pair_struct in tgt_phrase_struct['sent_pairs']:
+            for i in xrange (len (pair_struct)):
+                sent_str = next (iter_detokenized)
+                sent_str = re.sub (BICONCOR_PHRASE_STARTS_HERE + r'\s*', '<concord>', sent_str)
+                sent_str = re.sub (r'\s*' + BICONCOR_PHRASE_STOPS_HERE, '</concord>', sent_str)
+                pair_struct[i] = sent_str
+    return concor_struct
+
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# utils
 
 def re_cover (regex, text, flags=0):
     """ Ensures that the given regex matches the given text from start to end, and returns the captured groups, as a list """
@@ -234,7 +388,7 @@ def main ():
         src_phrase = src_phrase.decode ('UTF-8')
         if not biconcor.is_warm():
             print "Biconcor is warming up, hang in there..."
-        output = biconcor.get_concordance (src_phrase)
+        output = ioloop.IOLoop.instance().run_sync (lambda: biconcor.get_concordance (src_phrase))
         json_struct = parse_biconcor_output_into_json_struct (
             output,
             detokenize_and_postprocess = lambda tokens: ' '.join(tokens).upper(),
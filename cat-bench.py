@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+"""
+Load and latency benchmark for cat-server.py.
+
+Replays socket.io sessions against cat-server.py, a given number of them at a time, and reports the latency of each event (from
+the time it's sent to the time its result comes back), the throughput, the number of requests made to server.py and to the
+prediction processes per event, and the peak memory of cat-server.py and its child processes.
+
+The sessions are either recordings of real traffic (see the --record-sessions option of cat-server.py), replayed with their
+original timing, or generated from a document: a file of source sentences and, optionally, a file of their translations, one
+sentence per line. In a generated session, each segment is decoded, along with a burst of prefetches of the next segments, then
+its translation is typed in one keystroke at a time, then its alignments are requested (and, optionally, the concordance of one of
+its words).
+
+By default the benchmark starts its own stand-in for server.py (server-py-stub.py) and its own cat-server.py:
+
+    ./cat-bench.py --source doc.de --target doc.en --concurrency 20 --translate-latency 0.3 --predict-cmd ./predict
+
+It can also replay sessions against a cat-server.py that is already running, in which case server.py requests are taken from the
+server's /metrics (only those of the worker that answers, if it has several), and memory is only reported if its pid is given:
+
+    ./cat-bench.py --sessions recorded.jsonl --server localhost:9999 --pid 1234
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import argparse
+import collections
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tornado import gen, httpclient, ioloop, websocket
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+ROOT = os.path.normpath (os.path.dirname (os.path.abspath (__file__)))
+
+# socket.io endpoint of cat-server.py
+ENDPOINT = '/cat'
+
+# Suffix of the names of the events that carry results, see catlog.py
+RESULT_SUFFIX = 'Result'
+
+# Events that cat-server.py doesn't answer
+NO_RESULT_EVENTS = ('rejectSuffix', 'warmUpBiconcordancer')
+
+# Events of a recording that aren't replayed (the connection is opened and closed by the benchmark itself)
+CONNECTION_EVENTS = ('on_open', 'on_close')
+
+PERCENTILES = (50, 95, 99)
+
+# Seconds between two samples of the memory of cat-server.py
+RSS_SAMPLING_INTERVAL = 0.25
+
+# Seconds allowed for the servers started by the benchmark to come up
+STARTUP_TIMEOUT = 30.0
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# sessions
+#
+# A session is a list of steps (delay, event, data): wait `delay' seconds after sending the previous event, then send `event' with
+# `data'. Events are sent on schedule, without waiting for the results of the previous ones, as a user would.
+
+def load_recorded_sessions (path, max_delay=None):
+    """ Reads sessions recorded by cat-server.py (see `SessionRecorder' in catlog.py) """
+    events = collections.defaultdict (list)
+    with open (path) as recording:
+        for line in recording:
+            if line.strip():
+                record = json.loads (line)
+                if record['event'] not in CONNECTION_EVENTS:
+                    events[record['session']].append (record)
+    sessions = []
+    for session in sorted (events):
+        steps = []
+        previous_time = None
+        for record in events[session]:
+            delay = record['time'] - previous_time if previous_time is not None else 0.0
+            if max_delay is not None:
+                delay = min (delay, max_delay)
+            steps.append ((delay, record['event'], record['data']))
+            previous_time = record['time']
+        sessions.append (steps)
+    return sessions
+
+def generate_sessions (sources, targets, segments_per_session=10, prefetch=3, keystroke_delay=0.1, think_time=1.0, biconcor=False):
+    """
+    Generates sessions that translate the sentences of a document, `segments_per_session' consecutive segments each. `targets'
+    are the translations typed in; if there are none, the source sentences are typed instead, which still makes for one
+    completion per keystroke.
+    """
+    targets = targets or sources
+    sessions = []
+    for first in xrange (0, len(sources), segments_per_session):
+        steps = []
+        for seg_id in xrange (first, min (first + segments_per_session, len(sources))):
+            source,target = sources[seg_id], targets[seg_id]
+            steps.append ((think_time, 'decode', { 'source': source, 'segId': seg_id, 'isPreFetch': False }))
+            for next_id in xrange (seg_id + 1, min (seg_id + 1 + prefetch, len(sources))):
+                steps.append ((0.0, 'decode', { 'source': sources[next_id], 'segId': next_id, 'isPreFetch': True }))
+            for caret_pos in xrange (1, len(target) + 1):
+                steps.append ((keystroke_delay, 'setPrefix', { 'source': source, 'target': target[:caret_pos], 'caretPos': caret_pos }))
+            steps.append ((think_time, 'getAlignments', { 'source': source, 'target': target }))
+            if biconcor and source.split():
+                steps.append ((think_time, 'biconcor', { 'srcPhrase': random.choice (source.split()) }))
+        sessions.append (steps)
+    return sessions
+
+def read_sentences (path):
+    with open (path) as sentences:
+        return [line.decode ('UTF-8').strip() for line in sentences]
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# client
+
+class SocketIOClient (object):
+    """ Minimal socket.io 0.9 client, over a websocket, for the `ENDPOINT' of cat-server.py """
+
+    def __init__ (self, host, port, on_event):
+        self.host = host
+        self.port = port
+        self.on_event = on_event
+        self.connection = None
+
+    @gen.coroutine
+    def connect (self):
+        response = yield httpclient.AsyncHTTPClient().fetch ('http://%s:%d/socket.io/1/' % (self.host, self.port))
+        session_id = response.body.split (':')[0]
+        self.connection = yield websocket.websocket_connect ('ws://%s:%d/socket.io/1/websocket/%s' % (self.host, self.port, session_id))
+        yield self._expect ('1::')
+        self.connection.write_message ('1::' + ENDPOINT)
+        yield self._expect ('1::' + ENDPOINT)
+        self._read()
+
+    @gen.coroutine
+    def _expect (self, prefix):
+        message = yield self.connection.read_message()
+        if message is None or not message.startswith (prefix):
+            raise IOError ("expected %r from cat-server, got %r" % (prefix, message))
+
+    @gen.coroutine
+    def _read (self):
+        while True:
+            message = yield self.connection.read_message()
+            if message is None:
+                break
+            if message.startswith ('2::'):
+                # heartbeat
+                self.connection.write_message ('2::')
+            elif message.startswith ('5::%s:' % ENDPOINT):
+                event = json.loads (message[len('5::%s:' % ENDPOINT):])
+                self.on_event (event['name'], event.get ('args') or [])
+
+    def emit (self, name, data):
+        # tornadio passes a single dict argument on as keyword arguments, hence the {data: ...} wrapping
+        args = [] if data is None else [{ 'data': data }]
+        self.connection.write_message ('5::%s:%s' % (ENDPOINT, json.dumps ({ 'name': name, 'args': args })))
+
+    def close (self):
+        if self.connection is not None:
+            self.connection.close()
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# replay
+
+class Replay (object):
+    """ Replays sessions, `concurrency' at a time, and collects the latency of each event """
+
+    def __init__ (self, host, port, sessions, concurrency, speed=1.0, result_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.sessions = collections.deque (sessions)
+        self.concurrency = concurrency
+        self.speed = speed
+        self.result_timeout = result_timeout
+        self.latencies = collections.defaultdict (list)
+        self.counters = collections.defaultdict (collections.Counter)
+
+    @gen.coroutine
+    def run (self):
+        start_time = time.time()
+        yield [self._run_sessions() for i in xrange (self.concurrency)]
+        self.elapsed = time.time() - start_time
+
+    @gen.coroutine
+    def _run_sessions (self):
+        while self.sessions:
+            yield self._run_session (self.sessions.popleft())
+
+    @gen.coroutine
+    def _run_session (self, steps):
+        loop = ioloop.IOLoop.current()
+        session = ReplayedSession (self)
+        client = SocketIOClient (self.host, self.port, session.on_event)
+        yield client.connect()
+        for delay,event,data in steps:
+            if delay > 0:
+                yield gen.Task (loop.add_timeout, time.time() + delay / self.speed)
+            session.sent (event, data)
+            client.emit (event, data)
+        # give the results still expected some time to arrive
+        deadline = time.time() + self.result_timeout
+        while session.waiting() and time.time() < deadline:
+            yield gen.Task (loop.add_timeout, time.time() + 0.01)
+        session.give_up()
+        client.close()
+
+    def report (self):
+        events = {}
+        for event,counts in self.counters.iteritems():
+            latencies = sorted (self.latencies[event])
+            stats = dict (counts)
+            if latencies:
+                stats['mean'] = sum (latencies) / len (latencies)
+                for p in PERCENTILES:
+                    stats['p%d' % p] = latencies[max (0, int (math.ceil (len(latencies) * p / 100.0)) - 1)]
+            events[event] = stats
+        results = sum (counts['results'] for counts in self.counters.itervalues())
+        return {
+            'elapsed': self.elapsed,
+            'events': events,
+            'sent': sum (counts['sent'] for counts in self.counters.itervalues()),
+            'results': results,
+            'throughput': results / self.elapsed if self.elapsed else None,
+            }
+
+
+class ReplayedSession (object):
+    """ The events of one session that are waiting for their results """
+
+    def __init__ (self, replay):
+        self.replay = replay
+        self.pending = collections.defaultdict (collections.deque)  # event -> (segId, time sent), oldest first
+
+    def sent (self, event, data):
+        self.replay.counters[event]['sent'] += 1
+        if event not in NO_RESULT_EVENTS:
+            seg_id = data.get ('segId') if isinstance (data, dict) else None
+            self.pending[event].append ((seg_id, time.time()))
+
+    def on_event (self, name, args):
+        if not name.endswith (RESULT_SUFFIX):
+            return
+        event = name[:-len(RESULT_SUFFIX)]
+        result = args[0] if args and isinstance (args[0], dict) else {}
+        data = result.get ('data') or {}
+        if event == 'biconcor' and data.get ('warm') is False:
+            # sent while the concordancer loads, the actual result follows
+            return
+        pending = self.pending[event]
+        if not pending:
+            self.replay.counters[event]['unexpected'] += 1
+            return
+        # results of the same event mostly come back in order, except decodes, where prefetches can overtake each other
+        index = 0
+        if event == 'decode':
+            index = next ((i for i,(seg_id,sent_time) in enumerate (pending) if seg_id == data.get ('segId')), 0)
+        seg_id,sent_time = pending[index]
+        del pending[index]
+        self.replay.latencies[event].append (time.time() - sent_time)
+        self.replay.counters[event]['results'] += 1
+        if result.get ('errors'):
+            self.replay.counters[event]['errors'] += 1
+
+    def waiting (self):
+        return any (self.pending.itervalues())
+
+    def give_up (self):
+        for event,pending in self.pending.iteritems():
+            self.replay.counters[event]['lost'] += len (pending)
+        self.pending.clear()
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# servers
+
+def free_port ():
+    sock = socket.socket()
+    sock.bind (('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+@gen.coroutine
+def wait_for_url (url, process=None, timeout=STARTUP_TIMEOUT):
+    loop = ioloop.IOLoop.current()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            yield httpclient.AsyncHTTPClient().fetch (url)
+            return
+        except Exception:
+            if time.time() > deadline or (process is not None and process.poll() is not None):
+                raise IOError ("%s didn't come up" % url)
+        yield gen.Task (loop.add_timeout, time.time() + 0.1)
+
+def start_process (cmd, log_path):
+    """ Starts a server in its own process group, so that its children (e.g. predict processes) can be stopped along with it """
+    log = open (log_path, 'w')
+    print ' '.join (cmd)
+    return subprocess.Popen (cmd, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+def stop_process (process):
+    if process is not None and process.poll() is None:
+        try:
+            os.killpg (process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        process.wait()
+
+class MemorySampler (object):
+    """ Samples the resident memory of a process plus all of its descendants, and keeps the peak """
+
+    def __init__ (self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self.callback = ioloop.PeriodicCallback (self.sample, RSS_SAMPLING_INTERVAL * 1000)
+
+    def start (self):
+        self.sample()
+        self.callback.start()
+
+    def stop (self):
+        self.sample()
+        self.callback.stop()
+
+    def sample (self):
+        pids = self.descendants (self.pid) + [self.pid]
+        rss = sum (proc_status (pid).get ('VmRSS', 0) for pid in pids)
+        self.peak_rss = max (self.peak_rss, rss)
+        self.peak_processes = max (self.peak_processes, len (pids))
+
+    def descendants (self, pid):
+        children = collections.defaultdict (list)
+        for name in os.listdir ('/proc'):
+            if name.isdigit():
+                try:
+                    with open ('/proc/%s/stat' % name) as stat:
+                        # the command name, in parentheses, may contain spaces
+                        ppid = int (stat.read().rsplit (')', 1)[1].split()[1])
+                except (IOError, IndexError, ValueError):
+                    continue
+                children[ppid].append (int (name))
+        found = []
+        todo = [pid]
+        while todo:
+            for child in children.get (todo.pop(), ()):
+                found.append (child)
+                todo.append (child)
+        return found
+
+    def report (self):
+        return {
+            'peak_rss': self.peak_rss,
+            'peak_processes': self.peak_processes,
+            # the kernel's high-water mark of the main process, which sampling might miss
+            'main_peak_rss': proc_status (self.pid).get ('VmHWM'),
+            }
+
+def proc_status (pid):
+    """ Returns the memory fields of /proc/PID/status, in bytes """
+    status = {}
+    try:
+        with open ('/proc/%d/status' % pid) as lines:
+            for line in lines:
+                if line.startswith ('Vm'):
+                    name,value = line.split (':', 1)
+                    status[name] = int (value.split()[0]) * 1024
+    except IOError:
+        pass
+    return status
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# backend counters
+
+@gen.coroutine
+def fetch_json (url):
+    response = yield httpclient.AsyncHTTPClient().fetch (url)
+    raise gen.Return (json.loads (response.body))
+
+@gen.coroutine
+def backend_counters (cat_server_url, stub_url=None):
+    """
+    Returns the number of requests made so far to server.py, by action, and to the prediction processes. The server.py requests
+    are counted by the stub if we have one (a batch is counted as a request per action it holds), else by cat-server.py
+    """
+    metrics = yield fetch_json (cat_server_url + '/metrics?format=json')
+    stats = metrics['stats']
+    counters = collections.Counter()
+    if stub_url is not None:
+        request_counts = yield fetch_json (stub_url + '/stats')
+        for action,count in request_counts.iteritems():
+            counters['server_py.' + action] = count
+    else:
+        for action,counts in (stats.get ('server_py') or {}).iteritems():
+            counters['server_py.' + action] = counts.get ('issued', 0)
+    prefix = stats.get ('prefix') or {}
+    counters['predict.queries'] = prefix.get ('predicted', 0) + prefix.get ('speculated', 0)
+    counters['predict.spawned'] = sum (
+        (pair.get ('predict') or {}).get ('spawned', 0) for pair in (stats.get ('language_pairs') or {}).itervalues()
+        )
+    raise gen.Return (counters)
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# report
+
+def print_report (report):
+    print
+    print '%-16s %7s %7s %6s %6s %9s %9s %9s %9s' % ('event', 'sent', 'results', 'lost', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'mean ms')
+    for event,stats in sorted (report['events'].iteritems()):
+        counts = tuple (stats.get (key, 0) for key in ('sent', 'results', 'lost', 'errors'))
+        latencies = tuple (('%.1f' % (stats[key] * 1000)) if key in stats else '-' for key in ('p50', 'p95', 'p99', 'mean'))
+        print '%-16s %7d %7d %6d %6d %9s %9s %9s %9s' % ((event,) + counts + latencies)
+    print
+    print 'elapsed: %.1f s, throughput: %.1f results/s' % (report['elapsed'], report['throughput'] or 0)
+    backend = report.get ('backend')
+    if backend is not None:
+        per_event = lambda count: float (count) / report['sent'] if report['sent'] else 0.0
+        server_py = dict ((name.split('.',1)[1], count) for name,count in backend.iteritems() if name.startswith ('server_py.'))
+        print 'server.py requests per event: %.3f (%s)' % (
+            per_event (sum (count for action,count in server_py.iteritems() if action != 'batch')),
+            ', '.join ('%s %.3f' % (action, per_event (count)) for action,count in sorted (server_py.iteritems())),
+            )
+        print 'predict queries per event: %.3f, predict processes started: %d' % (
+            per_event (backend['predict.queries']), backend['predict.spawned'])
+    memory = report.get ('memory')
+    if memory is not None:
+        print 'peak RSS: %.1f MB (cat-server.py and its children, %d processes at most), %.1f MB (cat-server.py alone)' % (
+            memory['peak_rss'] / 1048576.0, memory['peak_processes'], (memory['main_peak_rss'] or 0) / 1048576.0)
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+@gen.coroutine
+def main (settings):
+    if settings.sessions:
+        sessions = load_recorded_sessions (settings.sessions, settings.max_think_time)
+    else:
+        sessions = generate_sessions (
+            read_sentences (settings.source),
+            settings.target and read_sentences (settings.target),
+            segments_per_session = settings.segments_per_session,
+            prefetch = settings.prefetch,
+            keystroke_delay = settings.keystroke_delay,
+            think_time = settings.think_time,
+            biconcor = settings.biconcor,
+            )
+    sessions = sessions * settings.repeat
+
+    stub = cat_server = work_dir = None
+    stub_url = None
+    pid = settings.pid
+    try:
+        if settings.server:
+            host,port = settings.server.rsplit (':', 1)
+            port = int (port)
+        else:
+            host,port = '127.0.0.1', free_port()
+            work_dir = tempfile.mkdtemp (prefix='cat-bench.')
+            stub_port = free_port()
+            stub_url = 'http://127.0.0.1:%d' % stub_port
+            stub = start_process ([
+                sys.executable, os.path.join (ROOT, 'server-py-stub.py'),
+                '--port', str(stub_port),
+                '--latency', str(settings.latency),
+                '--action-latency', 'translate=%s' % settings.translate_latency,
+                ], os.path.join (work_dir, 'server-py-stub.out'))
+            yield wait_for_url (stub_url + '/stats', stub)
+            cat_server = start_process ([
+                sys.executable, os.path.join (ROOT, 'cat-server.py'),
+                '--port', str(port),
+                '--mt-port', str(stub_port),
+                '--log-dir', work_dir,
+                '--disk-cache', '',
+                ] + (['--predict-cmd', settings.predict_cmd] if settings.predict_cmd else []) + settings.server_arg,
+                os.path.join (work_dir, 'cat-server.out'))
+            pid = cat_server.pid
+        cat_server_url = 'http://%s:%d' % (host, port)
+        yield wait_for_url (cat_server_url + '/metrics', cat_server)
+
+        sampler = MemorySampler (pid) if pid else None
+        if sampler is not None:
+            sampler.start()
+        counters_before = yield backend_counters (cat_server_url, stub_url)
+        replay = Replay (host, port, sessions, settings.concurrency, settings.speed, settings.result_timeout)
+        print '%d sessions, %d events, %d at a time' % (len(sessions), sum (len(steps) for steps in sessions), settings.concurrency)
+        yield replay.run()
+        counters_after = yield backend_counters (cat_server_url, stub_url)
+        report = replay.report()
+        report['backend'] = dict ((name, counters_after[name] - counters_before[name]) for name in counters_after)
+        if sampler is not None:
+            sampler.stop()
+            report['memory'] = sampler.report()
+        print_report (report)
+        if settings.json:
+            with open (settings.json, 'w') as output:
+                json.dump (report, output, indent=2, sort_keys=True)
+    finally:
+        stop_process (cat_server)
+        stop_process (stub)
+        if work_dir is not None:
+            if settings.keep_logs:
+                print 'logs kept in %s' % work_dir
+            else:
+                shutil.rmtree (work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description=__doc__.strip().split('\n')[0])
+    parser.add_argument ('--sessions', help='sessions recorded by cat-server.py --record-sessions, to replay')
+    parser.add_argument ('--source', help='source sentences to generate sessions from, one per line')
+    parser.add_argument ('--target', help='translations of the source sentences, typed in by the generated sessions (default: the source sentences)')
+    parser.add_argument ('--segments-per-session', help='number of consecutive segments translated in a generated session, default 10', type=int, default=10)
+    parser.add_argument ('--prefetch', help='number of following segments prefetched along with each decode, default 3', type=int, default=3)
+    parser.add_argument ('--keystroke-delay', help='seconds between two keystrokes of a generated session, default 0.1', type=float, default=0.1)
+    parser.add_argument ('--think-time', help='seconds before each decode and alignment request of a generated session, default 1', type=float, default=1.0)
+    parser.add_argument ('--biconcor', help='generated sessions also ask for concordances (cat-server.py must have a concordancer, see --server-arg)', action='store_true')
+    parser.add_argument ('--max-think-time', help='longest wait between two events of a recorded session, in seconds, default 5', type=float, default=5.0)
+    parser.add_argument ('--speed', help='replay speed: the waits between events are divided by this, default 1', type=float, default=1.0)
+    parser.add_argument ('--repeat', help='number of times each session is replayed, default 1', type=int, default=1)
+    parser.add_argument ('--concurrency', help='number of sessions replayed at a time, default 10', type=int, default=10)
+    parser.add_argument ('--result-timeout', help='seconds to wait for the results still expected at the end of a session, default 30', type=float, default=30.0)
+    parser.add_argument ('--server', help='HOST:PORT of a running cat-server.py (default: start server-py-stub.py and cat-server.py)')
+    parser.add_argument ('--pid', help='pid of the running cat-server.py, for measuring its memory', type=int)
+    parser.add_argument ('--latency', help='seconds the server.py stand-in takes to answer any request, default 0', type=float, default=0.0)
+    parser.add_argument ('--translate-latency', help='seconds the server.py stand-in takes to decode a sentence, default 0.2', type=float, default=0.2)
+    parser.add_argument ('--predict-cmd', help='prediction binary for the cat-server.py started by the benchmark')
+    parser.add_argument ('--server-arg', help='extra argument for the cat-server.py started by the benchmark (can be repeated, e.g. --server-arg=--workers=4)', action='append', default=[])
+    parser.add_argument ('--keep-logs', help="don't delete the logs of the servers started by the benchmark", action='store_true')
+    parser.add_argument ('--json', help='file where the results are also written, as JSON')
+    settings = parser.parse_args (sys.argv[1:])
+    if not settings.sessions and not settings.source:
+        parser.error ('give either --sessions or --source')
+    ioloop.IOLoop.instance().run_sync (lambda: main (settings))
+
+#----------------------------------------------------------------------------------------------------------------------------------
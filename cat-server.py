@@ -3,22 +3,19 @@
 
 ### includes ###
 
-import cStringIO
 import collections
-import copy
 import datetime
 import functools
+import glob
 import hashlib
 import logging
 import os
 import re
-import signal
-import subprocess
 import sys
 import time
 import traceback
+import unicodedata
 import urllib
-import urllib2
 
 try:
   import simplejson as json
@@ -26,7 +23,8 @@ except ImportError:
   import json
 
 try:
-  from tornado import web
+  from tornado import gen, web, httpserver, ioloop, netutil
+  from tornado.concurrent import Future
 except:
   print >> sys.stderr, """This software requires Tornado. Please, install the python-tornado package from your distribution."""
 
@@ -35,51 +33,112 @@ try:
 except:
   print >> sys.stderr, """This software requires Tornadio2. Please, install Tornadio2 from here: https://github.com/mrjoes/tornadio2"""
 
-from biconcor import BiconcorProcess, parse_biconcor_output_into_json_struct
-
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+from biconcor import BiconcorProcess, BiconcorError, BiconcorTimeout, parse_biconcor_output, concordance_token_lists, fill_in_concordance_sentences
+from biconcor import BICONCOR_WORKERS, BICONCOR_TIMEOUT, BICONCOR_LOAD_TIMEOUT
+from mtclient import ServerPyClient, Backend, MAX_CONNECTIONS, DEFAULT_PRIORITY, PRIORITIES, parse_backend, parse_timeout_settings, parse_class_limits
+from catcache import NamespacedCache, SharedStore, SHARED_STORE_MAX_BYTES, parse_cache_settings
+from mosestext import TextProcessor, load_nonbreaking_prefixes
+import transoptions
+from metrics import Metrics
+from catlog import AsyncHandler, EventTracer, SessionRecorder, LOG_LEVELS, MAX_TRACE_LENGTH, parse_sampling_settings
+from workers import Cluster, AffinityRouter
+from diskstore import DiskStore, DISK_STORE_MAX_BYTES, DISK_STORE_MAX_AGE
+from predictpool import PredictPool, PredictTimeout, PredictError, serialize_search_graph, graph_format_id
+from predictpool import PREDICT_CMD, DAEMONS, MAX_PROCESSES, MAX_MEMORY, IDLE_TIMEOUT, QUERY_TIMEOUT, GRAPH_FORMATS
+
+sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+
+# Tracing of the socket.io events received and of the results emitted, written to stdout by a background thread. See catlog.py
+trace_logger = logging.getLogger('catserver.trace')
+trace_logger.propagate = False
+trace_logger.setLevel(logging.INFO)
+trace_logger.addHandler(AsyncHandler(logging.StreamHandler(sys.stdout)))
+tracer = EventTracer(trace_logger)
+
+# Recording of the socket.io events received, in full, for replaying them with cat-bench.py (None when not recording)
+recorder = None
 
 ### global vars ###
 
 # root directory of the server
 ROOT = os.path.normpath(os.path.dirname(__file__))
 
-# BiconcorProcess objects, indexed by the language pair
-biconcor_processes = {}
+# Concordancer of the default language pair (the other pairs set theirs in --language-pairs), see `LanguagePair'
 biconcor_model = None
 biconcor_cmd = None
+# Number of biconcor binaries per model, and seconds they're allowed per query and for loading the model, see biconcor.py
+biconcor_workers = BICONCOR_WORKERS
+biconcor_timeout = BICONCOR_TIMEOUT
+biconcor_load_timeout = BICONCOR_LOAD_TIMEOUT
 
 # Defaults for MT Server
 mt_port = 9000
 mt_host = 'localhost'
+mt_backends = [] # more server.py instances to spread the requests over, as mtclient.Backends
+mt_max_connections = MAX_CONNECTIONS
+mt_timeouts = {}
+mt_batch = True # send concurrent text processing requests to server.py in batches, see mtclient.py
+mt_class_limits = {} # maximum number of connections to server.py per priority class, see mtclient.py
+mt_model_id = None # names the models behind the server.py instances in the keys of `disk_store', see `disk_store_key'
 log_dir = '.'
 
+# The worker processes, when there are several of them (None otherwise). See workers.py
+cluster = None
+
+# Store of the translate responses (with their options and search graphs) on disk, so that restarts aren't cold. See diskstore.py
+disk_store = None
+
+# Format of the search graphs sent to the prediction binary, see predictpool.py. 'binary' needs a predict built from this
+# version of predict.cpp, so it has to be asked for
+predict_graph_format = 'csv'
+
+# Settings of the PredictPools, as keyword arguments. Language pairs may override them, see `LanguagePair'
+predict_settings = {}
+
+# Settings of the cache namespaces, as given on the command line: namespace -> {'max_bytes':..., 'ttl':...}. Each language pair
+# has its own caches, with these settings unless it overrides them
+cache_settings = {}
+
+# In-process text processing, see mosestext.py. It is off unless asked for, since any difference with the Moses scripts that
+# server.py runs changes the prefixes sent to predict (mosestext.py can check a corpus against them)
+in_process_text_processing = False
+truecase_model = None # of the default language pair
+nonbreaking_prefix_files = (None, None) # source, target
+
 ### generic utils ###
 
 def cat_event (func):
-  """ Use this in place of tornadio's `event'. Adds some debugging utils to the function """
+  """ Use this in place of tornadio's `event'. Adds some debugging utils to the function, and records its latency """
   @functools.wraps (func)
   def wrapper (self, *args, **kwargs):
+    done = metrics.timer ('event', func.__name__)
     try:
-      print
-      print "%s(%s)" % (
-        func.__name__,
-        ', '.join (map(repr,args) + ['%s=%r' % i for i in sorted(kwargs.iteritems())])
-        )
-      return func (self, *args, **kwargs)
+      tracer.event (func.__name__, args, kwargs)
+      if recorder is not None:
+        recorder.record (self, func.__name__, args, kwargs)
+      result = func (self, *args, **kwargs)
+      if isinstance (result, Future):
+        # coroutine handlers fail after they've returned, so their errors are reported once they're done
+        result.add_done_callback (print_future_exception)
+        result.add_done_callback (done)
+        return None
+      done()
+      return result
     except Exception:
       # herve - if we raise an exception here, the whole websocket gets disconnected. So rather than do that, we print out the
       # error, and silence the exception. The client won't see a response, but at least they also won't get disconnected.
       print traceback.format_exc()
+      done()
   return event (wrapper)
 
+def print_future_exception (future):
+  """ Done-callback for the futures of coroutine event handlers. Prints out the exception, like `cat_event' does """
+  if future.exception() is not None:
+    if hasattr (future, 'exc_info'):
+      print ''.join (traceback.format_exception (*future.exc_info()))
+    else:
+      print repr (future.exception())
 
-class Alarm(Exception):
-    pass
-
-def alarm_handler(signum, frame):
-    """ used for timeout when calling subprocess """
-    raise Alarm
 
 def toutf8(string):
   """ strings in python are unicode. We need to convert them to uft8 """
@@ -90,6 +149,27 @@ def toutf8(string):
   assert isinstance(string,str), repr(string)
   return string
 
+class FrozenDict (dict):
+    """ A dict that refuses to be modified. See `freeze' """
+    def _read_only (self, *args, **kwargs):
+        raise TypeError ("%s is read-only" % type(self).__name__)
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+    def __reduce__ (self):
+        # unpickling a dict subclass normally sets its items one by one
+        return (FrozenDict, (dict(self),))
+
+def freeze (struct):
+  """
+  Returns a read-only copy of a JSON-like structure: dicts become FrozenDicts and lists become tuples. Frozen structures can be
+  cached and handed out to any number of callers without copying them, and still serialize to the same JSON.
+  """
+  if isinstance (struct, dict):
+    return FrozenDict ((key, freeze(val)) for key,val in struct.iteritems())
+  elif isinstance (struct, (list,tuple)):
+    return tuple (freeze(val) for val in struct)
+  else:
+    return struct
+
 class MRUDict (collections.MutableMapping):
     """ Container class that acts as a dictionary but only remembers the K items that were last accessed """
     def __init__ (self, max_size, items=()):
@@ -108,13 +188,8 @@ class MRUDict (collections.MutableMapping):
         del self.impl[key]
 
     def __contains__ (self, key):
-        if key in self.impl:
-            # re-insert the item so that it is now the MRU item
-            val = self.impl.pop (key)
-            self.impl[key] = val
-            return True
-        else:
-            return False
+        # a membership test doesn't count as a use, so the order is left untouched
+        return key in self.impl
 
     def __getitem__ (self, key):
         # re-insert the item so that it is now the MRU item
@@ -129,117 +204,341 @@ class MRUDict (collections.MutableMapping):
         self.impl[key] = val
 
 
-### Cached searchgraphs (index: source sentence. Remember to include language pair later)
-searchGraph = MRUDict (1000)
-translationOptions = MRUDict(1000)
-predictProcess = MRUDict(1000)
+### language pairs ###
 
-### connection to server.py ###
+# Language pair of the connections that don't choose one (see the `configure' event), named after --source-lang and --target-lang
+default_language_pair = 'xx-xx'
 
-# should this be per-connection?
-server_py_cache = MRUDict (1000)
-
-def request_to_server_py (text, action='translate', use_cache=False, target=''):
-
-  if isinstance (text, unicode):
-    text = text.encode ('UTF-8')
-  if isinstance (target, unicode):
-    target = target.encode ('UTF-8')
-
-  # herve - several operations crash in server.py if there are spaces around the string. I'm not sure where to strip them -- here
-  # in cat-server.py, or in the GUI itself. Trimming off whitespace in the GUI might solve the bug "at the root", but as far as I
-  # know it might sometimes be required to preserve whitespace. So I've added this here.
-  text = text and text.strip()
-  target = target and target.strip()
-
-  params = '' # additional parameters
-  if action == 'translate':
-    params = '&key=0&source=xx&target=xx&sg=true&topt=true' # sg=true to return searchgraph; topt=true to return translation options
-  elif action == 'align' or action == 'tokenize' or action == 'confidence':
-    params = '&t=%s' % urllib.quote_plus(target)
-    if action == 'align':
-      params = params + '&mode=sym'
-  elif action == 'update':
-    params = "&t=%s&source=xx&target=xx" % urllib.quote_plus(target)
-
-  url = 'http://%s:%d/%s?%s' % (
-    mt_host,
-    mt_port,
-    action,
-    'q=%s' % urllib.quote_plus(text) + params,
-  )
-  logging.debug(url)
-
-  missing = object()
-  output_struct = missing
-  if use_cache:
-    from_cache = server_py_cache.get (url)
-    if from_cache is not None:
-      print "%s [cached]" % url
-      output_struct = from_cache
+# Settings of the language pairs, by name (e.g. 'en-de'), as read from the --language-pairs file. See `LanguagePair'
+language_pair_settings = {}
 
-  if output_struct is missing:
-    print url
-    req = urllib2.Request (url, '', {'Content-Type': 'application/json'})
+# LanguagePairs, by name, created on first use. See `language_pair'
+language_pairs = {}
 
-    try:
-      f = urllib2.urlopen (url)
-    except urllib2.HTTPError, err:
-      f = err
-    json_str = f.read()
-    f.close()
+class LanguagePair (object):
+    """
+    Everything that depends on the language pair: the server.py backends, the caches, the predict processes, the concordancer and
+    the in-process text processing. Each pair has its own caches and process limits, so that a busy pair can't push another
+    pair's segments out.
+
+    `settings' is the pair's entry in the --language-pairs file, which may set:
+      mt, mt_no_update         lists of 'host:port' of server.py instances (default: those given on the command line)
+      mt_max_connections       maximum number of simultaneous connections to each of them
+      mt_model_id              names the models behind them, over --mt-model-id (see `disk_store_key')
+      biconcor_workers         number of concordancer binaries
+      predict                  PredictPool settings (cmd, daemons, max_processes, max_memory in MB, timeout, idle_timeout,
+                               graph_format), over those given on the command line
+      cache_size, cache_ttl    namespace -> megabytes, and namespace -> seconds, over those given on the command line
+      in_process_text_processing
+                               true or false, over --in-process-text-processing
+      biconcor_model, truecase_model, source_nonbreaking_prefixes, target_nonbreaking_prefixes
+                               which are only taken from the command line for the default pair
+    """
 
-    try:
-      output_struct = json.loads (json_str)
-    except Exception:
-      print "Can't parse JSON: %r" % json_str
-      raise
-    if use_cache:
-      try:
-	dummy = output_struct[u'data']
-        server_py_cache[url] = output_struct
-      except:
-        print "nope, not storing in cache, data faulty"
+    def __init__ (self, name, settings):
+      self.name = name
+      self.source_lang, self.target_lang = name.split('-', 1)
+      self.settings = settings
+      is_default = name == default_language_pair
+      own_setting = lambda key, default: settings.get(key, default if is_default else None)
+
+      # `predict' settings, over those given on the command line, see predictpool.py
+      pool_settings = dict(predict_settings)
+      pool_settings.update(settings.get('predict', {}))
+      self.graph_format = pool_settings.pop('graph_format', predict_graph_format)
+
+      # Byte-bounded caches, one namespace per server.py action (indexed by `key' of the request URL) plus 'searchgraph' and
+      # 'prefix'. See catcache.py
+      self.caches = NamespacedCache()
+      for namespace,namespace_settings in cache_settings.iteritems():
+        self.caches.configure(namespace, **namespace_settings)
+      for namespace,namespace_settings in parse_cache_settings(
+          ['%s=%s' % item for item in settings.get('cache_size', {}).iteritems()],
+          ['%s=%s' % item for item in settings.get('cache_ttl', {}).iteritems()]).iteritems():
+        self.caches.configure(namespace, **namespace_settings)
+      if cluster is not None:
+        # the translate responses and search graphs hold serialized graphs, so a restart with another graph format mustn't find
+        # them in a store left over in /dev/shm
+        self.caches.share(cluster.store, prefix='%s/%s/' % (name, graph_format_id(self.graph_format)))
+      # serialized search graphs, indexed by search graph id
+      self.search_graphs = self.caches['searchgraph']
+      # finished completions of the prefixes typed by the users, see `complete_prefix'
+      self.prefix_cache = self.caches['prefix']
+      # processed translation options, indexed by search graph id, see `process_options'
+      self.translation_options = self.caches['options']
+      # alignment of each translation, taken from its search graph, for serving getAlignments and getTokens without asking
+      # server.py. Indexed by search graph id, see `decoded_alignment'
+      self.translation_alignments = self.caches['alignments']
+
+      # `predict' child processes, indexed by search graph id
+      self.predict_pool = PredictPool(**pool_settings)
+
+      self.backends = [Backend(mt_host, mt_port)] + [Backend(b.host, b.port, b.updates) for b in mt_backends]
+      if 'mt' in settings or 'mt_no_update' in settings:
+        self.backends = [parse_backend(spec) for spec in settings.get('mt', ())] + \
+                        [parse_backend(spec, updates=False) for spec in settings.get('mt_no_update', ())]
+      # ServerPyClient for the requests to server.py, created on first use
+      self.mt_client = None
+      # what the translations of the pair depend on besides the source text, for the keys of `disk_store': the model id and the
+      # server.py instances
+      self.mt_generation = hashlib.sha1('%s|%s' % (
+        settings.get('mt_model_id', mt_model_id) or '',
+        ','.join(sorted('%s:%d' % (backend.host, backend.port) for backend in self.backends)),
+      )).hexdigest()[:16]
+
+      self.biconcor_model = own_setting('biconcor_model', biconcor_model)
+      self.biconcor_cmd = settings.get('biconcor_cmd', biconcor_cmd)
+      # BiconcorProcess (a pool of biconcor binaries), created on first use
+      self.biconcor_process = None
+
+      # mosestext.TextProcessor that does the tokenization and postprocessing of the setPrefix path in-process, or None to have
+      # server.py do it. Only used when in-process text processing is turned on and the pair has a truecasing model
+      self.text_processor = None
+      if settings.get('in_process_text_processing', in_process_text_processing) and own_setting('truecase_model', truecase_model):
+        self.text_processor = TextProcessor(
+          self.source_lang,
+          self.target_lang,
+          own_setting('truecase_model', truecase_model),
+          nonbreaking_prefixes = [path and load_nonbreaking_prefixes(path) for path in (
+            own_setting('source_nonbreaking_prefixes', nonbreaking_prefix_files[0]),
+            own_setting('target_nonbreaking_prefixes', nonbreaking_prefix_files[1]),
+          )],
+        )
 
-  if output_struct.get('traceback'):
-    print re.sub (r'^', 'server.py: ', output_struct['traceback'], flags=re.M)
-  return copy.deepcopy (output_struct)
+    def key (self, sgId):
+      """ Returns a search graph id qualified with the pair's name, for the structures that are shared by all pairs """
+      return '%s:%s' % (self.name, sgId)
+
+    def stats (self):
+      return {
+        'caches': self.caches.stats(),
+        'predict': self.predict_pool.stats(),
+        'server_py_client': self.mt_client.stats() if self.mt_client is not None else None,
+        'text_processing': self.text_processor.stats() if self.text_processor is not None else None,
+        'biconcor': self.biconcor_process.stats() if self.biconcor_process is not None else None,
+      }
+
+def language_pair(name=None):
+  """ Returns the LanguagePair of that name, or the default one. Raises ValueError for pairs that aren't configured """
+  name = name or default_language_pair
+  pair = language_pairs.get(name)
+  if pair is None:
+    if name != default_language_pair and name not in language_pair_settings:
+      raise ValueError("unknown language pair %r" % name)
+    pair = language_pairs[name] = LanguagePair(name, language_pair_settings.get(name, {}))
+  return pair
+
+def load_language_pair_settings(path):
+  """ Reads the --language-pairs file: a JSON object with the settings of each pair, by name, see `LanguagePair' """
+  with open(path) as settings_file:
+    settings = json.load(settings_file)
+  for name,pair_settings in settings.iteritems():
+    if '-' not in name:
+      raise ValueError("language pair %r should be named SOURCE-TARGET" % name)
+    predict = pair_settings.get('predict', {})
+    if 'max_memory' in predict:
+      predict['max_memory'] = predict['max_memory'] * 1024 * 1024
+    if 'timeout' in predict:
+      predict['query_timeout'] = predict.pop('timeout')
+  return dict((str(name), pair_settings) for name,pair_settings in settings.iteritems())
+
+### connection to server.py ###
 
+# Futures of the requests to server.py that are currently being processed, indexed by language pair and URL. Callers that ask
+# for a request that is already in flight wait for the same result instead of sending the request again.
+server_py_in_flight = {}
+# Request counts by action: 'issued' (sent to server.py), 'coalesced' (joined an in-flight request) and 'cached' (of which
+# 'from_disk' were read from `disk_store'). 'issued_time' is the total time spent waiting for issued requests.
+server_py_stats = collections.defaultdict (collections.Counter)
+
+# server.py actions that have side effects, and so must never be coalesced
+NON_IDEMPOTENT_ACTIONS = ('update',)
+
+def server_py_client (pair=None):
+  """ Returns the ServerPyClient of a LanguagePair (by default, of the default pair) """
+  pair = pair or language_pair()
+  if pair.mt_client is None:
+    max_connections = pair.settings.get ('mt_max_connections', mt_max_connections)
+    pair.mt_client = ServerPyClient (pair.backends, max_connections=max_connections, timeouts=mt_timeouts, batch=mt_batch, class_limits=mt_class_limits)
+  return pair.mt_client
+
+@gen.coroutine
+def request_to_server_py (text, action='translate', use_cache=False, target='', priority=DEFAULT_PRIORITY, owner=None, pair=None):
+  done = metrics.timer ('server_py', action)
+  # failed and timed out requests are timed too
+  try:
+    pair = pair or language_pair()
+    if isinstance (text, unicode):
+      text = text.encode ('UTF-8')
+    if isinstance (target, unicode):
+      target = target.encode ('UTF-8')
+
+    # herve - several operations crash in server.py if there are spaces around the string. I'm not sure where to strip them --
+    # here in cat-server.py, or in the GUI itself. Trimming off whitespace in the GUI might solve the bug "at the root", but as far
+    # as I know it might sometimes be required to preserve whitespace. So I've added this here.
+    text = text and text.strip()
+    target = target and target.strip()
+
+    langs = '&source=%s&target=%s' % (pair.source_lang, pair.target_lang)
+    params = '' # additional parameters
+    if action == 'translate':
+      params = '&key=0%s&sg=true&topt=true' % langs # sg=true to return searchgraph; topt=true to return translation options
+    elif action == 'align' or action == 'tokenize' or action == 'confidence':
+      params = '&t=%s' % urllib.quote_plus(target)
+      if action == 'align':
+        params = params + '&mode=sym'
+    elif action == 'update':
+      params = "&t=%s%s" % (urllib.quote_plus(target), langs)
+
+    client = server_py_client(pair)
+    url = '%s/%s?%s' % (
+      client.base_url(),
+      action,
+      'q=%s' % urllib.quote_plus(text) + params,
+    )
+    # only translate and update send the language pair to server.py, but the other actions depend on it too (the pairs may
+    # share backends), so it is part of the key that requests are cached and coalesced under
+    request_key = pair.key (url)
 
-def request_translation_and_searchgraph(source, returnTranslation = True, returnOptions = True):
-    translation = request_to_server_py (source, use_cache=True)
+    missing = object()
+    output_struct = missing
+    if use_cache:
+      from_cache = pair.caches[action].get (request_key)
+      if from_cache is None and action == 'translate' and disk_store is not None:
+        from_cache = disk_store.get (disk_store_key (text, pair))
+        if from_cache is not None:
+          server_py_stats[action]['from_disk'] += 1
+          pair.caches[action][request_key] = from_cache
+      if from_cache is not None:
+        logging.debug ('%s [cached]', url)
+        output_struct = from_cache
+
+    if output_struct is not missing:
+      server_py_stats[action]['cached'] += 1
+    elif action not in NON_IDEMPOTENT_ACTIONS:
+      in_flight = server_py_in_flight.get (request_key)
+      if in_flight is not None:
+        logging.debug ('%s [coalesced]', url)
+        server_py_stats[action]['coalesced'] += 1
+        # if the request is still waiting to be sent, it should now be sent as early as we need it
+        client.promote (url, priority)
+      else:
+        in_flight = server_py_in_flight[request_key] = fetch_from_server_py (
+          client, url, request_key, action, text, use_cache, priority, owner, pair)
+        in_flight.add_done_callback (lambda future: server_py_in_flight.pop (request_key, None))
+      output_struct = yield in_flight
+    else:
+      output_struct = yield fetch_from_server_py (client, url, request_key, action, text, use_cache, priority, owner, pair)
+
+    if output_struct.get('traceback'):
+      logging.warning ('%s', re.sub (r'^', 'server.py: ', output_struct['traceback'], flags=re.M))
+    # the struct is frozen (see `normalize_server_py_response'), so it's safe to hand it out without copying it
+    raise gen.Return (output_struct)
+  finally:
+    done()
+
+@gen.coroutine
+def fetch_from_server_py (client, url, request_key, action, text, use_cache, priority, owner, pair):
+  """ Sends the request to server.py and parses the response. Use `request_to_server_py' rather than calling this directly """
+  logging.debug ('%s [issued]', url)
+  server_py_stats[action]['issued'] += 1
+  start_time = time.time()
+  try:
+    json_str = yield client.fetch (url, action, priority, owner)
+  finally:
+    server_py_stats[action]['issued_time'] += time.time() - start_time
+    metrics.observe ('backend', action, time.time() - start_time)
+
+  done = metrics.timer ('stage', 'parse')
+  try:
+    output_struct = json.loads (json_str)
+  except Exception:
+    print "Can't parse JSON: %r" % json_str
+    raise
+  output_struct = normalize_server_py_response (action, text, output_struct, pair)
+  done()
+  if use_cache:
+    try:
+      dummy = output_struct[u'data']
+      pair.caches[action][request_key] = output_struct
+    except:
+      print "nope, not storing in cache, data faulty"
+    else:
+      if action == 'translate' and disk_store is not None:
+        disk_store.put (disk_store_key (text, pair), output_struct)
+  raise gen.Return (output_struct)
+
+def disk_store_key (text, pair):
+  """
+  Key of a translate response in `disk_store': the language pair, its `mt_generation' (the model id and the server.py instances
+  that produced it), the format its search graph is serialized in (which may have changed since it was stored) and the search
+  graph id of the (UTF-8) source text. Responses stored under another generation are never read again, and age out
+  """
+  return pair.key ('%s:%s:%s' % (pair.mt_generation, graph_format_id (pair.graph_format), hashlib.sha224 (text).hexdigest()))
+
+def server_py_request_stats ():
+  """
+  Returns the request counters, by action, along with an estimate of the server.py time saved by coalescing (the number of
+  coalesced requests times the average duration of the issued ones)
+  """
+  stats = {}
+  for action,counts in server_py_stats.iteritems():
+    stats[action] = dict (counts)
+    if counts['issued']:
+      stats[action]['saved_time'] = counts['coalesced'] * counts['issued_time'] / counts['issued']
+  return stats
+
+
+def normalize_server_py_response (action, text, output_struct, pair):
+  """
+  Brings a freshly parsed server.py response into the form used by the handlers, and freezes it. Tokenization spans are fixed
+  (see `fix_span_mismatches'). For translations, the search graph is replaced by its serialization for the predict binary
+  ('predictSearchGraph'), and the translation options by their processed version ('options'). Since this is done once, before the
+  response is cached, cache hits don't need to copy or reprocess anything.
+  """
+  data = output_struct.get (u'data')
+  if isinstance (data, dict):
+    if isinstance (data.get (u'tokenization'), dict):
+      data[u'tokenization'] = fix_tokenization_spans (data[u'tokenization'])
+    if action == 'translate' and data.get (u'translations'):
+      translation = data[u'translations'][0]
+      translation[u'tokenization'] = fix_tokenization_spans (translation[u'tokenization'])
+      if u'searchGraph' in translation:
+        alignment = search_graph_alignment (translation[u'searchGraph'])
+        if alignment is not None and alignment[1] == len (translation[u'tokenization'][u'tgt'] or ()):
+          translation[u'alignment'] = alignment[0]
+        translation[u'predictSearchGraph'] = serialize_search_graph (translation.pop (u'searchGraph'), pair.graph_format)
+      if u'topt' in translation:
+        translation[u'options'] = process_options (text, translation, 5, pair) # source sentence, translation, max_level size
+        del translation[u'topt']
+  return freeze (output_struct)
+
+
+@gen.coroutine
+def request_translation_and_searchgraph(source, returnTranslation = True, returnOptions = True, priority = DEFAULT_PRIORITY, owner = None, pair = None):
+    pair = pair or language_pair()
+    translation = yield request_to_server_py (source, use_cache=True, priority=priority, owner=owner, pair=pair)
     logging.debug('translation')
     logging.debug(translation)
-    target = translation[u'data'][u'translations'][0][u'translatedText']
+    translation = translation[u'data'][u'translations'][0]
+    target = translation[u'translatedText']
 
-    srcSpans = fix_span_mismatches(translation[u'data'][u'translations'][0][u'tokenization'][u'src'])
-    tgtSpans = fix_span_mismatches(translation[u'data'][u'translations'][0][u'tokenization'][u'tgt'])
+    srcSpans = translation[u'tokenization'][u'src']
+    tgtSpans = translation[u'tokenization'][u'tgt']
 
     sgId = hashlib.sha224(toutf8(source)).hexdigest() # unique searchgraph/sentence id generated by source
 
     """ searchgraph """
-    sg = translation[u'data'][u'translations'][0][u'searchGraph']
-
-    output = cStringIO.StringIO()
-    firstLine = True
-    for row in sg:
-        if firstLine:
-            output.write("hyp,stack,back,score,transition,recombined,forward,fscore,covered-start,covered-end,out\n")
-            output.write(str(row["hyp"])+','+str(row["stack"])+',0,0,-1,'+ str(int(row["forward"]))+','+str(row["fscore"])+'\n')
-            firstLine = False
-        else:
-            try:
-                output.write(str(row["hyp"])+','+str(row["stack"])+','+str(row["back"])+','+str(row["score"])+','+str(row["transition"])+','+str(row["recombined"])+','+str(int(row["forward"]))+','+str(row["fscore"])+','+ str(row["cover-start"])+','+str(row["cover-end"])+',"'+toutf8(row["out"])+'"\n')
-            except:   # if no 'recombined' in line
-                output.write(str(row["hyp"])+','+str(row["stack"])+','+str(row["back"])+','+str(row["score"])+','+str(row["transition"])+',-1,'+ str(int(row["forward"]))+','+str(row["fscore"])+','+str(row["cover-start"])+','+str(row["cover-end"])+',"'+toutf8(row["out"])+'"\n')
-    output.write("ENDSG\n")
-    searchGraph[sgId] = output.getvalue()
-    output.close()
+    pair.search_graphs[sgId] = translation[u'predictSearchGraph']
+
+    """ alignment, for the getAlignments and getTokens requests made while the translation is unedited """
+    if u'alignment' in translation:
+        pair.translation_alignments[sgId] = (target, srcSpans, tgtSpans, translation[u'alignment'])
 
     """ translation options """
     tOptions = {}
     if returnOptions:
-        tOptions = process_options(source, translation[u'data'][u'translations'][0][u'topt'], 5) # source sentence, options, max_level size
+        tOptions = translation[u'options']
 
     if returnTranslation:
        # needs to have >1 translations
@@ -249,103 +548,418 @@ def request_translation_and_searchgraph(source, returnTranslation = True, return
                                        { 'target': target , 'targetSegmentation': tgtSpans }
                                      )
                             } }
-        return res
+        raise gen.Return (res)
 
 # mismatch with span specifications, maybe should be changed in UI
 def fix_span_mismatches(spans):
-    for i in range(0, len(spans)):
-        if spans[i][1] is not None:
-          spans[i][1] += 1
-        elif i > 0:
-          spans[i] = [ spans[i-1][1], spans[i-1][1]+1 ]
+    fixed = []
+    for span in spans:
+        if span[1] is not None:
+          fixed.append([ span[0], span[1]+1 ])
+        elif fixed:
+          fixed.append([ fixed[-1][1], fixed[-1][1]+1 ])
         else:
-          spans[i] = [0,0]
-    return spans
-
-""" process Translation Options. Same implementation as in Caitra
-Sentence: already tokenized source sentence
-Options: in JSON format, as receieved from server.py  """
-def process_options(sentence, options, max_level):
-  # init future cost spans
-  cost = {}
-  # TODO: edit server.py to return tokenizedSource by default (during decoding)
-  pProcess  = request_to_server_py(sentence, action='tokenize')
-  sentence = pProcess[u'data'][u'tokenizedSource']
-  words = sentence.split(' ')
-  wordsLength = len(words)
-
-  for start in range(0,wordsLength):
-    for end in range(start, wordsLength):
-        cost[(start, end)] = -100 * (1+end-start)
-
-  # get cheapest costs from options
-  for option in options:
-        start = option['start']
-        end = option['end']
-        fscore = option['fscore']
-        if (cost[(start, end)] < fscore):
-	  cost[(start, end)] = fscore
-
-  # get cheapest (binary) combination
-  for size in range(1, wordsLength+1):
-    for start in range(0, wordsLength - size +1):
-        cheapest = cost[(start, start+size-1)]
-        for middle in range(1, size):
-            combined = cost[(start, start+middle-1)] + cost[(start+middle, start+size-1)]
-            if combined > cheapest:
-                cheapest = combined
-
-        cost[(start,start+size-1)] = cheapest
-  path_cost = cost[(0,wordsLength-1)]
-
-  # include future cost estimate in full cost of each option
-  for option in options:
-    start = option['start']
-    end = option['end']
-    option['full_cost'] = option['fscore'] - path_cost
-    if start > 0:
-      option['full_cost'] += cost[(0, start-1)]
-    if (end+1 < wordsLength):
-      option['full_cost'] += cost[(end+1, wordsLength-1)]
-    del option['fscore'] # remove unnecessary items from the dict
-    del option['scores']
-
-  # compute level for each option
-  filled = [-1] * wordsLength
-
-  # sort options by full cost
-  options.sort(key=lambda options: options['full_cost'], reverse=True)
-  filtered_options = [] # to keep only options that have level < max_level
-
-  for k in xrange(len(options)):
-    level = 0
-
-    for i in range(options[k]['start'], options[k]['end']+1):
-      if filled[i]+1 > level:
-	level = filled[i]+1
-
-    if level <= max_level: # we want to get rid of some of the options
-      for i in range(options[k]['start'], options[k]['end']+1):
-	filled[i] = level # filled[i] +1 #
-
-      options[k]['level'] = level
-      filtered_options.append(options[k])
-
-  filtered_options.sort(key=lambda filtered_options: filtered_options['start'])
-
-  return filtered_options
+          fixed.append([0,0])
+    return fixed
+
+def fix_tokenization_spans(tokenization):
+    fixed = dict(tokenization)
+    for side in (u'src', u'tgt'):
+        if fixed.get(side) is not None:
+            fixed[side] = fix_span_mismatches(fixed[side])
+    return fixed
+
+def process_options(source, translation, max_level, pair):
+  """
+  Returns the processed translation options of a translation (see transoptions.py), computed once per search graph id and kept
+  in the pair's `translation_options'. The number of source tokens is taken from the translation's tokenization.
+  """
+  sgId = hashlib.sha224(toutf8(source)).hexdigest()
+  options = pair.translation_options.get(sgId)
+  if options is not None:
+    return options
+  if translation.get(u'tokenizedSource') is not None:
+    wordsLength = len(translation[u'tokenizedSource'].split(' '))
+  else:
+    wordsLength = len(translation[u'tokenization'][u'src'])
+  options = freeze(transoptions.process_options(translation[u'topt'], wordsLength, max_level))
+  pair.translation_options[sgId] = options
+  return options
+
+### text processing ###
+#
+# Done in-process by the language pair's `text_processor' if it has one, by server.py otherwise
+
+@gen.coroutine
+def tokenize_target(target, priority='keystroke', owner=None, pair=None):
+  """ Returns the tokenized (and truecased) form of a target text, as given to predict """
+  pair = pair or language_pair()
+  if pair.text_processor is not None:
+    raise gen.Return(pair.text_processor.tokenize_target(target.decode('utf-8').strip()))
+  pProcess = yield request_to_server_py('', action='tokenize', target=target, use_cache=True, priority=priority, owner=owner, pair=pair)
+  raise gen.Return(pProcess[u'data'][u'tokenizedTarget'])
+
+@gen.coroutine
+def postprocess_target(tokenized, priority='keystroke', owner=None, pair=None):
+  """ Detokenizes and detruecases a tokenized target text """
+  pair = pair or language_pair()
+  if pair.text_processor is not None:
+    raise gen.Return(pair.text_processor.postprocess(tokenized.decode('utf-8').strip()))
+  pProcess = yield request_to_server_py(tokenized, 'detokenize', use_cache=True, priority=priority, owner=owner, pair=pair)
+  detokenized = pProcess[u'data'][u'translations'][0][u'detokenizedText']
+  pProcess = yield request_to_server_py(toutf8(detokenized), 'detruecase', use_cache=True, priority=priority, owner=owner, pair=pair)
+  raise gen.Return(pProcess[u'data'][u'translations'][0][u'detruecasedText'])
+
+@gen.coroutine
+def tokenization_spans(source, target, priority='keystroke', owner=None, pair=None):
+  """ Returns the token spans of a source and target text (both utf8), fixed as by `fix_tokenization_spans' """
+  pair = pair or language_pair()
+  if pair.text_processor is not None:
+    raise gen.Return(pair.text_processor.tokenization_spans(source.decode('utf-8').strip(), target.decode('utf-8').strip()))
+  response = yield request_to_server_py(source, action='tokenize', target=target, use_cache=True, priority=priority, owner=owner, pair=pair)
+  raise gen.Return((response[u'data'][u'tokenization'][u'src'], response[u'data'][u'tokenization'][u'tgt']))
+
+### prefix completion ###
+
+# Finished completions of the prefixes typed by the users are kept in the language pair's `prefix_cache', indexed by (search graph
+# id, tokenized prefix). Users backspace and retype all the time, and `speculate_completions' fills in the prefixes they're likely
+# to type next, so that most keystrokes can be answered from memory.
+
+# Number of word boundaries ahead of the user's caret for which completions are computed in the background
+SPECULATION_DEPTH = 3
+
+# Search graph ids, qualified with their language pair, for which a speculation is currently running
+speculating = set()
+
+# 'keystrokes' (setPrefix calls), 'type_through' (keystrokes that agreed with the completion last sent on the connection), 'hits'
+# (completion answered from the cache), 'reused' (cached predict output, but the prefix was typed differently), 'predicted'
+# (predict was queried), 'speculated' (completions computed in the background)
+prefix_stats = collections.Counter()
+
+# Number of segments per connection for which the last completion is remembered, for typing through it
+LAST_COMPLETIONS_PER_CONNECTION = 100
+
+def prefix_completion_stats ():
+  """ Returns the prefix completion counters, along with the share of keystrokes that were answered by typing through """
+  stats = dict (prefix_stats)
+  if prefix_stats['keystrokes']:
+    stats['type_through_rate'] = float (prefix_stats['type_through']) / prefix_stats['keystrokes']
+  return stats
+
+@gen.coroutine
+def complete_prefix(source, prefix, owner=None, speculative=False, forwarded=False, pair=None):
+  """
+  Completes a target prefix (unicode, as typed by the user) for the given source (utf8), using the predict binary. Returns a
+  (completion, errors) pair, where completion is None or a frozen dict with 'target', 'sourceSegmentation' and
+  'targetSegmentation'. Speculative calls never request translations nor start prediction processes, since they're only meant to
+  fill the `prefix_cache'. With several workers, the segments owned by another worker are completed by that worker, unless the
+  call was `forwarded' from another worker in the first place.
+  """
+  pair = pair or language_pair()
+  sgId = hashlib.sha224(toutf8(source)).hexdigest()
+  if cluster is not None and not forwarded:
+    worker = cluster.owner(pair.key(sgId))
+    if worker is not None and worker != cluster.index:
+      result = yield forward_completion(worker, source, prefix, speculative, pair)
+      if result is not None:
+        raise gen.Return(result)
+
+  errors = []
+  prefix_no_encoding = prefix
+  caretPos = len(prefix_no_encoding)
+  prefix = toutf8(prefix)
+  priority = 'background' if speculative else 'keystroke'
+
+  # tokenize prefix (change of var name to "userInput" because "prefix" needs to be returned to the client)
+  userInput = yield tokenize_target(prefix, priority, owner, pair)
+  userInput = toutf8(userInput)
+
+  key = (sgId, userInput)
+  cached = pair.prefix_cache.get(key)
+  if cached is not None and cached['prefix'] == prefix:
+    prefix_stats['hits'] += 1
+    raise gen.Return((cached, errors))
+
+  if cached is not None:
+    # same tokens, typed differently (e.g. spacing). The prediction still holds, only the postprocessing needs redoing
+    prefix_stats['reused'] += 1
+    prediction = cached['prediction']
+  else:
+    if pair.search_graphs.get(sgId) is None:
+      if speculative:
+        raise gen.Return((None, errors))
+      logging.debug('request searchgraph')
+      yield request_translation_and_searchgraph(source, returnTranslation = False, returnOptions = False, priority = 'decode', owner = owner, pair = pair)
+
+    logging.debug("calling prediction binary")
+    prediction = ''
+    predict_pool = pair.predict_pool
+    process = predict_pool.get(sgId, owner=owner)
+    if process is None and not speculative and cluster is not None and not forwarded:
+      worker = cluster.claim(pair.key(sgId))
+      if worker != cluster.index:
+        # another worker started a prediction process for this segment in the meantime
+        result = yield forward_completion(worker, source, prefix_no_encoding, speculative, pair)
+        if result is not None:
+          raise gen.Return(result)
+    if process is None and not speculative:
+      logging.debug('creating a new prediction process')
+      try:
+          process = predict_pool.spawn(sgId, pair.search_graphs[sgId], owner=owner)
+      except:
+          logging.debug("could not create prediction process")
+          print sys.exc_info()[0]
+          errors.append('could not start prediction process')
+    if process is not None:
+      prefix_stats['predicted'] += 1
+      done = metrics.timer('backend', 'predict')
+      try:
+        prediction = yield process.query(userInput, predict_pool.timeout_for(process))
+        done()
+      except PredictTimeout, ex:
+        logging.debug("interaction with predict binary failed: %s" % ex)
+        predict_pool.discard(sgId)
+        errors.append('prediction timed out')
+      except PredictError, ex:
+        logging.debug("subprocess error: %s" % ex)
+        predict_pool.discard(sgId)
+        errors.append('prediction process failed')
+
+    logging.debug("prediction for prefix '" + prefix + "' is '" + prediction + "'")
+  if not prediction:
+    raise gen.Return((None, errors))
+
+  # add prefix to ensure correct tokenization (esp. of opening/closing quotes).
+  # fix bug in binary, which may introduce extra spaces
+  completed = prediction
+  if prefix.endswith(" ") and completed.startswith(" "):
+    completed = completed[1:]
+    logging.debug("removed extra space, so that prefix '" + prefix + "' is followed by '" + completed + "'")
+  completed = prefix + completed
+  #postprocessing
+  completed = yield postprocess_target(completed, priority, owner, pair)
+
+  # added for the case where the user has typed extra spaces
+  #(they are automatically removed in the postprocessing, and therefore
+  # the previous target suffix does not match the generated one, and prediction is not updated at the GUI)
+  # ' '.join(prefix.split() is the prefix string w/o excess whitespace
+  lenSplitPrefix = len(' '.join(prefix_no_encoding.split()))
+  lenPrefix = len(prefix_no_encoding)
+  if lenPrefix != lenSplitPrefix:
+    pos = caretPos - (lenPrefix - lenSplitPrefix)
+    correctedPrediction =  prefix_no_encoding + completed[pos:]
+    correctedPrediction = toutf8(correctedPrediction)
+  else:
+    correctedPrediction = toutf8(completed)
+  # call server and get relevant information from reponse
+  srcSpans, tgtSpans = yield tokenization_spans(source, correctedPrediction, priority, owner, pair)
+
+  completion = freeze({
+    'prefix': prefix,
+    'prediction': prediction,
+    'target': correctedPrediction,
+    'sourceSegmentation': srcSpans,
+    'targetSegmentation': tgtSpans,
+  })
+  pair.prefix_cache[key] = completion
+  raise gen.Return((completion, errors))
+
+@gen.coroutine
+def forward_completion(worker, source, prefix, speculative, pair):
+  """
+  Has another worker, which owns the prediction process of the segment, complete the prefix. Returns what `complete_prefix'
+  returns, or None if the worker can't be reached
+  """
+  try:
+    response = yield cluster.forward(worker, '/internal/complete', { 'source': source, 'prefix': prefix, 'speculative': speculative, 'languagePair': pair.name })
+  except Exception, ex:
+    logging.warning("could not forward completion to worker %d: %s" % (worker, ex))
+    raise gen.Return(None)
+  completion = response['completion']
+  if completion is not None:
+    # strings are utf8 throughout, not the unicode that comes out of JSON
+    completion = freeze(dict(completion, **dict((name, toutf8(completion[name])) for name in ('prefix', 'prediction', 'target'))))
+  raise gen.Return((completion, response['errors']))
+
+class ForwardedCompletionHandler(web.RequestHandler):
+    """
+    Completes prefixes for the other workers, for the segments whose prediction process this worker owns (see `complete_prefix'),
+    and speculates further on them, since the other workers can't
+    """
+
+    @gen.coroutine
+    def post(self):
+      request = json.loads(self.request.body)
+      source = toutf8(request['source'])
+      prefix = request['prefix']
+      pair = language_pair(request['languagePair'])
+      completion, errors = yield complete_prefix(source, prefix, speculative=request['speculative'], forwarded=True, pair=pair)
+      self.set_header('Content-Type', 'application/json')
+      self.write(json.dumps({ 'completion': completion, 'errors': errors }))
+      if completion is not None and not request['speculative']:
+        speculate_completions(source, hashlib.sha224(source).hexdigest(), completion, len(prefix), pair=pair)
+
+@gen.coroutine
+def speculate_completions(source, sgId, completion, caretPos, owner=None, pair=None):
+  """
+  Completes, in the background, the prefixes that end at the next SPECULATION_DEPTH word boundaries of `completion' after
+  `caretPos', i.e. what the user will have typed if they accept the next few words. Steps aside as soon as the prediction process
+  has real queries to answer.
+  """
+  pair = pair or language_pair()
+  if pair.key(sgId) in speculating:
+    return
+  speculating.add(pair.key(sgId))
+  try:
+    target = completion['target'].decode('utf-8')
+    boundaries = [end for start,end in completion['targetSegmentation'] if end > caretPos and end < len(target)]
+    for end in boundaries[:SPECULATION_DEPTH]:
+      process = pair.predict_pool.get(sgId)
+      if process is None or process.pending:
+        break
+      prefix_stats['speculated'] += 1
+      result, errors = yield complete_prefix(source, target[:end] + u' ', owner=owner, speculative=True, pair=pair)
+      if result is None:
+        break
+  except Exception:
+    print traceback.format_exc()
+  finally:
+    speculating.discard(pair.key(sgId))
+
+### alignments ###
+
+# Representations of the alignment points in the getAlignments response, which a client chooses with the `configure' event:
+#   dense  - len(sourceSegmentation) x len(targetSegmentation) matrix of 0/1, for clients that don't configure anything
+#   points - sorted list of [source token index, target token index] pairs
+#   runs   - for each source token, the list of [start,end) ranges of target token indices it's aligned to
+ALIGNMENT_FORMATS = ('dense', 'points', 'runs')
+DEFAULT_ALIGNMENT_FORMAT = 'dense'
+
+def format_alignments(alignmentPoints, srcLength, tgtLength, alignmentFormat):
+  """ Returns the alignment points (as server.py gives them) in the given format, see `ALIGNMENT_FORMATS' """
+  points = sorted(set((point[u'src_idx'], point[u'tgt_idx']) for point in alignmentPoints))
+  if alignmentFormat == 'points':
+    return [list(point) for point in points]
+  if alignmentFormat == 'runs':
+    runs = [[] for j in xrange(srcLength)]
+    for src,tgt in points:
+      # points are sorted, so a target index either extends the last run of its source token or starts a new one
+      if runs[src] and runs[src][-1][1] == tgt:
+        runs[src][-1][1] = tgt+1
+      else:
+        runs[src].append([tgt, tgt+1])
+    return runs
+  alignmentMatrix = [[0] * tgtLength for j in xrange(srcLength)]
+  for src,tgt in points:
+    alignmentMatrix[src][tgt] = 1
+  return alignmentMatrix
+
+def search_graph_alignment(searchGraph):
+  """
+  Returns the alignment points of the best translation in a search graph, in the form of server.py's `align' action, along with
+  the number of target tokens, or None if the best path can't be followed. Each hypothesis on the path aligns the source tokens
+  it covers with all of the target tokens it outputs, so this is a phrase alignment.
+  """
+  states = dict((row[u'hyp'], row) for row in searchGraph)
+  points = []
+  tgtLength = 0
+  hyp = searchGraph[0].get(u'forward', -1) if searchGraph else -1
+  for step in xrange(len(searchGraph)):
+    if hyp is None or int(hyp) < 0:
+      return points, tgtLength
+    row = states.get(int(hyp))
+    if row is None or u'cover-start' not in row:
+      return None
+    outLength = len(row.get(u'out', u'').split())
+    for src in xrange(row[u'cover-start'], row[u'cover-end']+1):
+      for tgt in xrange(tgtLength, tgtLength + outLength):
+        points.append({ u'src_idx': src, u'tgt_idx': tgt })
+    tgtLength += outLength
+    hyp = row.get(u'forward')
+  return None # the forward links go round in a cycle
+
+def decoded_alignment(source, target, pair):
+  """
+  If `target' is the translation of `source' that server.py returned (see `request_translation_and_searchgraph'), or the
+  beginning of it up to the end of a token, returns its source spans, target spans and alignment points as server.py's `align'
+  action would, taken from the search graph. Returns None if the target was edited or the translation isn't known.
+  """
+  decoded = pair.translation_alignments.get(hashlib.sha224(toutf8(source)).hexdigest())
+  if decoded is None:
+    return None
+  mtTarget, srcSpans, tgtSpans, alignmentPoints = decoded
+  # server.py strips the texts before processing them, so the spans are relative to the stripped target
+  target = target.decode('utf-8').strip() if isinstance(target, str) else target.strip()
+  if not target or not mtTarget.startswith(target):
+    return None
+  tgtLength = len(tgtSpans)
+  if len(target) < len(mtTarget):
+    # the target must stop at the end of a token, and before the start of the next
+    tgtLength = sum(1 for span in tgtSpans if span[1] <= len(target))
+    if tgtLength == 0 or tgtSpans[tgtLength-1][1] != len(target):
+      return None
+  return (srcSpans, tgtSpans[:tgtLength], [point for point in alignmentPoints if point[u'tgt_idx'] < tgtLength])
+
+### concordances ###
+
+# The finished concordances (with their sentences detokenized) are cached in each language pair's 'biconcor' namespace, indexed
+# by normalized source phrase, and kept in `disk_store' across restarts. Counters of the lookups: 'queries', 'cached' (answered
+# from the caches, of which 'from_disk' were read from `disk_store') and 'computed' (by the biconcor binary and server.py)
+concordance_stats = collections.Counter()
+
+def normalize_phrase(src_phrase):
+  """ Returns the form of a source phrase that concordances are looked up by: NFC, with the whitespace collapsed """
+  return u' '.join(unicodedata.normalize('NFC', src_phrase).split())
+
+def model_files_id(path):
+  """
+  Returns an id of the files of a model: `path' itself, or the files whose names start with it (biconcor loads FILE.*), by name,
+  size and modification time. It changes when the model is retrained.
+  """
+  paths = [path] if os.path.isfile(path) else sorted(glob.glob(path + '*'))
+  files = []
+  for file_path in paths:
+    try:
+      files.append((file_path, os.path.getsize(file_path), os.path.getmtime(file_path)))
+    except OSError:
+      pass # deleted in the meantime
+  return hashlib.sha1(repr((path, files))).hexdigest()[:16]
+
+def concordance_disk_key(phrase, pair):
+  """
+  Key of a concordance in `disk_store': the language pair, the concordancer model (see `model_files_id', so that concordances
+  of a retrained model aren't served) and the normalized source phrase
+  """
+  return pair.key('biconcor:%s:%s' % (model_files_id(pair.biconcor_model), phrase.encode('UTF-8')))
+
+def cached_concordance(phrase, pair):
+  """ Returns the concordance of a normalized source phrase from the caches, or None """
+  concor_struct = pair.caches['biconcor'].get(phrase)
+  if concor_struct is None and disk_store is not None:
+    concor_struct = disk_store.get(concordance_disk_key(phrase, pair))
+    if concor_struct is not None:
+      concordance_stats['from_disk'] += 1
+      pair.caches['biconcor'][phrase] = concor_struct
+  if concor_struct is not None:
+    concordance_stats['cached'] += 1
+  return concor_struct
+
+def cache_concordance(phrase, pair, concor_struct):
+  pair.caches['biconcor'][phrase] = concor_struct
+  if disk_store is not None:
+    disk_store.put(concordance_disk_key(phrase, pair), concor_struct)
 
 """This class will handle our client/server API. Each function we would like to
     export needs to be decorated with the @event decorator (see example below)."""
 class MinimalConnection(SocketConnection):
 
     def emit (self, *args, **kwargs):
-      """ Print out everything we emit to stdout for debugging. This method can be commented out to disable this. """
-      print "emit(%s)" % ', '.join (
-        ['%r' % a for a in args] +
-        ['%s=%r' % i for i in kwargs.iteritems()]
-        )
-      return super(MinimalConnection,self).emit (*args, **kwargs)
+      """ Traces everything we emit, at debug level (see `tracer') """
+      done = metrics.timer ('stage', 'emit')
+      tracer.emit (args[0], args[1:], kwargs)
+      result = super(MinimalConnection,self).emit (*args, **kwargs)
+      done()
+      return result
 
     # @cat_event is a decorator that exports the function to be used with the
     # socket.io javascript client.
@@ -357,13 +971,22 @@ class MinimalConnection(SocketConnection):
       print '-' * 79
       print "%s: new connection from %s" % (datetime.datetime.now(), info.ip)
       print
-      self.config = { 'enabled': True }
+      self.config = { 'enabled': True, 'alignmentFormat': DEFAULT_ALIGNMENT_FORMAT, 'languagePair': default_language_pair }
+      # the completion last sent for each segment, indexed by search graph id qualified with the language pair. See `setPrefix'
+      self.last_completions = MRUDict(LAST_COMPLETIONS_PER_CONNECTION)
 
     @cat_event
     # the on_close event is called when a socket.io connection is closed.
     # This is the place to delete session variables
     def on_close(self):
       del self.config
+      del self.last_completions
+      for pair in language_pairs.values():
+        pair.predict_pool.release_owner(self)
+
+    def _language_pair(self, data):
+      """ Returns the LanguagePair of a request: the one named by its `languagePair', or else the connection's """
+      return language_pair((data or {}).get('languagePair') or self.config['languagePair'])
 
     @cat_event
     def ping(self, data):
@@ -375,14 +998,41 @@ class MinimalConnection(SocketConnection):
       res = { 'data' : 0 }
       self.emit('getServerConfigResult', res)
 
+    # Sets options for this connection. Options that aren't given keep their value
+    """ @param {Object}
+    * @setup obj
+    *   alignmentFormat {String} 'dense' (default), 'points' or 'runs', see ALIGNMENT_FORMATS
+    *   languagePair {String} e.g. 'en-de', for the requests that don't name one (default: the server's --source-lang and
+    *     --target-lang)
+    * @trigger configureResult
+    * @return {Object}
+    *   errors {Array} List of error messages, for the options that were refused
+    *   data {Object} The options now in effect """
     @cat_event
     def configure(self, data):
-      print "configure not implemented"
+      errors = []
+      for key,val in (data or {}).iteritems():
+        if key == 'alignmentFormat' and val in ALIGNMENT_FORMATS:
+          self.config['alignmentFormat'] = val
+        elif key == 'alignmentFormat':
+          errors.append('unknown alignment format %r, use one of %s' % (val, ', '.join(ALIGNMENT_FORMATS)))
+        elif key == 'languagePair':
+          try:
+            self.config['languagePair'] = language_pair(val).name
+          except ValueError, ex:
+            errors.append(str(ex))
+        else:
+          errors.append('unknown option %r' % key)
+      res = { 'errors': errors,
+              'data': dict(self.config) }
+      self.emit('configureResult', res)
 
     @cat_event
+    @gen.coroutine
     def decode(self, data):
       start_time = time.time()
-      res = request_translation_and_searchgraph(toutf8(data[u'source']))
+      priority = 'prefetch' if data.get('isPreFetch') else 'decode'
+      res = yield request_translation_and_searchgraph(toutf8(data[u'source']), priority = priority, owner = self, pair = self._language_pair(data))
       res.get('data',{}).setdefault ('segId', data.get('segId'))
       res.get('data',{}).setdefault ('isPreFetch', data.get('isPreFetch'))
       res[u'data'][u'elapsedTime'] = time.time()-start_time
@@ -399,111 +1049,51 @@ class MinimalConnection(SocketConnection):
       print "rejectSuffix not implemented"
 
     @cat_event
+    @gen.coroutine
     def setPrefix(self, data):
       start_time = time.time()
-      errors = []
       source = toutf8(data[u'source'])
       target = data[u'target'] # don't convert to utf8, it will complain after toutf8(prefix)
       caretPos = data[u'caretPos']
       prefix = target[0:caretPos]
-      prefix_no_encoding = prefix
-      prefix = toutf8(prefix)
-
-      # tokenize prefix (change of var name to "userInput" because "prefix" needs to be returned to the client)
-      pProcess  = request_to_server_py('', action='tokenize', target=prefix)
-      userInput = pProcess[u'data'][u'tokenizedTarget']
-      userInput = toutf8(userInput)
-
-      sgId = hashlib.sha224(source).hexdigest()
-      if searchGraph.get(sgId) is None:
-        logging.debug('request searchgraph')
-        request_translation_and_searchgraph(source, returnTranslation = False, returnOptions = False)
-
-      logging.debug("calling prediction binary")
-      prediction = ''
-      timeout = 1 # seconds - only integer values allowed
-      if predictProcess.get(sgId) is None:
-        logging.debug('creating a new prediction process')
-        try:
-	    t = time.time()
-	    err = open("%s/predict.%s.%s.err" % (log_dir,sgId,t),"w")
-	    log = "%s/predict.%s.%s.in" % (log_dir,sgId,t)
-            p = subprocess.Popen(['/opt/cat-server/predict','-W','-s','3','3','-t','0.4','-f','5','-m','0.1','-l',log], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err, preexec_fn = lambda: os.nice(10),)
-            p.stdin.write(searchGraph[sgId])
-            p.stdin.flush()
-	    predictProcess[ sgId ] = p
-	    timeout = 3
-        except:
-            logging.debug("could not create prediction process")
-            print sys.exc_info()[0]
-      try:
-          predictProcess[ sgId ].stdin.write(userInput+'\n')
-          predictProcess[ sgId ].stdin.flush()
-
-          """ timeout """
-          signal.signal(signal.SIGALRM, alarm_handler)
-          signal.alarm(timeout)
+      pair = self._language_pair(data)
+
+      sgId = hashlib.sha224(toutf8(source)).hexdigest()
+      prefix_stats['keystrokes'] += 1
+      completion = self.last_completions.get(pair.key(sgId))
+      if completion is not None and completion['target'].decode('utf-8').startswith(prefix):
+          # the user is typing through the completion we last sent, which therefore still stands
+          prefix_stats['type_through'] += 1
+          errors = []
+          typed_through = True
+      else:
+          completion, errors = yield complete_prefix(source, prefix, owner=self, pair=pair)
+          typed_through = False
+          if completion is not None:
+              self.last_completions[pair.key(sgId)] = completion
 
-          try:
-            prediction = predictProcess[ sgId ].stdout.readline()
-            """ prediction, error =  p.communicate() """
-            signal.alarm(0)  # reset the alarm
-          except Alarm:
-	    logging.debug("interaction with predict binary failed")
-            predictProcess[ sgId ].kill()
-            predictProcess[ sgId ].wait()
-            del predictProcess[ sgId ]
-      except:
-        logging.debug("subprocess error")
-	predictProcess[ sgId ].kill()
-	predictProcess[ sgId ].wait()
-	del predictProcess[ sgId ]
-        '''prediction = p.stdout.readline()
-          p.kill()'''
-
-      logging.debug("prediction for prefix '" + prefix + "' is '" + prediction + "'")
       res = {}
-      if prediction:
-          # add prefix to ensure correct tokenization (esp. of opening/closing quotes).
-	  # fix bug in binary, which may introduce extra spaces
-	  if prefix.endswith(" ") and prediction.startswith(" "):
-              prediction = prediction[1:]
-              logging.debug("removed extra space, so that prefix '" + prefix + "' is followed by '" + prediction + "'")
-          prediction = prefix + prediction
-          #postprocessing
-          pProcess   = request_to_server_py(prediction, 'detokenize', use_cache=True)
-          prediction = pProcess[u'data'][u'translations'][0][u'detokenizedText']
-
-          pProcess   = request_to_server_py(toutf8(prediction), 'detruecase', use_cache=True)
-          prediction = pProcess[u'data'][u'translations'][0][u'detruecasedText']
-
-	  # added for the case where the user has typed extra spaces
-	  #(they are automatically removed in the postprocessing, and therefore
-	  # the previous target suffix does not match the generated one, and prediction is not updated at the GUI)
-	  # ' '.join(prefix.split() is the prefix string w/o excess whitespace
-	  lenSplitPrefix = len(' '.join(prefix_no_encoding.split()))
-	  lenPrefix = len(prefix_no_encoding)
-	  if lenPrefix != lenSplitPrefix:
-	    pos = caretPos - (lenPrefix - lenSplitPrefix)
-	    correctedPrediction =  prefix_no_encoding + prediction[pos:]
-	    correctedPrediction = toutf8(correctedPrediction)
-	  else:
-	    correctedPrediction = toutf8(prediction)
-	  # call server and get relevant information from reponse
-	  response = request_to_server_py(source, action='tokenize', target=correctedPrediction, use_cache=True)
-	  srcSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'src'])
-	  tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
-
-	  res = { 'errors': errors,
-		  'data': {
-			'caretPos': caretPos,
-			'elapsedTime': time.time() - start_time,
-			'source': source,
-			'sourceSegmentation' : srcSpans,
-			'nbest': [ { 'target': correctedPrediction, 'elapsedTime': time.time() - start_time, 'author': 'ITP' , 'targetSegmentation': tgtSpans }
-				 ]
-			  } }
+      if completion is not None:
+          res = { 'errors': errors,
+                  'data': {
+                        'caretPos': caretPos,
+                        'elapsedTime': time.time() - start_time,
+                        'source': source,
+                        'sourceSegmentation' : completion['sourceSegmentation'],
+                        'nbest': [ { 'target': completion['target'], 'elapsedTime': time.time() - start_time, 'author': 'ITP' , 'targetSegmentation': completion['targetSegmentation'] }
+                                 ]
+                          } }
+      elif errors:
+          res = { 'errors': errors,
+                  'data': {
+                        'caretPos': caretPos,
+                        'elapsedTime': time.time() - start_time,
+                        'source': source,
+                        'nbest': []
+                          } }
       self.emit('setPrefixResult', res)
+      if completion is not None and not typed_through:
+          speculate_completions(source, sgId, completion, caretPos, owner=self, pair=pair)
 
     # Validates source-target pair
     """ @param {Object}
@@ -517,6 +1107,7 @@ class MinimalConnection(SocketConnection):
     *   @setup data
     *     elapsedTime {Number} ms """
     @cat_event
+    @gen.coroutine
     def validate(self,data):
       start_time = time.time()
       # requires source and target text
@@ -524,7 +1115,7 @@ class MinimalConnection(SocketConnection):
       target = toutf8(data[u'target'])
 
       # call server and get relevant information from reponse
-      response = request_to_server_py(source, action='update', target=target, use_cache=True)
+      response = yield request_to_server_py(source, action='update', target=target, use_cache=True, owner=self, pair=self._language_pair(data))
 
       # send response to client
       errors = []
@@ -535,46 +1126,55 @@ class MinimalConnection(SocketConnection):
       self.emit('validateResult', res)
 
     @cat_event
+    @gen.coroutine
     def getAlignments(self, data):
       start_time = time.time()
       # requires source and target text
       source = toutf8(data[u'source'])
       target = toutf8(data[u'target'])
 
-      # call server and get relevant information from reponse
-      response = request_to_server_py(source, action='align', target=target, use_cache=True)
-      if response.get ('data'):
-        srcSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'src'])
-        tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
-        alignmentPoints = response[u'data'][u'alignment']
+      # call server and get relevant information from reponse, unless the target is (the beginning of) the MT output, whose
+      # alignment we already have
+      pair = self._language_pair(data)
+      decoded = decoded_alignment(source, target, pair)
+      if decoded is not None:
+        server_py_stats['align']['from_translation'] += 1
+        srcSpans, tgtSpans, alignmentPoints = decoded
       else:
-        srcSpans = []
-        tgtSpans = []
-        alignmentPoints = []
+        response = yield request_to_server_py(source, action='align', target=target, use_cache=True, owner=self, pair=pair)
+        if response.get ('data'):
+          srcSpans = response[u'data'][u'tokenization'][u'src']
+          tgtSpans = response[u'data'][u'tokenization'][u'tgt']
+          alignmentPoints = response[u'data'][u'alignment']
+        else:
+          srcSpans = []
+          tgtSpans = []
+          alignmentPoints = []
 
-      # process alignment points into matrix
-      print "alignmentPoints ", alignmentPoints
+      # process alignment points into the format the client asked for (a matrix unless it said otherwise)
+      alignmentFormat = self.config['alignmentFormat']
+      logging.debug("%d alignmentPoints", len(alignmentPoints))
       if len(alignmentPoints) == 0:
         errors = ['could not establish any alignment points']
-        alignmentMatrix = []
+        alignments = []
       else:
         errors = []
-        alignmentMatrix = [[0 for i in range(len(tgtSpans))] for j in range(len(srcSpans))]
-        for point in alignmentPoints:
-          alignmentMatrix[ point[u'src_idx'] ][ point[u'tgt_idx'] ] = 1
+        alignments = format_alignments(alignmentPoints, len(srcSpans), len(tgtSpans), alignmentFormat)
 
       res = { 'errors': errors,
               'data': {'source': source,
                        'sourceSegmentation': srcSpans,
                        'target': target,
                        'targetSegmentation': tgtSpans,
-                       'alignments': alignmentMatrix,
+                       'alignments': alignments,
+                       'alignmentFormat': alignmentFormat,
                        'elapsedTime': time.time() - start_time
           } }
       self.emit('getAlignmentsResult', res)
 
 
     @cat_event
+    @gen.coroutine
     def getTokens(self, data):
       start_time = time.time()
 
@@ -583,9 +1183,15 @@ class MinimalConnection(SocketConnection):
       target = toutf8(data[u'target'])
 
       # call server and get relevant information from reponse
-      response = request_to_server_py(source, action='tokenize', target=target, use_cache=True)
-      srcSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'src'])
-      tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
+      pair = self._language_pair(data)
+      decoded = decoded_alignment(source, target, pair)
+      if decoded is not None:
+        server_py_stats['tokenize']['from_translation'] += 1
+        srcSpans, tgtSpans = decoded[:2]
+      else:
+        response = yield request_to_server_py(source, action='tokenize', target=target, use_cache=True, owner=self, pair=pair)
+        srcSpans = response[u'data'][u'tokenization'][u'src']
+        tgtSpans = response[u'data'][u'tokenization'][u'tgt']
 
       errors = []
       res = { 'errors': errors,
@@ -619,15 +1225,16 @@ class MinimalConnection(SocketConnection):
     *     elapsedTime {Number} ms
     """
     @cat_event
+    @gen.coroutine
     def getConfidences(self, data):
       start_time = time.time()
 
       source = toutf8(data[u'source'])
       target = toutf8(data[u'target'])
 
-      response = request_to_server_py(source, action='confidence', target=target)
-      srcSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'src'])
-      tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
+      response = yield request_to_server_py(source, action='confidence', target=target, owner=self, pair=self._language_pair(data))
+      srcSpans = response[u'data'][u'tokenization'][u'src']
+      tgtSpans = response[u'data'][u'tokenization'][u'tgt']
       word_confidence = response[u'data'][u'confidence'][u'word']
       sent_confidence = response[u'data'][u'confidence'][u'word']
 
@@ -741,37 +1348,59 @@ class MinimalConnection(SocketConnection):
     def getValidatedContributions(self, data):
       print "getValidatedContributions not implemented"
 
-    def _biconcor_proc (self, data):
-      lang_pair = 'xx-xx' # not used
-      biconcor_proc = biconcor_processes.get (lang_pair)
-      if biconcor_proc is None and biconcor_model is not None:
-        biconcor_proc = biconcor_processes[lang_pair] = BiconcorProcess (biconcor_cmd, biconcor_model)
-      return biconcor_proc
+    def _biconcor_proc (self, pair):
+      if pair.biconcor_process is None:
+        if pair.biconcor_model is None:
+          raise ValueError ("no concordancer for language pair %s" % pair.name)
+        pair.biconcor_process = BiconcorProcess (pair.biconcor_cmd, pair.biconcor_model,
+          workers=pair.settings.get ('biconcor_workers', biconcor_workers), query_timeout=biconcor_timeout,
+          load_timeout=biconcor_load_timeout)
+      return pair.biconcor_process
 
     @cat_event
+    @gen.coroutine
     def biconcor (self, data):
       start_time = time.time()
       try:
-        biconcor_proc = self._biconcor_proc (data)
+        pair = self._language_pair (data)
+        biconcor_proc = self._biconcor_proc (pair)
         src_phrase = data['srcPhrase']
+        phrase = normalize_phrase (src_phrase)
       except Exception, ex:
         self.emit ('biconcorResult', {'errors':[str(ex)], 'data':{}})
         return
-      if not biconcor_proc.is_warm():
-        self.emit ('biconcorResult', {
-            'errors': [],
-            'data': {
-              'warm': False,
-	      'elapsedTime': time.time() - start_time,
-              'srcPhrase': src_phrase,
-              }
-            })
-      concor_struct = parse_biconcor_output_into_json_struct (
-        biconcor_proc.get_concordance (src_phrase),
-        detokenize_and_postprocess = lambda tokens: \
-          request_to_server_py (' '.join(tokens), action='detokenize', use_cache=True) \
-          ['data']['translations'][0]['detokenizedText'],
-        )
+      concordance_stats['queries'] += 1
+      concor_struct = cached_concordance (phrase, pair)
+      if concor_struct is None:
+        if not biconcor_proc.is_warm():
+          self.emit ('biconcorResult', {
+              'errors': [],
+              'data': {
+                'warm': False,
+                'elapsedTime': time.time() - start_time,
+                'srcPhrase': src_phrase,
+                }
+              })
+        done = metrics.timer ('backend', 'biconcor')
+        try:
+          raw_output = yield biconcor_proc.get_concordance (phrase)
+        except (BiconcorError, BiconcorTimeout), ex:
+          self.emit ('biconcorResult', {'errors':[str(ex)], 'data':{}})
+          return
+        finally:
+          done()
+        concor_struct = parse_biconcor_output (raw_output)
+        # detokenize all the example sentences in parallel
+        responses = yield [
+          request_to_server_py (' '.join(tokens), action='detokenize', use_cache=True, priority='background', owner=self, pair=pair)
+          for tokens in concordance_token_lists (concor_struct)
+          ]
+        fill_in_concordance_sentences (concor_struct, [
+          response['data']['translations'][0]['detokenizedText']
+          for response in responses
+          ])
+        concordance_stats['computed'] += 1
+        cache_concordance (phrase, pair, concor_struct)
       self.emit ('biconcorResult', {
           'errors': [],
           'data': {
@@ -785,9 +1414,10 @@ class MinimalConnection(SocketConnection):
     @cat_event
     def warmUpBiconcordancer (self, data):
       start_time = time.time()
-      self._biconcor_proc(data).warm_up()
+      self._biconcor_proc(self._language_pair(data)).warm_up()
 
     @cat_event
+    @gen.coroutine
     def redecode(self, data):
       start_time = time.time()
 
@@ -796,9 +1426,6 @@ class MinimalConnection(SocketConnection):
       annotation = data[u'annotation']
 
       # do something silly
-      response = request_to_server_py(source, action='tokenize', target=target, use_cache=True)
-      srcSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'src'])
-      tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
       target = ""
       for i in range(0, len(annotation)):
         if target != "":
@@ -808,8 +1435,10 @@ class MinimalConnection(SocketConnection):
         else:
           target = target + "marked"
         annotation[i] = -annotation[i]
-      response = request_to_server_py(source, action='tokenize', target=target, use_cache=True)
-      tgtSpans = fix_span_mismatches(response[u'data'][u'tokenization'][u'tgt'])
+      # the source spans don't depend on the target, so one tokenization gives both
+      response = yield request_to_server_py(source, action='tokenize', target=target, use_cache=True, owner=self, pair=self._language_pair(data))
+      srcSpans = response[u'data'][u'tokenization'][u'src']
+      tgtSpans = response[u'data'][u'tokenization'][u'tgt']
 
       # send results
       self.emit ('redecodeResult', {
@@ -833,8 +1462,65 @@ class RouterConnection(SocketConnection):
       pass
 
 
-# Create tornadio router
-MinimalRouter = TornadioRouter(RouterConnection)
+# Create tornadio router. It's created at startup (see below), since with several workers each of them needs its own
+MinimalRouter = None
+
+### metrics ###
+
+# Latency histograms, by socket.io event ('event'), by server.py action as seen by the handlers, cache hits included
+# ('server_py'), by backend call ('backend': server.py actions, predict and biconcor), and for parsing server.py responses and
+# emitting results ('stage'). See metrics.py
+metrics = Metrics()
+
+def metric_gauges():
+  """ Yields the gauges that describe the current state of the server, for `metrics' """
+  yield ('server_py_in_flight', {}, len(server_py_in_flight))
+  for name,pair in sorted(language_pairs.iteritems()):
+    pool = pair.predict_pool.stats()
+    yield ('predict_processes', { 'pair': name }, pool['live'])
+    yield ('predict_memory_bytes', { 'pair': name }, pool['rss'])
+    if pool['daemons']:
+      yield ('predict_queue_depth', { 'pair': name }, sum(daemon['pending'] for daemon in pool['daemons']))
+    else:
+      yield ('predict_queue_depth', { 'pair': name }, sum(process['pending'] for process in pool['processes']))
+    if pair.biconcor_process is not None:
+      biconcor = pair.biconcor_process.stats()
+      yield ('biconcor_processes', { 'pair': name }, sum(1 for worker in biconcor['workers'] if worker['ready']))
+      yield ('biconcor_queue_depth', { 'pair': name }, biconcor['pending'])
+    # the pairs that haven't talked to server.py yet have no client, and reading the gauges mustn't create one
+    if pair.mt_client is not None:
+      client_stats = pair.mt_client.stats()
+      for priority,counts in client_stats['scheduler'].iteritems():
+        yield ('server_py_queue_depth', { 'pair': name, 'class': priority }, counts['waiting'])
+        yield ('server_py_running', { 'pair': name, 'class': priority }, counts['running'])
+      for backend in client_stats['backends']:
+        yield ('server_py_backend_outstanding', { 'pair': name, 'backend': backend['url'] }, backend['outstanding'])
+        yield ('server_py_backend_up', { 'pair': name, 'backend': backend['url'] }, 0 if backend['ejected'] else 1)
+    for namespace,counts in pair.caches.stats().iteritems():
+      lookups = counts['hits'] + counts['misses']
+      yield ('cache_hit_rate', { 'pair': name, 'namespace': namespace }, float(counts['hits']) / lookups if lookups else 0.0)
+      yield ('cache_bytes', { 'pair': name, 'namespace': namespace }, counts['bytes'])
+
+metrics.add_gauges(metric_gauges)
+metrics.add_stats('server_py', server_py_request_stats)
+metrics.add_stats('prefix', prefix_completion_stats)
+metrics.add_stats('biconcor', lambda: dict(concordance_stats))
+metrics.add_stats('language_pairs', lambda: dict((name, pair.stats()) for name,pair in language_pairs.iteritems()))
+metrics.add_stats('disk_store', lambda: disk_store.stats() if disk_store is not None else None)
+metrics.add_stats('cluster', lambda: cluster.stats() if cluster is not None else None)
+metrics.add_stats('logging', lambda: dict(tracer.stats(), dropped=sum(
+  handler.dropped for handler in logging.root.handlers + trace_logger.handlers if isinstance(handler, AsyncHandler))))
+
+class MetricsHandler(web.RequestHandler):
+    """ Serves `metrics' in the Prometheus text format, or as JSON with ?format=json """
+
+    def get(self):
+      if self.get_argument('format', None) == 'json':
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(metrics.to_json(), default=repr))
+      else:
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.to_prometheus())
 
 ### cmd-line parsing and server init ###
 
@@ -844,22 +1530,130 @@ if __name__ == "__main__":
     parser.add_argument('--port', help='server port to bind to, default: 9999', type=int, default=9999)
     parser.add_argument('--mt-host', help='host of the mt server (server.py), default '+mt_host, default=mt_host)
     parser.add_argument('--mt-port', help='port of the mt server (server.py), default '+str(mt_port), type=int, default=mt_port)
+    parser.add_argument('--mt-backend', help='HOST:PORT of another mt server to spread the requests over, besides --mt-host and --mt-port (can be repeated)', action='append', default=[])
+    parser.add_argument('--mt-backend-no-update', help='HOST:PORT of another mt server that does not learn online, and so gets no updates (can be repeated)', action='append', default=[])
+    parser.add_argument('--mt-model-id', help='names the models behind the mt servers in the keys of the disk cache: change it (or delete the --disk-cache directory) when the models are replaced, so that no stored translation of the old ones is served', default=None)
+    parser.add_argument('--mt-max-connections', help='maximum number of simultaneous connections to each server.py, default '+str(mt_max_connections), type=int, default=mt_max_connections)
+    parser.add_argument('--mt-timeout', help='request timeout for a server.py action, as ACTION=SECONDS (can be repeated)', action='append', default=[])
+    parser.add_argument('--mt-class-limit', help='maximum number of simultaneous connections to each server.py for a priority class ('+', '.join(PRIORITIES)+'), as CLASS=CONNECTIONS (can be repeated)', action='append', default=[])
+    parser.add_argument('--mt-no-batch', help="don't send requests to server.py in batches (batches are only used if server.py supports them)", action='store_true')
     parser.add_argument('--biconcor-model', help='model file for bilingual concordancer')
     parser.add_argument('--biconcor-cmd', help='command binary for bilingual concordancer')
+    parser.add_argument('--biconcor-workers', help='number of concordancer binaries per model (queries go to the least busy one), default '+str(BICONCOR_WORKERS), type=int, default=BICONCOR_WORKERS)
+    parser.add_argument('--biconcor-timeout', help='seconds allowed for the concordancer to answer a query, from when it starts on it, default '+str(BICONCOR_TIMEOUT), type=float, default=BICONCOR_TIMEOUT)
+    parser.add_argument('--biconcor-load-timeout', help='seconds allowed for the concordancer to load its model, default '+str(BICONCOR_LOAD_TIMEOUT), type=float, default=BICONCOR_LOAD_TIMEOUT)
     parser.add_argument('--log-dir', help='directory for log files', default=".")
+    parser.add_argument('--log-level', help='level of the log file and of the event tracing on stdout (events are traced at info level, emitted results at debug level), default info', choices=LOG_LEVELS, default='info')
+    parser.add_argument('--trace-sample', help='share of the calls to a socket.io event (and of its results) to trace, as EVENT=RATE with RATE between 0 and 1 (can be repeated)', action='append', default=[])
+    parser.add_argument('--trace-max-length', help='maximum number of characters of the arguments of a traced event or result, default '+str(MAX_TRACE_LENGTH), type=int, default=MAX_TRACE_LENGTH)
+    parser.add_argument('--record-sessions', help='file where all the socket.io events received are recorded, for replaying them with cat-bench.py (with several workers, each records to FILE.workerN)')
+    parser.add_argument('--predict-cmd', help='prediction binary, default '+PREDICT_CMD, default=PREDICT_CMD)
+    parser.add_argument('--predict-daemons', help='number of long-lived prediction processes that hold the search graphs of all segments (0 to start one process per segment; requires a predict built from this version of predict.cpp), default '+str(DAEMONS), type=int, default=DAEMONS)
+    parser.add_argument('--predict-max-processes', help='maximum number of live prediction processes (or of search graphs loaded into the daemons), default '+str(MAX_PROCESSES), type=int, default=MAX_PROCESSES)
+    parser.add_argument('--predict-max-memory', help='maximum combined memory of the prediction processes, in MB (0 for no limit), default '+str(MAX_MEMORY/1024/1024), type=int, default=MAX_MEMORY/1024/1024)
+    parser.add_argument('--predict-graph-format', help='format of the search graphs sent to the prediction binary (binary requires a predict built from this version of predict.cpp), default '+predict_graph_format, choices=GRAPH_FORMATS, default=predict_graph_format)
+    parser.add_argument('--predict-timeout', help='seconds allowed for the prediction binary to answer a prefix, default '+str(QUERY_TIMEOUT), type=float, default=QUERY_TIMEOUT)
+    parser.add_argument('--predict-idle-timeout', help='seconds after which an unused prediction process is killed, default '+str(IDLE_TIMEOUT), type=float, default=IDLE_TIMEOUT)
+    parser.add_argument('--in-process-text-processing', help='tokenize and postprocess typed prefixes in-process rather than by server.py (needs --truecase-model; check the results against the Moses scripts with mosestext.py first)', action='store_true')
+    parser.add_argument('--truecase-model', help='truecasing model of the target language, for in-process text processing')
+    parser.add_argument('--source-lang', help='source language code of the default language pair (sent to server.py with translate and update requests), default xx', default='xx')
+    parser.add_argument('--target-lang', help='target language code of the default language pair (sent to server.py with translate and update requests), default xx', default='xx')
+    parser.add_argument('--language-pairs', help='JSON file with the settings of more language pairs, by name (e.g. "en-de"): server.py instances, predict settings, cache sizes, concordancer model, ... (see LanguagePair in cat-server.py)')
+    parser.add_argument('--source-nonbreaking-prefixes', help='Moses nonbreaking_prefix file of the source language, for in-process tokenization')
+    parser.add_argument('--target-nonbreaking-prefixes', help='Moses nonbreaking_prefix file of the target language, for in-process tokenization')
+    parser.add_argument('--cache-size', help='memory budget of a cache namespace (a server.py action, searchgraph, prefix, options, alignments or biconcor), as NAMESPACE=MEGABYTES (can be repeated)', action='append', default=[])
+    parser.add_argument('--workers', help='number of worker processes (each takes over the socket.io sessions it accepts; only the websocket and flashsocket transports are available with more than one), default 1', type=int, default=1)
+    parser.add_argument('--worker-port', help='with several workers, worker i listens for requests from the others on 127.0.0.1, port WORKER_PORT+i, default PORT+1', type=int)
+    parser.add_argument('--shared-cache', help='with several workers, SQLite database where they share translations and search graphs, default /dev/shm/cat-server.PORT.sqlite')
+    parser.add_argument('--shared-cache-size', help='size limit of the shared cache, in MB, default '+str(SHARED_STORE_MAX_BYTES/1024/1024), type=int, default=SHARED_STORE_MAX_BYTES/1024/1024)
+    parser.add_argument('--disk-cache', help='directory where translations, search graphs and concordances are kept across restarts, default none. Stored translations are only served for the same --mt-model-id and mt servers: change the id, or delete the directory, when the models change', default=None)
+    parser.add_argument('--disk-cache-size', help='size limit of the disk cache, in MB, default '+str(DISK_STORE_MAX_BYTES/1024/1024), type=int, default=DISK_STORE_MAX_BYTES/1024/1024)
+    parser.add_argument('--disk-cache-max-age', help='days after which translations are dropped from the disk cache, default '+str(DISK_STORE_MAX_AGE/24/3600), type=float, default=DISK_STORE_MAX_AGE/24/3600)
+    parser.add_argument('--cache-ttl', help='time to live of the entries of a cache namespace, as NAMESPACE=SECONDS (can be repeated)', action='append', default=[])
     settings = parser.parse_args(sys.argv[1:])
+    if settings.workers > 1:
+      # fork before anything starts an IOLoop, a thread or a child process
+      shared_cache = settings.shared_cache or '%s/cat-server.%d.sqlite' % ('/dev/shm' if os.path.isdir('/dev/shm') else settings.log_dir, settings.port)
+      cluster = Cluster(settings.workers, settings.worker_port or settings.port+1, SharedStore(shared_cache, settings.shared_cache_size * 1024 * 1024))
+      sockets = netutil.bind_sockets(settings.port)
+      cluster.fork()
     mt_host = settings.mt_host
     mt_port = settings.mt_port
+    mt_backends = [parse_backend(spec) for spec in settings.mt_backend] + [parse_backend(spec, updates=False) for spec in settings.mt_backend_no_update]
+    mt_max_connections = settings.mt_max_connections
+    mt_timeouts = parse_timeout_settings(settings.mt_timeout)
+    mt_batch = not settings.mt_no_batch
+    mt_class_limits = parse_class_limits(settings.mt_class_limit)
+    mt_model_id = settings.mt_model_id
     log_dir = settings.log_dir
+    predict_graph_format = settings.predict_graph_format
     biconcor_model = settings.biconcor_model
     biconcor_cmd = settings.biconcor_cmd
+    biconcor_workers = settings.biconcor_workers
+    biconcor_timeout = settings.biconcor_timeout
+    biconcor_load_timeout = settings.biconcor_load_timeout
+    predict_settings = dict(
+      cmd = settings.predict_cmd,
+      log_dir = log_dir,
+      max_processes = settings.predict_max_processes,
+      max_memory = settings.predict_max_memory * 1024 * 1024,
+      idle_timeout = settings.predict_idle_timeout,
+      query_timeout = settings.predict_timeout,
+      daemons = settings.predict_daemons,
+    )
+    in_process_text_processing = settings.in_process_text_processing
+    truecase_model = settings.truecase_model
+    if in_process_text_processing and not truecase_model:
+      parser.error('--in-process-text-processing needs --truecase-model')
+    nonbreaking_prefix_files = (settings.source_nonbreaking_prefixes, settings.target_nonbreaking_prefixes)
+    default_language_pair = '%s-%s' % (settings.source_lang, settings.target_lang)
+    if settings.language_pairs:
+      language_pair_settings = load_language_pair_settings(settings.language_pairs)
+    if settings.disk_cache:
+      # opened on first use, see diskstore.py
+      disk_store = DiskStore(settings.disk_cache, settings.disk_cache_size * 1024 * 1024, settings.disk_cache_max_age * 24 * 3600)
+    cache_settings = parse_cache_settings(settings.cache_size, settings.cache_ttl)
+    # create the pairs up front, so that their caches and processes are in place (and their settings checked) before any request
+    for name in [default_language_pair] + sorted(language_pair_settings):
+      language_pair(name)
 
     log_file = '%s.catserver.log' %datetime.datetime.now().strftime("%Y%m%d-%H.%M.%S")
+    if cluster is not None:
+      log_file = '%s.catserver.worker%d.log' % (datetime.datetime.now().strftime("%Y%m%d-%H.%M.%S"), cluster.index)
     log_format = '%(asctime)s %(thread)d - %(filename)s:%(lineno)s: %(message)s'
-    logging.basicConfig(filename=log_dir+"/"+log_file,level=logging.DEBUG,format=log_format)
-
+    log_level = getattr(logging, settings.log_level.upper())
+    log_handler = AsyncHandler(logging.FileHandler(log_dir+"/"+log_file))
+    log_handler.setFormatter(logging.Formatter(log_format))
+    logging.root.addHandler(log_handler)
+    logging.root.setLevel(log_level)
+    trace_logger.setLevel(log_level)
+    tracer.sampling = parse_sampling_settings(settings.trace_sample)
+    tracer.max_length = settings.trace_max_length
+    if settings.record_sessions:
+      record_logger = logging.getLogger('catserver.sessions')
+      record_logger.propagate = False
+      record_logger.setLevel(logging.INFO)
+      record_file = settings.record_sessions
+      if cluster is not None:
+        record_file = '%s.worker%d' % (record_file, cluster.index)
+      record_handler = AsyncHandler(logging.FileHandler(record_file))
+      record_handler.setFormatter(logging.Formatter('%(message)s'))
+      record_logger.addHandler(record_handler)
+      recorder = SessionRecorder(record_logger)
+
+    if cluster is not None:
+      MinimalRouter = AffinityRouter(RouterConnection, cluster)
+    else:
+      MinimalRouter = TornadioRouter(RouterConnection)
     application = web.Application(
-        MinimalRouter.apply_routes([]),
+        MinimalRouter.apply_routes([(r'/metrics', MetricsHandler)]),
         socket_io_port = settings.port
     )
-    SocketServer(application)
+    if cluster is not None:
+      # the workers share the listening socket bound before forking, and each has a private port for the others
+      web.Application([(r'/internal/complete', ForwardedCompletionHandler)]).listen(cluster.internal_port + cluster.index, '127.0.0.1')
+      server = httpserver.HTTPServer(application)
+      server.add_sockets(sockets)
+      ioloop.IOLoop.instance().start()
+    else:
+      SocketServer(application)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+"""
+Memory-bounded caches for cat-server.py.
+
+Caches are bounded by the approximate number of bytes their values occupy rather than by the number of entries, since a search
+graph for a long sentence is thousands of times bigger than a detokenized string. Entries can also be given a time to live.
+
+When several cat-server.py processes run side by side (see workers.py), some namespaces are backed by a SharedStore, so that what
+one process puts in its cache is found by the others.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import collections
+import cPickle
+import os
+import sqlite3
+import sys
+import time
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+MB = 1024 * 1024
+
+# Default byte budget and time to live (in seconds, None for no expiry) of each cache namespace: one per server.py action, plus
+# the search graphs serialized for the predict binary, the completions of typed prefixes, the processed translation options and
+# alignments of the translations, and the concordances
+DEFAULT_NAMESPACE_SETTINGS = {
+    'searchgraph': { 'max_bytes': 128 * MB, 'ttl': None },
+    'translate':  { 'max_bytes': 256 * MB, 'ttl': None },
+    'tokenize':   { 'max_bytes':  16 * MB, 'ttl': None },
+    'detokenize': { 'max_bytes':   8 * MB, 'ttl': None },
+    'detruecase': { 'max_bytes':   8 * MB, 'ttl': None },
+    'align':      { 'max_bytes':  32 * MB, 'ttl': None },
+    'prefix':     { 'max_bytes':  32 * MB, 'ttl': None },
+    'options':    { 'max_bytes':  32 * MB, 'ttl': None },
+    'alignments': { 'max_bytes':  16 * MB, 'ttl': None },
+    'biconcor':   { 'max_bytes':  32 * MB, 'ttl': None },
+    }
+
+# Used for the namespaces that are not listed above
+FALLBACK_NAMESPACE_SETTINGS = { 'max_bytes': 16 * MB, 'ttl': None }
+
+# Namespaces that are backed by the SharedStore when there is one: the results that are expensive to recompute and that every
+# process needs for the same documents
+SHARED_NAMESPACES = ('translate', 'searchgraph')
+
+# Default size limit of a SharedStore
+SHARED_STORE_MAX_BYTES = 1024 * MB
+
+# Number of writes (or claims) to a SharedStore between two checks of its size (or of the age of its claims)
+TRIM_INTERVAL = 100
+
+# Seconds after which a claim is dropped from a SharedStore, and the key can be claimed again. A segment that's still being
+# worked on by then goes to whichever process asks for it next
+CLAIM_MAX_AGE = 6 * 3600
+
+# Seconds a process waits for another one to finish writing to the SharedStore
+BUSY_TIMEOUT = 1.0
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+def approximate_size (obj):
+    """
+    Estimates the number of bytes taken up by a JSON-like structure (dicts, lists, tuples, strings and numbers). Shared objects
+    are counted every time they appear, so this errs on the high side.
+    """
+    size = sys.getsizeof (obj)
+    if isinstance (obj, dict):
+        for key,val in obj.iteritems():
+            size += approximate_size (key) + approximate_size (val)
+    elif isinstance (obj, (list,tuple)):
+        for val in obj:
+            size += approximate_size (val)
+    return size
+
+
+class ByteBudgetCache (collections.MutableMapping):
+    """
+    Container class that acts as a dictionary but only keeps the most recently used items whose combined approximate size fits
+    within `max_bytes'. Items older than `ttl' seconds are dropped. Only lookups (`get' and `[]') count as a use of an item;
+    membership tests and iteration leave the order untouched.
+    """
+
+    def __init__ (self, max_bytes, ttl=None, sizeof=approximate_size):
+        self.max_bytes = int (max_bytes)
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.impl = collections.OrderedDict () # key -> (value, size, expiry time or None)
+        self.bytes = 0
+        self.counters = collections.Counter ()
+        self.shared = None # (SharedStore, namespace), see `share'
+
+    def __len__ (self):
+        return len(self.impl)
+    def __iter__ (self):
+        return iter (self.impl)
+
+    def __delitem__ (self, key):
+        val,size,expiry = self.impl.pop (key)
+        self.bytes -= size
+
+    def __contains__ (self, key):
+        entry = self.impl.get (key)
+        return entry is not None and not self._expired (entry)
+
+    def __getitem__ (self, key):
+        entry = self.impl.get (key)
+        if entry is not None and self._expired (entry):
+            del self[key]
+            self.counters['expirations'] += 1
+            entry = None
+        if entry is None:
+            if self.shared is not None:
+                store,namespace = self.shared
+                data = store.get (namespace, key)
+                if data is not None:
+                    val = cPickle.loads (data)
+                    self._insert (key, val)
+                    self.counters['shared_hits'] += 1
+                    return val
+            self.counters['misses'] += 1
+            raise KeyError (key)
+        # re-insert the item so that it is now the MRU item
+        del self.impl[key]
+        self.impl[key] = entry
+        self.counters['hits'] += 1
+        return entry[0]
+
+    def __setitem__ (self, key, val):
+        self._insert (key, val)
+        if self.shared is not None:
+            store,namespace = self.shared
+            store.put (namespace, key, cPickle.dumps (val, cPickle.HIGHEST_PROTOCOL))
+
+    def _insert (self, key, val):
+        if key in self.impl:
+            del self[key]
+        size = self.sizeof (val)
+        if size > self.max_bytes:
+            # would evict everything else and still not fit
+            self.counters['rejections'] += 1
+            return
+        self._make_room (size)
+        expiry = self.ttl and time.time() + self.ttl
+        self.impl[key] = (val, size, expiry)
+        self.bytes += size
+
+    def _make_room (self, size):
+        while self.impl and self.bytes + size > self.max_bytes:
+            # delete the LRU item
+            lru_key,(lru_val,lru_size,lru_expiry) = self.impl.popitem (last=False)
+            self.bytes -= lru_size
+            self.counters['evictions'] += 1
+
+    def configure (self, max_bytes=None, ttl=None):
+        """ Changes the byte budget and/or time to live. Items that no longer fit are evicted; the new TTL applies to new items """
+        if max_bytes is not None:
+            self.max_bytes = int (max_bytes)
+            self._make_room (0)
+        if ttl is not None:
+            self.ttl = ttl
+
+    def share (self, store, namespace):
+        """
+        Backs the cache with a namespace of a SharedStore: items are written through to the store, and lookups that miss are
+        retried there. Values must be picklable. Membership tests only look at the items held locally.
+        """
+        self.shared = (store, namespace)
+
+    def _expired (self, entry):
+        expiry = entry[2]
+        return expiry is not None and expiry < time.time()
+
+    def purge_expired (self):
+        """ Drops all expired items. Expired items are otherwise only dropped when they are looked up or evicted """
+        for key in [k for k,entry in self.impl.iteritems() if self._expired(entry)]:
+            del self[key]
+            self.counters['expirations'] += 1
+
+    def stats (self):
+        stats = {
+            'entries': len (self.impl),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            }
+        for name in ('hits', 'shared_hits', 'misses', 'evictions', 'expirations', 'rejections'):
+            stats[name] = self.counters[name]
+        return stats
+
+
+class NamespacedCache (object):
+    """
+    A set of ByteBudgetCaches, one per namespace (e.g. per server.py action), each with its own byte budget and time to live.
+    Caches for namespaces without explicit settings are created on first use, with `fallback_settings'.
+    """
+
+    def __init__ (self, settings=DEFAULT_NAMESPACE_SETTINGS, fallback_settings=FALLBACK_NAMESPACE_SETTINGS):
+        self.settings = dict ((name, dict(s)) for name,s in settings.iteritems())
+        self.fallback_settings = dict (fallback_settings)
+        self.namespaces = {}
+        self.shared_store = None
+        self.shared_namespaces = ()
+        self.shared_prefix = ''
+
+    def configure (self, namespace, max_bytes=None, ttl=None):
+        """ Changes the settings of a namespace """
+        settings = self.settings.setdefault (namespace, dict(self.fallback_settings))
+        if max_bytes is not None:
+            settings['max_bytes'] = max_bytes
+        if ttl is not None:
+            settings['ttl'] = ttl
+        if namespace in self.namespaces:
+            self.namespaces[namespace].configure (max_bytes, ttl)
+
+    def __getitem__ (self, namespace):
+        cache = self.namespaces.get (namespace)
+        if cache is None:
+            settings = self.settings.get (namespace, self.fallback_settings)
+            cache = self.namespaces[namespace] = ByteBudgetCache (settings['max_bytes'], settings['ttl'])
+            if namespace in self.shared_namespaces:
+                cache.share (self.shared_store, self.shared_prefix + namespace)
+        return cache
+
+    def share (self, store, namespaces=SHARED_NAMESPACES, prefix=''):
+        """
+        Backs the given namespaces with a SharedStore, see `ByteBudgetCache.share'. Their names in the store start with `prefix',
+        so that several NamespacedCaches (e.g. one per language pair) can share a store
+        """
+        self.shared_store = store
+        self.shared_namespaces = tuple (namespaces)
+        self.shared_prefix = prefix
+        for namespace in self.shared_namespaces:
+            self[namespace].share (store, prefix + namespace)
+
+    def stats (self):
+        return dict ((name, cache.stats()) for name,cache in self.namespaces.iteritems())
+
+
+class SharedStore (object):
+    """
+    A store of byte strings, indexed by namespace and key, in an SQLite database that several processes open at once. Put in
+    /dev/shm, it lives in shared memory. When the values take up more than `max_bytes', the least recently written ones are
+    dropped. A store that can't be read or written (e.g. while another process holds a lock for too long) acts as if it were
+    empty, since it only ever holds things that can be recomputed.
+
+    It also records claims (see `claim'), which are dropped after `claim_max_age' seconds.
+
+    The database is opened on first use, and again after forking, so that each process has its own connection.
+    """
+
+    def __init__ (self, path, max_bytes=SHARED_STORE_MAX_BYTES, claim_max_age=CLAIM_MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.claim_max_age = claim_max_age
+        self.counters = collections.Counter()
+        self._db = None
+        self._pid = None
+
+    def _connect (self):
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect (self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            db.text_factory = str
+            db.execute ('PRAGMA journal_mode=WAL')
+            db.execute ('PRAGMA synchronous=OFF')
+            db.execute ('CREATE TABLE IF NOT EXISTS entries'
+                        ' (namespace TEXT, key TEXT, value BLOB, written REAL, PRIMARY KEY (namespace, key))')
+            db.execute ('CREATE INDEX IF NOT EXISTS entries_written ON entries (written)')
+            db.execute ('CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner INTEGER, claimed REAL)')
+            if 'claimed' not in [column[1] for column in db.execute ('PRAGMA table_info(claims)')]:
+                # a store left over by a version that kept claims forever
+                try:
+                    db.execute ('ALTER TABLE claims ADD COLUMN claimed REAL')
+                except sqlite3.OperationalError:
+                    pass # another process added it first
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def get (self, namespace, key):
+        """ Returns the value stored under `key' (any object with a stable repr) in `namespace', or None """
+        try:
+            row = self._connect().execute (
+                'SELECT value FROM entries WHERE namespace = ? AND key = ?', (namespace, repr(key))
+                ).fetchone()
+        except sqlite3.Error:
+            self.counters['errors'] += 1
+            return None
+        self.counters['hits' if row is not None else 'misses'] += 1
+        return str (row[0]) if row is not None else None
+
+    def put (self, namespace, key, value):
+        try:
+            self._connect().execute (
+                'INSERT OR REPLACE INTO entries (namespace, key, value, written) VALUES (?, ?, ?, ?)',
+                (namespace, repr(key), sqlite3.Binary(value), time.time())
+                )
+            self.counters['writes'] += 1
+            if self.counters['writes'] % TRIM_INTERVAL == 0:
+                self.trim()
+        except sqlite3.Error:
+            self.counters['errors'] += 1
+
+    def trim (self):
+        """ Drops the least recently written entries until the values fit within `max_bytes' """
+        db = self._connect()
+        count,size = db.execute ('SELECT COUNT(*), SUM(LENGTH(value)) FROM entries').fetchone()
+        if size > self.max_bytes:
+            # drop the share of the entries by which we're over, and a bit more, so that this isn't needed again right away
+            excess = int (count * (1 - 0.9 * self.max_bytes / float(size))) + 1
+            db.execute ('DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY written LIMIT ?)', (excess,))
+            self.counters['evictions'] += excess
+
+    def claim (self, key, owner):
+        """
+        Records `owner' (an int) as the owner of `key', unless it already has an owner whose claim hasn't expired. Returns the
+        owner, or None on error
+        """
+        now = time.time()
+        try:
+            db = self._connect()
+            db.execute ('DELETE FROM claims WHERE key = ? AND (claimed IS NULL OR claimed < ?)', (key, now - self.claim_max_age))
+            db.execute ('INSERT OR IGNORE INTO claims (key, owner, claimed) VALUES (?, ?, ?)', (key, owner, now))
+            row = db.execute ('SELECT owner FROM claims WHERE key = ?', (key,)).fetchone()
+            self.counters['claims'] += 1
+            if self.counters['claims'] % TRIM_INTERVAL == 0:
+                self.expire_claims()
+        except sqlite3.Error:
+            self.counters['errors'] += 1
+            return None
+        return row[0]
+
+    def owner (self, key):
+        """ Returns the owner of `key', or None if it hasn't been claimed, or its claim has expired """
+        try:
+            row = self._connect().execute (
+                'SELECT owner FROM claims WHERE key = ? AND claimed >= ?', (key, time.time() - self.claim_max_age)
+                ).fetchone()
+        except sqlite3.Error:
+            self.counters['errors'] += 1
+            return None
+        return row[0] if row is not None else None
+
+    def expire_claims (self):
+        """ Drops the claims that are older than `claim_max_age' """
+        cursor = self._connect().execute (
+            'DELETE FROM claims WHERE claimed IS NULL OR claimed < ?', (time.time() - self.claim_max_age,)
+            )
+        self.counters['expired_claims'] += max (cursor.rowcount, 0)
+
+    def clear_claims (self):
+        """ Forgets all claims, e.g. when starting over with new processes """
+        self._connect().execute ('DELETE FROM claims')
+
+    def stats (self):
+        return dict (self.counters, path=self.path, max_bytes=self.max_bytes)
+
+
+def parse_cache_settings (size_specs, ttl_specs):
+    """
+    Parses lists of 'namespace=megabytes' and 'namespace=seconds' strings, as given on the command line, into a dict of
+    namespace -> {'max_bytes':..., 'ttl':...}, with missing values set to None
+    """
+    settings = collections.defaultdict (lambda: { 'max_bytes': None, 'ttl': None })
+    for spec in size_specs or ():
+        namespace,megabytes = spec.split ('=', 1)
+        settings[namespace.strip()]['max_bytes'] = int (float (megabytes) * MB)
+    for spec in ttl_specs or ():
+        namespace,seconds = spec.split ('=', 1)
+        settings[namespace.strip()]['ttl'] = float (seconds)
+    return dict (settings)
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Logging for cat-server.py that stays off the event loop's back.
+
+Records are handed to a background thread that formats and writes them (`AsyncHandler'), so the event loop never waits for a
+write. The tracing of socket.io events and of the results emitted back (`EventTracer') is leveled, can be sampled per event,
+and only ever formats a bounded prefix of each payload, so tracing a decodeResult with hundreds of options costs no more than
+tracing a ping. The events received can also be recorded in full (`SessionRecorder'), to be replayed by cat-bench.py.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import Queue
+import collections
+import itertools
+import logging
+import os
+import random
+import repr as reprlib
+import threading
+import time
+import weakref
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# Maximum number of records waiting to be written. When the writer falls this far behind, new records are dropped (and counted)
+# rather than held in memory or waited for
+MAX_QUEUE = 10000
+
+# Maximum length, in characters, of the arguments of a traced event or emit
+MAX_TRACE_LENGTH = 500
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+# Events that open and close a connection. Their arguments (connection details) aren't recorded by `SessionRecorder'
+CONNECTION_EVENTS = ('on_open', 'on_close')
+
+# Suffix of the names of the events that carry the result of a socket.io event back to the client, e.g. `decodeResult'
+RESULT_SUFFIX = 'Result'
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class AsyncHandler (logging.Handler):
+    """
+    Passes records on to `target' (another handler) from a background thread. Formatting happens on that thread too, so the
+    arguments of a record must not be modified after it is logged. A process that forks gets a new thread on its first record,
+    since threads don't survive forking.
+    """
+
+    def __init__ (self, target, max_queue=MAX_QUEUE):
+        logging.Handler.__init__ (self)
+        self.target = target
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._start_writer()
+
+    def _start_writer (self):
+        self.queue = Queue.Queue (self.max_queue)
+        self.writer = threading.Thread (target=self._write, name='log writer')
+        self.writer.daemon = True
+        self.writer.start()
+        self.pid = os.getpid()
+
+    def setFormatter (self, fmt):
+        logging.Handler.setFormatter (self, fmt)
+        self.target.setFormatter (fmt)
+
+    def emit (self, record):
+        if self.pid != os.getpid():
+            self._start_writer()
+        try:
+            self.queue.put_nowait (record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write (self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.target.handle (record)
+
+    def close (self):
+        """ Writes out the records still waiting, then closes the target """
+        if self.writer.is_alive():
+            self.queue.put (None)
+            self.writer.join (5)
+        self.target.close()
+        logging.Handler.close (self)
+
+
+class TruncatingRepr (reprlib.Repr):
+    """
+    repr that abbreviates deep, long or numerous items, in the manner of the standard `repr' module, but that also knows about
+    unicode strings and about subclasses of dict, list and tuple (e.g. frozen structs), which it would otherwise repr in full
+    """
+
+    def __init__ (self):
+        reprlib.Repr.__init__ (self)
+        self.maxlevel = 4
+        self.maxdict = 8
+        self.maxlist = self.maxtuple = 8
+        self.maxstring = self.maxother = 80
+
+    def repr1 (self, x, level):
+        if isinstance (x, dict):
+            return self.repr_dict (x, level)
+        if isinstance (x, list):
+            return self.repr_list (x, level)
+        if isinstance (x, tuple):
+            return self.repr_tuple (x, level)
+        if isinstance (x, basestring):
+            return self.repr_str (x, level)
+        return reprlib.Repr.repr1 (self, x, level)
+
+
+class EventTracer (object):
+    """
+    Logs the socket.io events received (at INFO level) and the results emitted (at DEBUG level) to `logger', with their arguments
+    abbreviated to `max_length' characters. `sampling' gives, by event name, the share of the events to trace (1 by default); a
+    result is sampled at the rate of its event, e.g. `decodeResult' at the rate of `decode'.
+    """
+
+    def __init__ (self, logger, sampling=None, max_length=MAX_TRACE_LENGTH):
+        self.logger = logger
+        self.sampling = dict (sampling or {})
+        self.max_length = max_length
+        self.repr = TruncatingRepr()
+        self.counters = collections.Counter()
+
+    def event (self, name, args, kwargs):
+        if self._traced (logging.INFO, name):
+            self.logger.info ('%s(%s)', name, self._format_args (args, kwargs))
+
+    def emit (self, name, args, kwargs):
+        event_name = name[:-len(RESULT_SUFFIX)] if name.endswith (RESULT_SUFFIX) else name
+        if self._traced (logging.DEBUG, event_name):
+            self.logger.debug ('emit(%r, %s)', name, self._format_args (args, kwargs))
+
+    def _traced (self, level, name):
+        if not self.logger.isEnabledFor (level):
+            return False
+        rate = self.sampling.get (name, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.counters['sampled_out'] += 1
+            return False
+        self.counters['traced'] += 1
+        return True
+
+    def _format_args (self, args, kwargs):
+        formatted = ', '.join (
+            [self.repr.repr (a) for a in args] +
+            ['%s=%s' % (key, self.repr.repr (val)) for key,val in sorted (kwargs.iteritems())]
+            )
+        if len (formatted) > self.max_length:
+            formatted = formatted[:self.max_length] + '...'
+        return formatted
+
+    def stats (self):
+        return dict (self.counters)
+
+
+class SessionRecorder (object):
+    """
+    Logs every socket.io event received to `logger', with its full data argument, as a line of JSON:
+
+        {"session": 3, "time": 1400000000.25, "event": "setPrefix", "data": {"source": ..., "target": ..., "caretPos": 5}}
+
+    where `session' numbers the connections in the order of their first event. cat-bench.py replays these recordings.
+    """
+
+    def __init__ (self, logger):
+        self.logger = logger
+        self.sessions = weakref.WeakKeyDictionary()
+        self.session_numbers = itertools.count (1)
+
+    def record (self, connection, name, args, kwargs):
+        session = self.sessions.get (connection)
+        if session is None:
+            session = self.sessions[connection] = next (self.session_numbers)
+        data = None
+        if name not in CONNECTION_EVENTS:
+            # socket.io clients send the data as {data: ...}, which tornadio passes on as keyword arguments
+            data = args[0] if args else kwargs.get ('data')
+        self.logger.info ('%s', json.dumps ({
+            'session': session,
+            'time': time.time(),
+            'event': name,
+            'data': data,
+            }, default=repr))
+
+
+def parse_sampling_settings (specs):
+    """ Parses a list of 'event=rate' strings, as given on the command line, into a dict of event name -> rate """
+    sampling = {}
+    for spec in specs or ():
+        name,rate = spec.split ('=', 1)
+        rate = float (rate)
+        if not 0 <= rate <= 1:
+            raise ValueError ("sampling rate of %s must be between 0 and 1" % name)
+        sampling[name.strip()] = rate
+    return sampling
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Persistent store of translations for cat-server.py, so that a restart doesn't send every segment of the open documents back to
+server.py.
+
+The store is a directory of segment files, to which records (a key and a compressed, pickled value) are appended; the newest
+record for a key wins. Segment files are memory-mapped for reading. When the files take up more than `max_bytes', or when the
+newest record of a segment is older than `max_age', whole segments are deleted, oldest first, so eviction never rewrites
+anything.
+
+The store is opened lazily: the directory is only scanned, and the index of the records built, on the first lookup or write.
+Several processes (see workers.py) can use the same directory, since every record is appended with a single write; each process
+only sees the records that were there when it opened the store, plus its own.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import collections
+import cPickle
+import glob
+import mmap
+import os
+import struct
+import time
+import zlib
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+MB = 1024 * 1024
+
+DISK_STORE_MAX_BYTES = 2048 * MB
+DISK_STORE_MAX_AGE = 30 * 24 * 3600.0
+
+# Size beyond which a new segment file is started
+SEGMENT_BYTES = 64 * MB
+
+# zlib compression level of the values. Search graphs compress well even at low levels, and writes happen on the event loop
+COMPRESSION_LEVEL = 3
+
+# Record header: magic, key length, value length, time written
+RECORD_MAGIC = 'CSR1'
+RECORD_HEADER = struct.Struct ('=4sIId')
+
+SEGMENT_SUFFIX = '.seg'
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class DiskStore (object):
+    """ Picklable values on disk, indexed by string keys. See the module docstring """
+
+    def __init__ (self, directory, max_bytes=DISK_STORE_MAX_BYTES, max_age=DISK_STORE_MAX_AGE, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.index = None      # key -> (segment path, value offset, value length), built by `_open'
+        self.segments = None   # segment path -> time of its newest record, oldest segment first
+        self.maps = {}         # segment path -> mmap, opened on first read
+        self.writer = None     # (path, file descriptor) of the segment being appended to
+        self.counters = collections.Counter()
+
+    def _open (self):
+        if self.index is not None:
+            return
+        start_time = time.time()
+        if not os.path.isdir (self.directory):
+            os.makedirs (self.directory)
+        self.index = {}
+        self.segments = collections.OrderedDict()
+        for path in sorted (glob.glob (os.path.join (self.directory, '*' + SEGMENT_SUFFIX))):
+            self.segments[path] = self._scan (path)
+        self._evict()
+        self.counters['open_time'] = time.time() - start_time
+
+    def _scan (self, path):
+        """ Adds the records of a segment file to the index. Returns the time of its newest record """
+        newest = os.path.getmtime (path)
+        data = self._map (path)
+        if data is None:
+            return newest
+        offset = 0
+        while offset + RECORD_HEADER.size <= len (data):
+            magic,key_length,value_length,written = RECORD_HEADER.unpack_from (data, offset)
+            end = offset + RECORD_HEADER.size + key_length + value_length
+            if magic != RECORD_MAGIC or end > len (data):
+                # a write that was cut short, e.g. by a crash. Nothing after it can be trusted
+                self.counters['truncated_segments'] += 1
+                break
+            key = data[offset+RECORD_HEADER.size : offset+RECORD_HEADER.size+key_length]
+            self.index[key] = (path, end - value_length, value_length)
+            self.counters['records_scanned'] += 1
+            newest = written
+            offset = end
+        return newest
+
+    def _map (self, path, min_length=0):
+        """ Returns an up-to-date mmap of the segment file that's at least `min_length' bytes long, or None if it can't be read """
+        data = self.maps.get (path)
+        if data is None or len (data) < min_length:
+            try:
+                with open (path, 'rb') as segment:
+                    if os.fstat (segment.fileno()).st_size == 0:
+                        return None
+                    data = self.maps[path] = mmap.mmap (segment.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError):
+                self.maps.pop (path, None)
+                return None
+        return data
+
+    def get (self, key):
+        """ Returns the value stored under `key', or None """
+        self._open()
+        entry = self.index.get (key)
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        path,offset,length = entry
+        data = self._map (path, offset + length)
+        if data is None or len (data) < offset + length:
+            del self.index[key]
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        return cPickle.loads (zlib.decompress (data[offset:offset+length]))
+
+    def put (self, key, value):
+        self._open()
+        value = zlib.compress (cPickle.dumps (value, cPickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL)
+        now = time.time()
+        record = RECORD_HEADER.pack (RECORD_MAGIC, len(key), len(value), now) + key + value
+        path,fd = self._writer()
+        # O_APPEND and a single write keep records whole, even with other processes appending to the same file
+        offset = os.lseek (fd, 0, os.SEEK_END)
+        os.write (fd, record)
+        self.index[key] = (path, offset + RECORD_HEADER.size + len(key), len(value))
+        self.segments[path] = now
+        self.counters['writes'] += 1
+        self.counters['bytes_written'] += len (record)
+
+    def _writer (self):
+        if self.writer is not None and os.fstat (self.writer[1]).st_size >= self.segment_bytes:
+            os.close (self.writer[1])
+            self.writer = None
+            self._evict()
+        if self.writer is None:
+            path = os.path.join (self.directory, '%017.6f.%d%s' % (time.time(), os.getpid(), SEGMENT_SUFFIX))
+            fd = os.open (path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            self.writer = (path, fd)
+            self.segments[path] = time.time()
+        return self.writer
+
+    def _evict (self):
+        """ Deletes the oldest segments, until the rest fit within `max_bytes' and none is older than `max_age' """
+        sizes = dict ((path, self._size (path)) for path in self.segments)
+        total = sum (sizes.itervalues())
+        now = time.time()
+        for path,newest in list (self.segments.iteritems()):
+            if self.writer is not None and path == self.writer[0]:
+                continue
+            if total <= self.max_bytes and (self.max_age is None or now - newest <= self.max_age):
+                break
+            self._drop (path)
+            total -= sizes[path]
+            self.counters['evicted_segments'] += 1
+
+    def _size (self, path):
+        try:
+            return os.path.getsize (path)
+        except OSError:
+            return 0
+
+    def _drop (self, path):
+        del self.segments[path]
+        data = self.maps.pop (path, None)
+        if data is not None:
+            data.close()
+        for key in [key for key,entry in self.index.iteritems() if entry[0] == path]:
+            del self.index[key]
+        try:
+            os.unlink (path)
+        except OSError:
+            pass # another process got there first
+
+    def stats (self):
+        stats = dict (self.counters, directory=self.directory, max_bytes=self.max_bytes, max_age=self.max_age)
+        if self.index is not None:
+            stats.update (
+                records = len (self.index),
+                segments = len (self.segments),
+                bytes = sum (self._size (path) for path in self.segments),
+                )
+        return stats
+
+#----------------------------------------------------------------------------------------------------------------------------------
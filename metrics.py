@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Latency histograms and gauges for cat-server.py, served on its /metrics URL.
+
+Latencies are counted into fixed buckets, so recording one costs a binary search and an increment, and the memory used doesn't
+grow with traffic. Gauges (process counts, queue depths, cache hit rates) are only computed when the metrics are requested.
+
+The metrics can be read in the Prometheus text format (the default) or as JSON (/metrics?format=json), which also gives
+estimated percentiles and the full statistics of each component.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import bisect
+import collections
+import time
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# Upper bounds of the histogram buckets, in seconds. Anything slower goes into an overflow bucket
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Percentiles estimated in the JSON output
+PERCENTILES = (50, 95, 99)
+
+# Prefix of the metric names in the Prometheus output
+METRIC_PREFIX = 'catserver'
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class LatencyHistogram (object):
+    """ Counts of observed durations, by bucket (see `LATENCY_BUCKETS'), along with their number and sum """
+
+    def __init__ (self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe (self, seconds):
+        self.counts[bisect.bisect_left (self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile (self, p):
+        """
+        Returns the upper bound of the bucket that holds the p-th percentile, or None if nothing was observed or if it's in the
+        overflow bucket
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound,count in zip (self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot (self):
+        stats = {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            }
+        for p in PERCENTILES:
+            stats['p%d' % p] = self.percentile (p)
+        return stats
+
+
+class Metrics (object):
+    """
+    Latency histograms, grouped into families (e.g. 'event', one histogram per socket.io event) and indexed by name within their
+    family, plus the gauge and stats functions that describe the current state of the server.
+    """
+
+    def __init__ (self):
+        self.histograms = collections.defaultdict (dict)
+        self.gauge_functions = []
+        self.stats_functions = {}
+        self.start_time = time.time()
+
+    def observe (self, family, name, seconds):
+        """ Records a duration in the histogram of the given family and name """
+        histogram = self.histograms[family].get (name)
+        if histogram is None:
+            histogram = self.histograms[family][name] = LatencyHistogram()
+        histogram.observe (seconds)
+
+    def timer (self, family, name):
+        """ Returns a function that, when called, records the time elapsed since the call to `timer' """
+        start_time = time.time()
+        return lambda *args: self.observe (family, name, time.time() - start_time)
+
+    def add_gauges (self, func):
+        """
+        Registers a function that returns the current value of some gauges, as an iterable of (name, labels, value) triples, where
+        labels is a dict
+        """
+        self.gauge_functions.append (func)
+
+    def add_stats (self, name, func):
+        """ Registers a function that returns a JSON-serializable description of a component, for the JSON output """
+        self.stats_functions[name] = func
+
+    def gauges (self):
+        gauges = []
+        for func in self.gauge_functions:
+            gauges.extend (func())
+        return gauges
+
+    def to_json (self):
+        return {
+            'uptime': time.time() - self.start_time,
+            'latency': dict (
+                (family, dict ((name, histogram.snapshot()) for name,histogram in histograms.iteritems()))
+                for family,histograms in self.histograms.iteritems()
+                ),
+            'gauges': [dict (labels, name=name, value=value) for name,labels,value in self.gauges()],
+            'stats': dict ((name, func()) for name,func in self.stats_functions.iteritems()),
+            }
+
+    def to_prometheus (self):
+        lines = []
+        for family in sorted (self.histograms):
+            metric = '%s_%s_seconds' % (METRIC_PREFIX, family)
+            lines.append ('# TYPE %s histogram' % metric)
+            for name,histogram in sorted (self.histograms[family].iteritems()):
+                cumulative = 0
+                for bound,count in zip (histogram.bounds + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append ('%s_bucket{name="%s",le="%s"} %d' % (metric, name, bound, cumulative))
+                lines.append ('%s_sum{name="%s"} %r' % (metric, name, histogram.sum))
+                lines.append ('%s_count{name="%s"} %d' % (metric, name, histogram.count))
+        for name,labels,value in sorted (self.gauges(), key=lambda gauge: (gauge[0], sorted (gauge[1].items()))):
+            labels = ','.join ('%s="%s"' % item for item in sorted (labels.iteritems()))
+            lines.append ('%s_%s{%s} %r' % (METRIC_PREFIX, name, labels, float(value)))
+        return '\n'.join (lines) + '\n'
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+"""
+In-process versions of the Moses scripts that server.py runs over the text it's given: tokenizer.perl, truecase.perl,
+detokenizer.perl and detruecase.perl. They let cat-server.py process a typed prefix and its completion without a round trip to
+server.py for each step.
+
+Only the default settings of the scripts are implemented (no aggressive hyphen splitting, no headline casing, no factors). The
+tokenizer works one whitespace-separated chunk at a time and remembers the chunks it has seen, so that retokenizing a prefix after
+a keystroke only processes the chunk that was edited.
+
+Any difference with the scripts changes the prefixes sent to predict, so check a corpus of the language against them before
+turning in-process text processing on (see `compare_with_moses', or run this module with --help).
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import collections
+import os
+import re
+import subprocess
+import sys
+import unicodedata
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# Characters escaped by tokenizer.perl, in the order in which they're escaped
+ESCAPES = (
+    (u'&', u'&amp;'),
+    (u'|', u'&#124;'),
+    (u'<', u'&lt;'),
+    (u'>', u'&gt;'),
+    (u"'", u'&apos;'),
+    (u'"', u'&quot;'),
+    (u'[', u'&#91;'),
+    (u']', u'&#93;'),
+    )
+
+# Entities unescaped by detokenizer.perl, in the order in which they're unescaped (&amp; last)
+UNESCAPES = (
+    (u'&bar;', u'|'),
+    (u'&#124;', u'|'),
+    (u'&lt;', u'<'),
+    (u'&gt;', u'>'),
+    (u'&bra;', u'['),
+    (u'&ket;', u']'),
+    (u'&quot;', u'"'),
+    (u'&apos;', u"'"),
+    (u'&#91;', u'['),
+    (u'&#93;', u']'),
+    (u'&amp;', u'&'),
+    )
+
+# Words that don't end a sentence when followed by a period, by language. 1 means never, 2 means not when the next word is a
+# number. This is a subset of Moses' nonbreaking_prefix.* files; complete lists can be loaded with `load_nonbreaking_prefixes'
+NONBREAKING_PREFIXES = {
+    'en': dict (
+        [(unichr(c), 1) for c in range (ord('A'), ord('Z')+1)]
+        + [(p, 1) for p in u'Adj Adm Adv Asst Bart Bldg Brig Bros Capt Cmdr Col Comdr Con Corp Cpl DR Dr Drs Ens Gen Gov Hon Hr '
+                           u'Hosp Insp Lt MM MR MRS MS Maj Messrs Mlle Mme Mr Mrs Ms Msgr Op Ord Pfc Ph Prof Pvt Rep Reps Res '
+                           u'Rev Rt Sen Sens Sfc Sgt Sr St Supt Surg v vs i.e rev e.g Jan Feb Mar Apr Jun Jul Aug Sep Sept Oct '
+                           u'Nov Dec'.split()]
+        + [(p, 2) for p in u'No Nos Art Nr pp'.split()]
+        ),
+    }
+
+# Tokens after which truecase.perl and detruecase.perl consider that a new sentence starts, and tokens that don't change whether
+# the next word starts a sentence
+SENTENCE_END = frozenset ((u'.', u':', u'?', u'!'))
+DELAYED_SENTENCE_START = frozenset ((u'(', u'[', u'"', u"'", u'&apos;', u'&quot;', u'&#91;', u'&#93;'))
+
+ALPHA = re.compile (ur'[^\W\d_]', re.U)
+
+# Number of tokenized chunks remembered by each Tokenizer
+CHUNK_CACHE_SIZE = 20000
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# tokenization
+
+class Tokenizer (object):
+    """
+    Splits text into tokens like Moses' tokenizer.perl, and also reports where in the text each token comes from.
+
+    tokenizer.perl's rules only ever look at a chunk of non-whitespace characters, except for the final period rule which also
+    looks at the first character of the next chunk. So the tokens of each chunk are cached, keyed by the chunk and by what kind
+    of chunk follows it.
+    """
+
+    def __init__ (self, lang='en', nonbreaking_prefixes=None, escape=True):
+        self.lang = lang
+        if nonbreaking_prefixes is None:
+            nonbreaking_prefixes = NONBREAKING_PREFIXES.get (lang, {})
+        self.nonbreaking_prefixes = nonbreaking_prefixes
+        self.escape = escape
+        self.chunks = collections.OrderedDict () # (chunk, kind of next chunk) -> (tokens, spans within chunk)
+        self.counters = collections.Counter ()
+
+    def tokenize (self, text):
+        """
+        Returns the tokens of `text' (unicode), and the [start,end) character span of each token in `text'. Tokens that can't be
+        traced back to the text (there shouldn't be any) are given a 1-character span after the previous token, like
+        cat-server.py's `fix_span_mismatches' does.
+        """
+        chunks = [(m.group(), m.start()) for m in re.finditer (ur'\S+', text, re.U)]
+        tokens,spans = [],[]
+        for i,(chunk,offset) in enumerate (chunks):
+            next_kind = _chunk_kind (chunks[i+1][0] if i+1 < len(chunks) else None)
+            chunk_tokens,chunk_spans = self._tokenize_chunk (chunk, next_kind)
+            tokens.extend (chunk_tokens)
+            for span in chunk_spans:
+                if span is not None:
+                    span = [offset+span[0], offset+span[1]]
+                elif spans:
+                    span = [spans[-1][1], spans[-1][1]+1]
+                else:
+                    span = [0,0]
+                spans.append (span)
+        return tokens,spans
+
+    def _tokenize_chunk (self, chunk, next_kind):
+        key = (chunk, next_kind)
+        cached = self.chunks.pop (key, None)
+        if cached is not None:
+            self.counters['hits'] += 1
+        else:
+            self.counters['misses'] += 1
+            words = self._split_chunk (chunk, next_kind)
+            spans = _locate_tokens (words, chunk)
+            if self.escape:
+                words = map (escape, words)
+            cached = (tuple(words), tuple(spans))
+            while len (self.chunks) >= CHUNK_CACHE_SIZE:
+                self.chunks.popitem (last=False)
+        self.chunks[key] = cached
+        return cached
+
+    def _split_chunk (self, chunk, next_kind):
+        text = u' %s ' % chunk
+        # separate out all "other" special characters
+        text = u''.join (c if c.isalnum() or c in u" .'`,-" else u' %s ' % c for c in text)
+        # multi-dots stay together
+        text = re.sub (ur'\.([\.]+)', ur' DOTMULTI\1', text)
+        while re.search (ur'DOTMULTI\.', text):
+            text = re.sub (ur'DOTMULTI\.([^\.])', ur'DOTDOTMULTI \1', text)
+            text = re.sub (ur'DOTMULTI\.', u'DOTDOTMULTI', text)
+        # separate out "," except if within numbers (5,300)
+        text = re.sub (ur'(\D),', ur'\1 , ', text, flags=re.U)
+        text = re.sub (ur',(\D)', ur' , \1', text, flags=re.U)
+        # turn ` into ' and '' into "
+        text = text.replace (u'`', u"'")
+        text = text.replace (u"''", u' " ')
+        text = self._split_apostrophes (text)
+
+        words = text.split()
+        for i,word in enumerate (words):
+            if word.endswith (u'.') and len(word) > 1:
+                pre = word[:-1]
+                next_word_kind = _chunk_kind (words[i+1]) if i+1 < len(words) else next_kind
+                if (u'.' in pre and ALPHA.search (pre)) \
+                        or self.nonbreaking_prefixes.get (pre) == 1 \
+                        or next_word_kind == 'lower':
+                    pass # no change
+                elif self.nonbreaking_prefixes.get (pre) == 2 and next_word_kind == 'digit':
+                    pass # no change
+                else:
+                    words[i] = pre + u' .'
+
+        # restore multi-dots
+        text = u' '.join (words)
+        while u'DOTDOTMULTI' in text:
+            text = text.replace (u'DOTDOTMULTI', u'DOTMULTI.')
+        text = text.replace (u'DOTMULTI', u'.')
+        return text.split()
+
+    def _split_apostrophes (self, text):
+        if self.lang == 'en':
+            # split contractions right
+            text = re.sub (ur"([\W\d_])'([\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([\W_])'([^\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([^\W\d_])'([\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([^\W\d_])'([^\W\d_])", ur"\1 '\2", text, flags=re.U)
+            # special case for "1990's"
+            text = re.sub (ur"(\d)'(s)", ur"\1 '\2", text, flags=re.U)
+        elif self.lang in ('fr', 'it'):
+            # split contractions left
+            text = re.sub (ur"([\W\d_])'([\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([\W\d_])'([^\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([^\W\d_])'([\W\d_])", ur"\1 ' \2", text, flags=re.U)
+            text = re.sub (ur"([^\W\d_])'([^\W\d_])", ur"\1' \2", text, flags=re.U)
+        else:
+            text = text.replace (u"'", u" ' ")
+        return text
+
+    def stats (self):
+        return dict (self.counters, chunks=len(self.chunks))
+
+def _chunk_kind (chunk):
+    """ What the tokenizer's period rule needs to know about the word that follows a word ending in a period """
+    if not chunk:
+        return 'end'
+    elif chunk[0].islower():
+        return 'lower'
+    elif chunk[0].isdigit():
+        return 'digit'
+    else:
+        return 'other'
+
+def _locate_tokens (tokens, chunk):
+    """
+    Returns the [start,end) span of each (unescaped) token in the chunk it was split from, or None for the tokens that can't be
+    found. The tokenizer turns ` into ' and '' into ", so those are looked for too.
+    """
+    normalized = chunk.replace (u'`', u"'")
+    spans = []
+    pos = 0
+    for token in tokens:
+        if token == u'"' and normalized.startswith (u"''", pos):
+            start,end = pos, pos+2
+        else:
+            start = normalized.find (token, pos)
+            end = start + len(token)
+        if start < 0:
+            spans.append (None)
+        else:
+            spans.append ((start,end))
+            pos = end
+    return spans
+
+def escape (token):
+    for char,entity in ESCAPES:
+        token = token.replace (char, entity)
+    return token
+
+def unescape (text):
+    for entity,char in UNESCAPES:
+        text = text.replace (entity, char)
+    return text
+
+def load_nonbreaking_prefixes (path):
+    """ Reads a Moses nonbreaking_prefix.* file into a dict suitable for `Tokenizer' """
+    prefixes = {}
+    with open (path) as handle:
+        for line in handle:
+            line = line.decode('utf-8').strip()
+            if not line or line.startswith (u'#'):
+                continue
+            if u'#NUMERIC_ONLY#' in line:
+                prefixes[line.split()[0]] = 2
+            else:
+                prefixes[line.split()[0]] = 1
+    return prefixes
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# truecasing
+
+class Truecaser (object):
+    """ Applies a Moses truecasing model (as trained by train-truecaser.perl) to a list of tokens, like truecase.perl """
+
+    def __init__ (self, model_path):
+        self.best = {}     # lowercased word -> most frequent casing
+        self.known = set() # all casings seen in training
+        with open (model_path) as model:
+            for line in model:
+                # each line reads: word (count/total) alternative (count) alternative (count) ...
+                fields = line.decode('utf-8').split()
+                if not fields:
+                    continue
+                self.best[fields[0].lower()] = fields[0]
+                self.known.update (fields[0::2])
+
+    def truecase (self, tokens):
+        truecased = []
+        sentence_start = True
+        for token in tokens:
+            best = self.best.get (token.lower())
+            if sentence_start and best is not None:
+                truecased.append (best)
+            elif token in self.known or best is None:
+                truecased.append (token)
+            else:
+                truecased.append (best)
+            if token in SENTENCE_END:
+                sentence_start = True
+            elif token not in DELAYED_SENTENCE_START:
+                sentence_start = False
+        return truecased
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# postprocessing
+
+def detokenize (text, lang='en'):
+    """ Joins tokenized text (unicode) back into a plain string, like detokenizer.perl """
+    words = unescape (text).split()
+    quote_count = collections.Counter()
+    out = []
+    prepend_space = u' '
+    for i,word in enumerate (words):
+        if all (unicodedata.category(c) == 'Sc' or c in u'([{\xbf\xa1' for c in word):
+            # perform right shift on currency and other random punctuation items
+            out.append (prepend_space + word)
+            prepend_space = u''
+        elif all (c in u',.?!:;\\%}])' for c in word):
+            if lang == 'fr' and re.match (ur'^[\?\!\:\;\\\%]$', word):
+                out.append (u' ')
+            # perform left shift on punctuation items
+            out.append (word)
+            prepend_space = u' '
+        elif lang == 'en' and i > 0 and re.match (ur"^'[^\W\d_]", word, re.U) and re.search (ur'[^\W_]$', words[i-1], re.U):
+            # left-shift the contraction
+            out.append (word)
+            prepend_space = u' '
+        elif lang in ('fr', 'it') and i < len(words)-2 and re.search (ur"[^\W\d_]'$", word, re.U) \
+                and re.match (ur'^[^\W\d_]', words[i+1], re.U):
+            # right-shift the contraction
+            out.append (prepend_space + word)
+            prepend_space = u''
+        elif all (c in u'\'"\u201e\u201c`' for c in word):
+            # combine punctuation smartly
+            quote = u'"' if all (c in u'\u201e\u201c\u201d' for c in word) else word
+            if quote_count[quote] % 2 == 0:
+                if lang == 'en' and word == u"'" and i > 0 and words[i-1].endswith (u's'):
+                    # single quote for possessives ending in s... "The Jones' house"
+                    out.append (word)
+                    prepend_space = u' '
+                else:
+                    # right shift
+                    out.append (prepend_space + word)
+                    prepend_space = u''
+                    quote_count[quote] += 1
+            else:
+                # left shift
+                out.append (word)
+                prepend_space = u' '
+                quote_count[quote] += 1
+        else:
+            out.append (prepend_space + word)
+            prepend_space = u' '
+    return re.sub (ur' +', u' ', u''.join(out)).strip()
+
+def detruecase (text):
+    """ Uppercases the first letter of each sentence, like detruecase.perl """
+    words = text.split()
+    sentence_start = True
+    for i,word in enumerate (words):
+        if sentence_start:
+            words[i] = word[:1].upper() + word[1:]
+        if word in SENTENCE_END:
+            sentence_start = True
+        elif word not in DELAYED_SENTENCE_START:
+            sentence_start = False
+    return u' '.join (words)
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class TextProcessor (object):
+    """
+    Does locally what server.py's `tokenize', `detokenize' and `detruecase' actions do for one language pair. Takes and returns
+    unicode strings.
+    """
+
+    def __init__ (self, source_lang, target_lang, truecase_model, nonbreaking_prefixes=(None,None)):
+        self.source_tokenizer = Tokenizer (source_lang, nonbreaking_prefixes[0])
+        self.target_tokenizer = Tokenizer (target_lang, nonbreaking_prefixes[1])
+        self.target_lang = target_lang
+        self.truecaser = Truecaser (truecase_model)
+
+    def tokenize_target (self, target):
+        """ Returns the tokenized and truecased target, as given to the decoder and to predict """
+        tokens,spans = self.target_tokenizer.tokenize (target)
+        return u' '.join (self.truecaser.truecase (tokens))
+
+    def tokenization_spans (self, source, target):
+        """ Returns the token spans of the source and target, in the same format as cat-server.py's `fix_tokenization_spans' """
+        return self.source_tokenizer.tokenize (source)[1], self.target_tokenizer.tokenize (target)[1]
+
+    def postprocess (self, tokenized):
+        """ Detokenizes and detruecases a tokenized target """
+        return detruecase (detokenize (tokenized, self.target_lang))
+
+    def stats (self):
+        return {
+            'source_tokenizer': self.source_tokenizer.stats(),
+            'target_tokenizer': self.target_tokenizer.stats(),
+            }
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# comparison with the Moses scripts
+
+def run_moses_script (moses_scripts, script, args, lines):
+    """ Runs one of the Moses perl scripts (`script' is relative to the scripts directory) over a list of unicode lines """
+    proc = subprocess.Popen (['perl', os.path.join (moses_scripts, script)] + list (args),
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output,_ = proc.communicate (u''.join (line + u'\n' for line in lines).encode ('UTF-8'))
+    if proc.returncode != 0:
+        raise RuntimeError ("%s exited with status %d" % (script, proc.returncode))
+    return output.decode ('UTF-8').split ('\n')[:len (lines)]
+
+def compare_with_moses (lines, moses_scripts, lang='en', truecase_model=None, nonbreaking_prefixes=None):
+    """
+    Runs a corpus (a list of unicode lines) through both the Moses scripts and this module, one step at a time, each step taking
+    as input the output of the Moses script of the step before, so that a difference is only reported at the step that makes it.
+    Returns a list of (step name, differences), where the differences are (line number, expected, actual) tuples
+    """
+    tokenizer = Tokenizer (lang, nonbreaking_prefixes)
+    tokenized = run_moses_script (moses_scripts, 'tokenizer/tokenizer.perl', ['-q', '-l', lang], lines)
+    steps = [('tokenize', tokenized, [u' '.join (tokenizer.tokenize (line)[0]) for line in lines])]
+    truecased = tokenized
+    if truecase_model:
+        truecaser = Truecaser (truecase_model)
+        truecased = run_moses_script (moses_scripts, 'recaser/truecase.perl', ['--model', truecase_model], tokenized)
+        steps.append (('truecase', truecased, [u' '.join (truecaser.truecase (line.split())) for line in tokenized]))
+    steps.append ((
+        'detokenize',
+        run_moses_script (moses_scripts, 'tokenizer/detokenizer.perl', ['-q', '-l', lang], tokenized),
+        [detokenize (line, lang) for line in tokenized],
+        ))
+    steps.append ((
+        'detruecase',
+        run_moses_script (moses_scripts, 'recaser/detruecase.perl', [], truecased),
+        [detruecase (line) for line in truecased],
+        ))
+    return [
+        (name, [(i+1, expected, actual) for i,(expected,actual) in enumerate (zip (expected_lines, actual_lines))
+                if expected.strip() != actual.strip()])
+        for name,expected_lines,actual_lines in steps
+        ]
+
+def main ():
+    import argparse
+    parser = argparse.ArgumentParser (description='Checks this module against the Moses scripts on a corpus, one sentence per line')
+    parser.add_argument ('corpus')
+    parser.add_argument ('--moses-scripts', help='the scripts directory of a Moses checkout', required=True)
+    parser.add_argument ('--lang', help='language of the corpus, default en', default='en')
+    parser.add_argument ('--truecase-model', help='truecasing model to check truecase.perl against')
+    parser.add_argument ('--nonbreaking-prefixes', help='nonbreaking_prefix file, as given to cat-server.py')
+    parser.add_argument ('--examples', help='number of differences to show per step, default 5', type=int, default=5)
+    settings = parser.parse_args()
+    with open (settings.corpus) as corpus:
+        lines = [line.decode ('UTF-8').rstrip ('\r\n') for line in corpus]
+    nonbreaking_prefixes = settings.nonbreaking_prefixes and load_nonbreaking_prefixes (settings.nonbreaking_prefixes)
+    failed = False
+    for name,differences in compare_with_moses (lines, settings.moses_scripts, settings.lang, settings.truecase_model,
+                                                nonbreaking_prefixes):
+        print "%-10s %d of %d lines differ" % (name, len (differences), len (lines))
+        for line_number,expected,actual in differences[:settings.examples]:
+            print ("  line %d\n    moses: %s\n    ours:  %s" % (line_number, expected, actual)).encode ('UTF-8')
+        failed = failed or bool (differences)
+    sys.exit (1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+
+"""
+Non-blocking client for the Moses MT server (server.py).
+
+All requests go through a single tornado AsyncHTTPClient, so that a slow decode only delays the coroutine that is waiting for
+it, and never the IOLoop that serves every other connected translator.
+
+Requests for the quick text processing actions that are made during the same IOLoop iteration (e.g. the detokenization of all
+the sentences of a concordance) are sent together, as one POST to server.py's /batch URL. Its body is
+    {"requests": [{"action": ACTION, "q": ..., "t": ..., <other URL parameters>}, ...]}
+and server.py answers with
+    {"responses": [RESPONSE, ...]}
+where each RESPONSE is the JSON string that the corresponding GET request would have returned. If server.py doesn't know about
+/batch, requests are sent one by one. See server-py-stub.py for an implementation.
+
+Requests are sent in order of urgency, so that prefetching the translations of a whole document never makes a translator wait
+for the completion of what they're typing. See `PriorityScheduler'.
+
+Requests can be spread over several server.py instances (`Backend's). Each request goes to the backend with the fewest requests
+outstanding, except translations, which always go to the same backend for the same sentence, so that its decoder-side caches stay
+hot, and updates, which go to every backend that learns from them. A backend that fails EJECT_AFTER_FAILURES times in a row
+(connection errors and timeouts, not server.py tracebacks) is ejected until it passes a health check.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import collections
+import functools
+import hashlib
+import sys
+import time
+import urlparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tornado import gen, httpclient, ioloop
+from tornado.concurrent import Future, chain_future
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# Maximum number of simultaneous connections to server.py. Requests beyond this are queued inside the client.
+MAX_CONNECTIONS = 16
+
+# Seconds allowed for establishing the TCP connection to server.py
+CONNECT_TIMEOUT = 2.0
+
+# Seconds allowed for a complete request, by action. Decoding a long sentence is slow, the text processing actions are not.
+DEFAULT_TIMEOUTS = {
+    'translate': 60.0,
+    'update': 60.0,
+    'align': 10.0,
+    'confidence': 10.0,
+    'tokenize': 5.0,
+    'detokenize': 5.0,
+    'detruecase': 5.0,
+    }
+FALLBACK_TIMEOUT = 20.0
+
+# Actions that may be sent in batches. Translation and update are slow, and would hold up everything batched with them
+BATCH_ACTIONS = ('tokenize', 'detokenize', 'detruecase', 'align', 'confidence')
+
+# Priority classes of the requests to server.py, most urgent first: completing what the user is typing, translating the segment
+# they're on (and the other interactive requests), translating the segments they'll probably open next, and everything that can
+# happen in the background (concordancer, speculative completions)
+PRIORITIES = ('keystroke', 'decode', 'prefetch', 'background')
+DEFAULT_PRIORITY = 'decode'
+
+# Share of the connections to server.py that each class may use at once. The lower classes can't take up all connections, so
+# that there is always room for interactive requests
+DEFAULT_CLASS_SHARES = {
+    'keystroke': 1.0,
+    'decode': 1.0,
+    'prefetch': 0.5,
+    'background': 0.25,
+    }
+
+# Maximum number of requests sent in one batch
+MAX_BATCH_SIZE = 100
+
+# HTTP status codes with which a server.py that doesn't support batches answers a POST to /batch
+NO_BATCH_SUPPORT_CODES = (404, 405, 501)
+
+# Actions that always go to the same backend for the same sentence, to make the most of its caches
+STICKY_ACTIONS = ('translate',)
+
+# Actions sent to every backend that learns from them (see `Backend.updates')
+FAN_OUT_ACTIONS = ('update',)
+
+# Number of consecutive failures after which a backend is ejected, when there are several
+EJECT_AFTER_FAILURES = 3
+
+# Seconds between two health checks of each backend, when there are several, and seconds allowed for a health check
+HEALTH_CHECK_INTERVAL = 5.0
+HEALTH_CHECK_TIMEOUT = 2.0
+
+# Request that backends are health-checked with. Any answer from server.py, even a traceback, means it's up
+HEALTH_CHECK_PATH = '/detokenize?q=health+check'
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+def configure_http_client (max_connections=MAX_CONNECTIONS):
+    """
+    Selects the AsyncHTTPClient implementation. The curl-based client keeps connections to server.py alive between requests, so
+    we use it when pycurl is installed; otherwise we fall back to tornado's own client, which opens one connection per request.
+    """
+    try:
+        import pycurl
+        httpclient.AsyncHTTPClient.configure ('tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=max_connections)
+    except ImportError:
+        print >> sys.stderr, "pycurl not available, connections to server.py will not be kept alive"
+        httpclient.AsyncHTTPClient.configure (None, max_clients=max_connections)
+
+
+class Backend (object):
+    """ One server.py instance. `updates' is false for a server.py that doesn't learn online, and so doesn't need updates """
+
+    def __init__ (self, host, port, updates=True):
+        self.host = host
+        self.port = int (port)
+        self.updates = updates
+        self.outstanding = 0 # requests sent and not answered yet
+        self.failures = 0 # consecutive failures
+        self.ejected = False
+        self.probing = False
+        self.counters = collections.Counter ()
+
+    def base_url (self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def url_for (self, url):
+        """ Returns the same URL as `url', but on this backend """
+        url = urlparse.urlsplit (url)
+        return urlparse.urlunsplit (('http', '%s:%d' % (self.host, self.port), url.path, url.query, ''))
+
+    def stats (self):
+        return dict (
+            self.counters,
+            url = self.base_url(),
+            updates = self.updates,
+            outstanding = self.outstanding,
+            failures = self.failures,
+            ejected = self.ejected,
+            )
+
+
+class ServerPyClient (object):
+    """
+    Sends requests to server.py and hands back the raw response body. URLs are built by the caller, since they also serve as cache
+    keys, on `base_url', and each request is then routed to one of the `backends'. If `batch' is true, concurrent requests for
+    BATCH_ACTIONS are sent in batches. Requests are sent in order of priority, see `PriorityScheduler'. `max_connections' and
+    `class_limits' are per backend.
+    """
+
+    def __init__ (self, backends, max_connections=MAX_CONNECTIONS, timeouts=None, batch=True, class_limits=None):
+        self.backends = list (backends)
+        self.timeouts = dict (DEFAULT_TIMEOUTS)
+        self.timeouts.update (timeouts or {})
+        self.batch = batch
+        self.queue = [] # QueuedRequests to send in the next batch
+        self.jobs = {} # URL -> scheduler Job that will send the request, until it's answered
+        self.counters = collections.Counter ()
+        self.health_check = None
+        total_connections = max_connections * len (self.backends)
+        self.scheduler = PriorityScheduler (total_connections, dict (
+            (name, limit * len (self.backends)) for name,limit in (class_limits or {}).iteritems()
+            ))
+        configure_http_client (total_connections)
+        # force_instance so that the max_clients setting above applies even if someone already created a shared client
+        self.http = httpclient.AsyncHTTPClient (force_instance=True, max_clients=total_connections)
+
+    def base_url (self):
+        """ Base of the URLs of the requests, which are the same whichever backend they go to """
+        return self.backends[0].base_url()
+
+    def timeout_for (self, action):
+        return self.timeouts.get (action, FALLBACK_TIMEOUT)
+
+    def fetch (self, url, action, priority=DEFAULT_PRIORITY, owner=None):
+        """
+        Fetches `url', with the timeout configured for `action'. Returns a Future for the response body, even for HTTP errors,
+        since server.py reports its tracebacks as JSON. Connection errors and timeouts are raised as `tornado.httpclient.HTTPError'.
+
+        The request waits in the scheduler until a connection is free for its `priority' class (one of PRIORITIES); `owner' (the
+        client connection it's made for) is used for sharing connections fairly between users.
+        """
+        request = QueuedRequest (url, action, priority, owner)
+        self._start_health_checks()
+        if self.batch and action in BATCH_ACTIONS:
+            if not self.queue:
+                ioloop.IOLoop.current().add_callback (self._flush)
+            self.queue.append (request)
+        else:
+            self._schedule ([request], lambda: self._fetch_one (url, action))
+        return request.future
+
+    def promote (self, url, priority):
+        """ Raises the priority of the request for `url' if it hasn't been sent yet, e.g. because a more urgent caller now needs it """
+        for request in self.queue:
+            if request.url == url and PRIORITIES.index (priority) < PRIORITIES.index (request.priority):
+                request.priority = priority
+        job = self.jobs.get (url)
+        if job is not None:
+            self.scheduler.promote (job, priority)
+
+    def _schedule (self, requests, start):
+        job = self.scheduler.submit (start, requests[0].priority, requests[0].owner)
+        for request in requests:
+            self.jobs[request.url] = job
+        job.future.add_done_callback (lambda future: self._forget_job (job, requests))
+        if len (requests) == 1:
+            chain_future (job.future, requests[0].future)
+
+    def _forget_job (self, job, requests):
+        for request in requests:
+            if self.jobs.get (request.url) is job:
+                del self.jobs[request.url]
+
+    @gen.coroutine
+    def _fetch_one (self, url, action):
+        self.counters['single'] += 1
+        make_request = lambda backend: httpclient.HTTPRequest (
+            backend.url_for (url),
+            connect_timeout = CONNECT_TIMEOUT,
+            request_timeout = self.timeout_for (action),
+            headers = { 'Connection': 'keep-alive' },
+            )
+        if action in FAN_OUT_ACTIONS and len (self.backends) > 1:
+            response = yield self._fan_out (make_request)
+        else:
+            response = yield self._fetch_balanced (make_request, self._sticky_key (action, url))
+        raise gen.Return (response.body)
+
+    @gen.coroutine
+    def _fetch_balanced (self, make_request, sticky_key=None):
+        """ Sends a request to the backend picked by `_pick_backend', or to another one if it can't be reached """
+        backend = self._pick_backend (sticky_key)
+        try:
+            response = yield self._fetch_from (backend, make_request)
+        except Exception:
+            other = self._pick_backend (sticky_key, exclude=backend)
+            if other is None:
+                raise
+            self.counters['retried'] += 1
+            response = yield self._fetch_from (other, make_request)
+        raise gen.Return (response)
+
+    @gen.coroutine
+    def _fan_out (self, make_request):
+        """ Sends a request to every backend that learns from updates, and returns the first response """
+        targets = [backend for backend in self.backends if backend.updates and not backend.ejected]
+        self.counters['fan_out_skipped'] += sum (1 for backend in self.backends if backend.updates and backend.ejected)
+        if not targets:
+            targets = [self._pick_backend()]
+        self.counters['fanned_out'] += len (targets)
+        futures = [self._fetch_from (backend, make_request) for backend in targets]
+        responses = []
+        errors = []
+        for future in futures:
+            try:
+                responses.append ((yield future))
+            except Exception:
+                errors.append (sys.exc_info())
+        if not responses:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        raise gen.Return (responses[0])
+
+    @gen.coroutine
+    def _fetch_from (self, backend, make_request):
+        """
+        Sends the request made by `make_request' for `backend', and returns the response, even for HTTP errors. Connection errors
+        and timeouts are raised, and count against the backend's health.
+        """
+        backend.outstanding += 1
+        backend.counters['requests'] += 1
+        try:
+            try:
+                response = yield self.http.fetch (make_request (backend))
+            except httpclient.HTTPError, err:
+                if err.response is None or err.response.body is None:
+                    raise
+                response = err.response
+        except Exception:
+            self._failed (backend)
+            raise
+        else:
+            self._succeeded (backend)
+        finally:
+            backend.outstanding -= 1
+        raise gen.Return (response)
+
+    def _sticky_key (self, action, url):
+        if action in STICKY_ACTIONS and len (self.backends) > 1:
+            return dict (urlparse.parse_qsl (urlparse.urlsplit (url).query)).get ('q')
+        return None
+
+    def _pick_backend (self, sticky_key=None, exclude=None):
+        """
+        Returns the healthy backend with the fewest outstanding requests or, for a sticky request, the healthy backend that ranks
+        first for its key (rendezvous hashing, so that the keys of an ejected backend are spread over the others, and come back
+        when it does). Returns None if there's no backend left besides `exclude'.
+        """
+        candidates = [backend for backend in self.backends if backend is not exclude and not backend.ejected]
+        if not candidates:
+            if exclude is not None:
+                return None
+            # every backend is down: keep trying them rather than failing every request
+            candidates = self.backends
+        if sticky_key is not None:
+            return max (candidates, key=lambda backend: hashlib.md5 ('%s %s' % (backend.base_url(), sticky_key)).digest())
+        return min (candidates, key=lambda backend: (backend.outstanding, backend.counters['requests']))
+
+    def _failed (self, backend):
+        backend.failures += 1
+        backend.counters['failures'] += 1
+        if backend.failures >= EJECT_AFTER_FAILURES and not backend.ejected and len (self.backends) > 1:
+            print >> sys.stderr, "server.py at %s ejected after %d failures" % (backend.base_url(), backend.failures)
+            backend.ejected = True
+            backend.counters['ejected'] += 1
+
+    def _succeeded (self, backend):
+        backend.failures = 0
+        if backend.ejected:
+            print >> sys.stderr, "server.py at %s is back" % backend.base_url()
+            backend.ejected = False
+
+    def _start_health_checks (self):
+        if self.health_check is None and len (self.backends) > 1:
+            self.health_check = ioloop.PeriodicCallback (self._check_health, HEALTH_CHECK_INTERVAL * 1000)
+            self.health_check.start()
+
+    def _check_health (self):
+        for backend in self.backends:
+            if not backend.probing:
+                self._probe (backend)
+
+    @gen.coroutine
+    def _probe (self, backend):
+        backend.probing = True
+        backend.counters['health_checks'] += 1
+        try:
+            yield self.http.fetch (httpclient.HTTPRequest (
+                backend.base_url() + HEALTH_CHECK_PATH,
+                connect_timeout = CONNECT_TIMEOUT,
+                request_timeout = HEALTH_CHECK_TIMEOUT,
+                ))
+        except httpclient.HTTPError, err:
+            if err.response is None or err.response.body is None:
+                self._failed (backend)
+            else:
+                self._succeeded (backend)
+        except Exception:
+            self._failed (backend)
+        else:
+            self._succeeded (backend)
+        finally:
+            backend.probing = False
+
+    def _flush (self):
+        """ Sends the queued requests in batches, one batch per priority class and owner """
+        queue,self.queue = self.queue,[]
+        groups = collections.OrderedDict ()
+        for request in queue:
+            groups.setdefault ((request.priority, request.owner), []).append (request)
+        for group in groups.itervalues():
+            for i in xrange (0, len(group), MAX_BATCH_SIZE):
+                batch = group[i:i+MAX_BATCH_SIZE]
+                if len (batch) == 1:
+                    self._schedule (batch, functools.partial (self._fetch_one, batch[0].url, batch[0].action))
+                else:
+                    self._schedule (batch, functools.partial (self._send_batch, batch))
+
+    @gen.coroutine
+    def _send_batch (self, batch):
+        if not self.batch:
+            yield self._send_one_by_one (batch)
+            return
+        self.counters['batches'] += 1
+        self.counters['batched'] += len (batch)
+        body = json.dumps ({ 'requests': [batch_item(r.url) for r in batch] })
+        make_request = lambda backend: httpclient.HTTPRequest (
+            '%s/batch' % backend.base_url(),
+            method = 'POST',
+            body = body,
+            connect_timeout = CONNECT_TIMEOUT,
+            request_timeout = max (self.timeout_for(r.action) for r in batch),
+            headers = { 'Connection': 'keep-alive', 'Content-Type': 'application/json' },
+            )
+        try:
+            response = yield self._fetch_balanced (make_request)
+            if response.code in NO_BATCH_SUPPORT_CODES:
+                print >> sys.stderr, "server.py doesn't support batches, sending requests one by one"
+                self.batch = False
+                yield self._send_one_by_one (batch)
+                return
+            response.rethrow()
+            responses = json.loads (response.body)['responses']
+            if len (responses) != len (batch):
+                raise ValueError ("server.py answered %d requests out of %d" % (len(responses), len(batch)))
+        except Exception:
+            exc_info = sys.exc_info()
+            for r in batch:
+                r.future.set_exc_info (exc_info)
+            return
+        for r,body in zip (batch, responses):
+            if not isinstance (body, basestring):
+                body = json.dumps (body)
+            r.future.set_result (body)
+
+    @gen.coroutine
+    def _send_one_by_one (self, batch):
+        futures = [self._fetch_one (r.url, r.action) for r in batch]
+        for r,future in zip (batch, futures):
+            chain_future (future, r.future)
+        for future in futures:
+            try:
+                yield future
+            except Exception:
+                pass # already passed on to the caller
+
+    def stats (self):
+        """
+        Counts of the requests sent on their own ('single'), and of the batches sent and the requests they contained, along with
+        the state of the scheduler and of each backend
+        """
+        return dict (self.counters, scheduler=self.scheduler.stats(), backends=[backend.stats() for backend in self.backends])
+
+
+class QueuedRequest (object):
+    """ A request to server.py that hasn't been answered yet """
+
+    def __init__ (self, url, action, priority, owner):
+        if priority not in PRIORITIES:
+            raise ValueError ("unknown priority class %r" % priority)
+        self.url = url
+        self.action = action
+        self.priority = priority
+        self.owner = owner
+        self.future = Future()
+
+
+class Job (object):
+    """ Something waiting in, or run by, a PriorityScheduler """
+
+    def __init__ (self, start, priority, owner):
+        self.start = start
+        self.priority = priority
+        self.owner = owner
+        self.submitted = time.time()
+        self.running = False
+        self.future = Future()
+
+
+class PriorityScheduler (object):
+    """
+    Runs jobs (functions that return a Future) with at most `max_running' of them running at once, and at most `class_limits'
+    of each priority class. Whenever there's room, the next job is taken from the most urgent class that has waiting jobs and is
+    under its limit. Within a class, the owners (client connections) that have waiting jobs take turns, so one user opening a
+    long document doesn't hold up the others.
+    """
+
+    def __init__ (self, max_running, class_limits=None):
+        self.max_running = max_running
+        self.limits = dict (
+            (name, max (1, int (round (share * max_running))))
+            for name,share in DEFAULT_CLASS_SHARES.iteritems()
+            )
+        self.limits.update (class_limits or {})
+        self.running = collections.Counter () # priority class -> number of running jobs
+        # priority class -> owner -> deque of waiting jobs. Owners are in the order in which they get their turn
+        self.waiting = dict ((name, collections.OrderedDict()) for name in PRIORITIES)
+        self.counters = collections.defaultdict (collections.Counter)
+
+    def submit (self, start, priority, owner=None):
+        """ Queues up a job and returns it. The job's `future' has the outcome of the Future returned by `start' """
+        job = Job (start, priority, owner)
+        self._enqueue (job)
+        self._dispatch()
+        return job
+
+    def promote (self, job, priority):
+        """ Moves a waiting job to a more urgent class """
+        if job.running or job.future.done() or PRIORITIES.index (priority) >= PRIORITIES.index (job.priority):
+            return
+        jobs = self.waiting[job.priority].get (job.owner)
+        if jobs is None or job not in jobs:
+            return
+        jobs.remove (job)
+        if not jobs:
+            del self.waiting[job.priority][job.owner]
+        self.counters[job.priority]['promoted'] += 1
+        job.priority = priority
+        self._enqueue (job)
+        self._dispatch()
+
+    def _enqueue (self, job):
+        queues = self.waiting[job.priority]
+        if job.owner not in queues:
+            queues[job.owner] = collections.deque()
+        queues[job.owner].append (job)
+
+    def _next_job (self):
+        for name in PRIORITIES:
+            queues = self.waiting[name]
+            if queues and self.running[name] < self.limits[name]:
+                owner,jobs = next (queues.iteritems())
+                job = jobs.popleft()
+                # this owner goes to the back of the line
+                del queues[owner]
+                if jobs:
+                    queues[owner] = jobs
+                return job
+        return None
+
+    def _dispatch (self):
+        while sum (self.running.itervalues()) < self.max_running:
+            job = self._next_job()
+            if job is None:
+                break
+            priority = job.priority
+            self.running[priority] += 1
+            self.counters[priority]['dispatched'] += 1
+            self.counters[priority]['wait_time'] += time.time() - job.submitted
+            job.running = True
+            try:
+                future = job.start()
+            except Exception:
+                future = Future()
+                future.set_exc_info (sys.exc_info())
+            chain_future (future, job.future)
+            future.add_done_callback (functools.partial (self._job_done, priority))
+
+    def _job_done (self, priority, future):
+        self.running[priority] -= 1
+        self._dispatch()
+
+    def stats (self):
+        stats = {}
+        for name in PRIORITIES:
+            stats[name] = dict (
+                self.counters[name],
+                limit = self.limits[name],
+                running = self.running[name],
+                waiting = sum (len(jobs) for jobs in self.waiting[name].itervalues()),
+                )
+        return stats
+
+
+def batch_item (url):
+    """ Turns the URL of a GET request to server.py into the equivalent item of a batch request """
+    url = urlparse.urlsplit (url)
+    item = dict (urlparse.parse_qsl (url.query, keep_blank_values=True))
+    item['action'] = url.path.strip ('/')
+    return item
+
+
+def parse_class_limits (specs):
+    """ Parses a list of 'class=connections' strings, as given on the command line, into a dict """
+    limits = {}
+    for spec in specs or ():
+        name,connections = spec.split ('=', 1)
+        if name.strip() not in PRIORITIES:
+            raise ValueError ("unknown priority class %r, should be one of %s" % (name, ', '.join(PRIORITIES)))
+        limits[name.strip()] = int (connections)
+    return limits
+
+
+def parse_backend (spec, updates=True):
+    """ Parses a 'host:port' string, as given on the command line, into a Backend """
+    host,port = spec.rsplit (':', 1)
+    return Backend (host, int (port), updates)
+
+
+def parse_timeout_settings (specs):
+    """ Parses a list of 'action=seconds' strings, as given on the command line, into a dict """
+    timeouts = {}
+    for spec in specs or ():
+        action,seconds = spec.split ('=', 1)
+        timeouts[action.strip()] = float (seconds)
+    return timeouts
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -109,6 +109,9 @@ typedef vector< Transition >::iterator transIter;
 typedef vector< Match >::iterator matchIter;
 
 void load_states_transitions ( float );
+void load_states_transitions_binary ( float );
+void predict_prefix( const string &, float );
+void run_server( float, float );
 Word add_to_lexicon( string wordstring, float score );
 int prefix_matching_search( float max_time, float threshold );
 inline vector< Match > string_edit_distance( int, const vector< Word > & );
@@ -146,6 +149,35 @@ set< pair< Word, Word > > approximate_word_match, lowercase_word_match, suffix_i
 set< Word > already_processed;
 FILE *log_in;
 
+// everything that belongs to one search graph, for holding many graphs in server mode (-S)
+// the graph being worked on lives in the globals above, and is swapped in and out of its Graph (which is cheap)
+class Graph {
+public:
+	map< string, Word > lexicon;
+	vector< float > word_score;
+	vector< string > surface;
+	vector< State > states;
+	vector<int> stateId2hypId;
+	map<int,int> hypId2stateId;
+	set< Word > partially_matches_last_token;
+	set< pair< Word, Word > > approximate_word_match, lowercase_word_match, suffix_insensitive_word_match;
+	set< Word > already_processed;
+};
+
+void swap_graph( Graph &graph ) {
+	lexicon.swap( graph.lexicon );
+	word_score.swap( graph.word_score );
+	surface.swap( graph.surface );
+	states.swap( graph.states );
+	stateId2hypId.swap( graph.stateId2hypId );
+	hypId2stateId.swap( graph.hypId2stateId );
+	partially_matches_last_token.swap( graph.partially_matches_last_token );
+	approximate_word_match.swap( graph.approximate_word_match );
+	lowercase_word_match.swap( graph.lowercase_word_match );
+	suffix_insensitive_word_match.swap( graph.suffix_insensitive_word_match );
+	already_processed.swap( graph.already_processed );
+}
+
 // main //////////
 
 int main(int argc, char* argv[])
@@ -160,6 +192,7 @@ int main(int argc, char* argv[])
 	suffix_insensitive_max_suffix = 0;
 	approximate_word_match_threshold = 1.0;
 	match_last_word_window = 0;
+	bool server_mode = false;
         string logfile_name;
 	for (int i = 1; i < argc; ++i) {
 		string arg = argv[i];
@@ -179,6 +212,9 @@ int main(int argc, char* argv[])
 			logfile_name = argv[++i];
 			log_in = fopen (logfile_name.c_str(), "w");
 		}
+		else if (arg == "-S" || arg.find("server") != string::npos) {
+			server_mode = true;
+		}
 		else if (arg == "-w" || arg.find("partial-word") != string::npos) {
 			last_word_may_match_partially = true;
 		}
@@ -222,6 +258,12 @@ int main(int argc, char* argv[])
 		}
 	}
 
+	// server mode: hold many search graphs, and take commands from stdin
+	if (server_mode) {
+		run_server( threshold, max_time );
+		return 0;
+	}
+
 	// load the decoder search graph from stdin
 	// this fills the golabl "states", transitions are attached to each state
 	load_states_transitions( threshold );
@@ -236,281 +278,339 @@ int main(int argc, char* argv[])
 			fputc((int)'\n', log_in);
 			fflush(log_in);
 		} 
-	        double start_time = get_wall_time();
-		// cerr << line << endl;
-		// convert prefix string into our representation (vector of integers)
-		bool prefix_has_final_space = (line[line.length()-1] == ' ');
-		prefix = tokenize(line, 0);
-		string last_token = surface[prefix[prefix.size()-1]];
-
-		// allow partial matching of last token in prefix matching search
-		if (last_word_may_match_partially && !prefix_has_final_space) {
-			// also allow case-insensitive match
-			string last_token_lowercase = lowercase(last_token);
-		       	partially_matches_last_token.clear();
+		predict_prefix( line, max_time );
+		request_id++;
+	 }
+}	
+
+// server mode: process one command per line
+//   LOAD <id>             followed by a search graph (in any format accepted by load_states_transitions); answers "OK <id> <states>"
+//   PREDICT <id> <prefix> answers "PRED " followed by the same line the single graph mode prints
+//   DROP <id>             forgets the graph; answers "OK <id>"
+// errors are answered with a line starting with "ERR"
+void run_server( float threshold, float max_time ) {
+	map< string, Graph > graphs;
+	std::string line;
+	while (std::getline(cin,line))
+	{
+		if (log_in) {
+			fwrite(line.c_str(),1,line.size(),log_in);
+			fputc((int)'\n', log_in);
+			fflush(log_in);
+		}
+		istringstream ss(line);
+		string command, id;
+		ss >> command >> id;
+		if (command == "LOAD") {
+			Graph &graph = graphs[ id ];
+			graph = Graph();
+			load_states_transitions( threshold );
+			int state_count = states.size();
+			swap_graph( graph );
+			cout << "OK " << id << " " << state_count << endl << flush;
+		}
+		else if (command == "PREDICT") {
+			map< string, Graph >::iterator graph = graphs.find( id );
+			if (graph == graphs.end()) {
+				cout << "ERR unknown graph " << id << endl << flush;
+				continue;
+			}
+			string::size_type prefix_start = command.size() + 1 + id.size() + 1;
+			swap_graph( graph->second );
+			cout << "PRED ";
+			predict_prefix( prefix_start < line.size() ? line.substr( prefix_start ) : string(), max_time );
+			swap_graph( graph->second );
+		}
+		else if (command == "DROP") {
+			graphs.erase( id );
+			cout << "OK " << id << endl << flush;
+		}
+		else {
+			cout << "ERR unknown command " << command << endl << flush;
+		}
+	}
+}
+
+// answer one prefix request: find the best completion in the current search graph and print it as one line on stdout
+void predict_prefix( const string &line, float max_time ) {
+	// nothing to match (the search below needs at least one prefix word)
+	if (line.find_first_not_of(" \t\r") == string::npos) {
+		cout << " " << endl << flush;
+		return;
+	}
+	double start_time = get_wall_time();
+	// cerr << line << endl;
+	// convert prefix string into our representation (vector of integers)
+	bool prefix_has_final_space = (line[line.length()-1] == ' ');
+	prefix = tokenize(line, 0);
+	string last_token = surface[prefix[prefix.size()-1]];
+
+	// allow partial matching of last token in prefix matching search
+	if (last_word_may_match_partially && !prefix_has_final_space) {
+		// also allow case-insensitive match
+		string last_token_lowercase = lowercase(last_token);
+	       	partially_matches_last_token.clear();
+		// for all words in vocabulary
+		for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
+			string word = lowercase(iter->first);
+		        // check if could be a partial match
+			if (last_token_lowercase.length() < word.length() &&
+			    last_token_lowercase == word.substr(0,last_token.length())) {
+				partially_matches_last_token.insert( iter->second );
+			}
+		}
+	}
+
+	// allow case-insensitive matching
+	if (case_insensitive_matching) {
+		// for all words in prefix
+		for(int p=0; p<prefix.size(); p++) {
+			if (already_processed.count( prefix[p] )) {
+				continue;
+			}
 			// for all words in vocabulary
 			for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
-				string word = lowercase(iter->first);
-			        // check if could be a partial match
-				if (last_token_lowercase.length() < word.length() &&
-				    last_token_lowercase == word.substr(0,last_token.length())) {
-					partially_matches_last_token.insert( iter->second );
+				// if they match case-insensitive, take note
+				if (equal_case_insensitive( surface[ prefix[p] ], iter->first )) {
+					lowercase_word_match.insert( make_pair( prefix[p], iter->second ) );
 				}
 			}
 		}
+	}
 
-		// allow case-insensitive matching
-		if (case_insensitive_matching) {
-			// for all words in prefix
-			for(int p=0; p<prefix.size(); p++) {
-				if (already_processed.count( prefix[p] )) {
-					continue;
-				}
-				// for all words in vocabulary
-				for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
-					// if they match case-insensitive, take note
-					if (equal_case_insensitive( surface[ prefix[p] ], iter->first )) {
-						lowercase_word_match.insert( make_pair( prefix[p], iter->second ) );
-					}
+	// consider mismatches of similarly spelled words as half an error
+	if (approximate_word_match_threshold < 1.0) {
+		// for all words in prefix
+		for(int p=0; p<prefix.size(); p++) {
+			if (already_processed.count( prefix[p] )) {
+				continue;
+			}
+			int length_prefix_word = surface[ prefix[p] ].size();
+			// for all words in vocabulary
+			for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
+				int distance = letter_string_edit_distance( prefix[p], iter->second );
+				int length_vocabulary_word = iter->first.size();
+				int min_length = length_prefix_word < length_vocabulary_word ? length_prefix_word : length_vocabulary_word;
+				if (distance <= min_length * approximate_word_match_threshold) {
+					approximate_word_match.insert( make_pair( prefix[p], iter->second ) );
 				}
 			}
 		}
+	}
 
-		// consider mismatches of similarly spelled words as half an error
-		if (approximate_word_match_threshold < 1.0) {
-			// for all words in prefix
-			for(int p=0; p<prefix.size(); p++) {
-				if (already_processed.count( prefix[p] )) {
-					continue;
-				}
-				int length_prefix_word = surface[ prefix[p] ].size();
-				// for all words in vocabulary
-				for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
-					int distance = letter_string_edit_distance( prefix[p], iter->second );
-					int length_vocabulary_word = iter->first.size();
-					int min_length = length_prefix_word < length_vocabulary_word ? length_prefix_word : length_vocabulary_word;
-					if (distance <= min_length * approximate_word_match_threshold) {
-						approximate_word_match.insert( make_pair( prefix[p], iter->second ) );
+	// consider mismatches in word endings (presumably morphological variants) as half an error
+	if (suffix_insensitive_max_suffix > 0) {
+		// for all words in prefix
+		for(int p=0; p<prefix.size(); p++) {
+			if (already_processed.count( prefix[p] )) {
+				continue;
+			}
+			// for all words in vocabulary
+			int length_prefix_word = surface[ prefix[p] ].size();
+			for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
+				int length_vocabulary_word = iter->first.size();
+				if (abs(length_vocabulary_word-length_prefix_word) <= suffix_insensitive_max_suffix &&
+				    length_prefix_word >= suffix_insensitive_min_match &&
+				    length_vocabulary_word >= suffix_insensitive_min_match) {
+					int specific_min_match = ( length_prefix_word > length_vocabulary_word ) ? length_prefix_word : length_vocabulary_word;
+					specific_min_match -= suffix_insensitive_max_suffix;
+					if (suffix_insensitive_min_match > specific_min_match) {
+						specific_min_match = suffix_insensitive_min_match;
+					}
+					if (iter->first.substr(0,specific_min_match) ==
+					      surface[ prefix[p] ].substr(0,specific_min_match)) {
+						suffix_insensitive_word_match.insert( make_pair( prefix[p], iter->second ) );
 					}
 				}
 			}
 		}
+	}
 
-		// consider mismatches in word endings (presumably morphological variants) as half an error
-		if (suffix_insensitive_max_suffix > 0) {
-			// for all words in prefix
-			for(int p=0; p<prefix.size(); p++) {
-				if (already_processed.count( prefix[p] )) {
-					continue;
-				}
-				// for all words in vocabulary
-				int length_prefix_word = surface[ prefix[p] ].size();
-				for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
-					int length_vocabulary_word = iter->first.size();
-					if (abs(length_vocabulary_word-length_prefix_word) <= suffix_insensitive_max_suffix &&
-					    length_prefix_word >= suffix_insensitive_min_match &&
-					    length_vocabulary_word >= suffix_insensitive_min_match) {
-						int specific_min_match = ( length_prefix_word > length_vocabulary_word ) ? length_prefix_word : length_vocabulary_word;
-						specific_min_match -= suffix_insensitive_max_suffix;
-						if (suffix_insensitive_min_match > specific_min_match) {
-							specific_min_match = suffix_insensitive_min_match;
-						}
-						if (iter->first.substr(0,specific_min_match) ==
-						      surface[ prefix[p] ].substr(0,specific_min_match)) {
-							suffix_insensitive_word_match.insert( make_pair( prefix[p], iter->second ) );
-						}
-					}
-				}
+	// record seen words for caching pre-processing across requests
+	if (case_insensitive_matching ||
+	    approximate_word_match_threshold < 1.0 ||
+	    suffix_insensitive_max_suffix > 0) {
+		for(int p=0; p<prefix.size(); p++) {
+			if (!already_processed.count( prefix[p] )) {
+				already_processed.insert( prefix[p] );
 			}
 		}
+	}
+	cerr << "preparation took " << (get_wall_time() - start_time) << " seconds\n";
 
-		// record seen words for caching pre-processing across requests
-		if (case_insensitive_matching ||
-		    approximate_word_match_threshold < 1.0 ||
-		    suffix_insensitive_max_suffix > 0) {
-			for(int p=0; p<prefix.size(); p++) {
-				if (!already_processed.count( prefix[p] )) {
-					already_processed.insert( prefix[p] );
-				}
+	// call the main search loop
+	int errorAllowed = prefix_matching_search( max_time, 0 );
+	if (max_time>0 && errorAllowed == -1) {
+	       errorAllowed = prefix_matching_search( 0, 0.000001 );	
+	}
+
+	// we found the best completion, now construct suffix for output
+	Best &b = best[errorAllowed];
+	vector< Word > matchedPrefix, predictedSuffix;
+
+	// add words from final prediction
+	for(int i=b.output_matched-1;i>=0;i--) {
+		matchedPrefix.push_back( b.transition->output[i] );
+	}
+	for(int i=b.output_matched;i<b.transition->output.size();i++) {
+		predictedSuffix.push_back( b.transition->output[i] );
+	}
+
+	// add suffix words (best path forward)
+	int suffixState = b.transition->to_state;
+	while (states[suffixState].forward > 0) {
+		Transition *transition = NULL;
+		float best_score = -999;
+		vector< Transition > &transitions = states[suffixState].transitions;
+		for(int t=0; t<transitions.size(); t++) {
+			if (transitions[t].to_state == states[suffixState].forward &&
+			    transitions[t].score > best_score) {
+				transition = &transitions[t];
+				best_score = transition->score;
 			}
 		}
-		cerr << "preparation took " << (get_wall_time() - start_time) << " seconds\n";
-
-		// call the main search loop
-		int errorAllowed = prefix_matching_search( max_time, 0 );
-		if (max_time>0 && errorAllowed == -1) {
-		       errorAllowed = prefix_matching_search( 0, 0.000001 );	
+		for(int i=0;i<transition->output.size();i++) {
+			predictedSuffix.push_back( transition->output[i] );
 		}
-	
-		// we found the best completion, now construct suffix for output
-		Best &b = best[errorAllowed];
-		vector< Word > matchedPrefix, predictedSuffix;
-
-		// add words from final prediction
-		for(int i=b.output_matched-1;i>=0;i--) {
-			matchedPrefix.push_back( b.transition->output[i] );
-		}
-		for(int i=b.output_matched;i<b.transition->output.size();i++) {
-			predictedSuffix.push_back( b.transition->output[i] );
-		}
-
-		// add suffix words (best path forward)
-		int suffixState = b.transition->to_state;
-		while (states[suffixState].forward > 0) {
-			Transition *transition = NULL;
-			float best_score = -999;
-			vector< Transition > &transitions = states[suffixState].transitions;
-			for(int t=0; t<transitions.size(); t++) {
-				if (transitions[t].to_state == states[suffixState].forward &&
-				    transitions[t].score > best_score) {
-					transition = &transitions[t];
-					best_score = transition->score;
-				}
-			}
-			for(int i=0;i<transition->output.size();i++) {
-				predictedSuffix.push_back( transition->output[i] );
-			}
-			suffixState = states[suffixState].forward;
-	 	}
+		suffixState = states[suffixState].forward;
+ 	}
 
-		// add prefix words (following back transitions
-		int prefixState = b.from_state;
-		int prefix_matched = b.back_matched;
-		while (prefixState > 0) {
-			backIter back = states[prefixState].back.begin();
-			for(; back != states[prefixState].back.end(); back++ ) {
-				if (back->prefix_matched == prefix_matched) {
-					break;
-				}
-			}
-			const vector< Word > &output = back->transition->output;
-			for(int i=output.size()-1; i>=0; i--) {
-				matchedPrefix.push_back( output[i] );
+	// add prefix words (following back transitions
+	int prefixState = b.from_state;
+	int prefix_matched = b.back_matched;
+	while (prefixState > 0) {
+		backIter back = states[prefixState].back.begin();
+		for(; back != states[prefixState].back.end(); back++ ) {
+			if (back->prefix_matched == prefix_matched) {
+				break;
 			}
-			back->transition->output.size();
-			prefixState = back->back_state;
-			prefix_matched = back->back_matched;
 		}
+		const vector< Word > &output = back->transition->output;
+		for(int i=output.size()-1; i>=0; i--) {
+			matchedPrefix.push_back( output[i] );
+		}
+		back->transition->output.size();
+		prefixState = back->back_state;
+		prefix_matched = back->back_matched;
+	}
 
 
 
-		// handle final partial word (normal case)
-		bool successful_partial_word_completion = false;
-		if (!successful_partial_word_completion && last_word_may_match_partially && !prefix_has_final_space && matchedPrefix.size()>0) {
-			Word last_matched_word = matchedPrefix[ 0 ];
-			if (partially_matches_last_token.count( last_matched_word )) {
-				cout << surface[ last_matched_word ].substr(last_token.length());
-				successful_partial_word_completion = true;
-			}
+	// handle final partial word (normal case)
+	bool successful_partial_word_completion = false;
+	if (!successful_partial_word_completion && last_word_may_match_partially && !prefix_has_final_space && matchedPrefix.size()>0) {
+		Word last_matched_word = matchedPrefix[ 0 ];
+		if (partially_matches_last_token.count( last_matched_word )) {
+			cout << surface[ last_matched_word ].substr(last_token.length());
+			successful_partial_word_completion = true;
 		}
+	}
 
-		// try a bit harder to match the last word
-		if (!successful_partial_word_completion && prefix.size()>0 && match_last_word_window>0 &&
-		    (matchedPrefix.size() == 0 || matchedPrefix[ 0 ] != prefix[prefix.size()-1])) {
-			// if we match it case-insensitive, that's okay
-			bool is_okay = false;
-			if (matchedPrefix.size()>0) {
-				if (equal_case_insensitive(last_token, surface[ matchedPrefix[0] ])) {
-					is_okay = true;
-				}
+	// try a bit harder to match the last word
+	if (!successful_partial_word_completion && prefix.size()>0 && match_last_word_window>0 &&
+	    (matchedPrefix.size() == 0 || matchedPrefix[ 0 ] != prefix[prefix.size()-1])) {
+		// if we match it case-insensitive, that's okay
+		bool is_okay = false;
+		if (matchedPrefix.size()>0) {
+			if (equal_case_insensitive(last_token, surface[ matchedPrefix[0] ])) {
+				is_okay = true;
 			}
-			// look for last word in window around current matched path position
-			for(int i=0; !is_okay && i<=match_last_word_window; i++) {
-				// is the word in the predicted suffix?
-				if (predictedSuffix.size() > i &&
-				    (equal_case_insensitive(last_token, surface[ predictedSuffix[i]]) ||
-				     (last_word_may_match_partially && !prefix_has_final_space && partially_matches_last_token.count( predictedSuffix[i] )))) {
-					// move predicted suffix words into matched prefix
-					for(int j=0; j<=i; j++) {
-						matchedPrefix.insert( matchedPrefix.begin(), predictedSuffix[0] );
-						predictedSuffix.erase( predictedSuffix.begin() );
-					}
-					is_okay = true;
+		}
+		// look for last word in window around current matched path position
+		for(int i=0; !is_okay && i<=match_last_word_window; i++) {
+			// is the word in the predicted suffix?
+			if (predictedSuffix.size() > i &&
+			    (equal_case_insensitive(last_token, surface[ predictedSuffix[i]]) ||
+			     (last_word_may_match_partially && !prefix_has_final_space && partially_matches_last_token.count( predictedSuffix[i] )))) {
+				// move predicted suffix words into matched prefix
+				for(int j=0; j<=i; j++) {
+					matchedPrefix.insert( matchedPrefix.begin(), predictedSuffix[0] );
+					predictedSuffix.erase( predictedSuffix.begin() );
 				}
-				// is the word in the macthed prefix?
-				else if (i>0 && matchedPrefix.size() > i &&
-				         (equal_case_insensitive(last_token, surface[ matchedPrefix[i]]) ||
-					  (last_word_may_match_partially && !prefix_has_final_space && partially_matches_last_token.count( matchedPrefix[i] )))) {
-					// move matched prefix words into predicted suffix
-					for(int j=0; j<i; j++) {
-						predictedSuffix.insert( predictedSuffix.begin(), matchedPrefix[0] );
-						matchedPrefix.erase( matchedPrefix.begin() );
-					}
-					is_okay = true;
-				}	
+				is_okay = true;
 			}
+			// is the word in the macthed prefix?
+			else if (i>0 && matchedPrefix.size() > i &&
+			         (equal_case_insensitive(last_token, surface[ matchedPrefix[i]]) ||
+				  (last_word_may_match_partially && !prefix_has_final_space && partially_matches_last_token.count( matchedPrefix[i] )))) {
+				// move matched prefix words into predicted suffix
+				for(int j=0; j<i; j++) {
+					predictedSuffix.insert( predictedSuffix.begin(), matchedPrefix[0] );
+					matchedPrefix.erase( matchedPrefix.begin() );
+				}
+				is_okay = true;
+			}	
 		}
+	}
 
-		// desparation word completion: matching word with best path score
-		if (match_last_partial_word_desparately && !prefix_has_final_space && !successful_partial_word_completion && word_score[ prefix[prefix.size()-1] ] == 0) {
-			string best;
-			float best_score = -9e9;
-			bool best_case_sensitive = false;
-			// for all words in vocabulary
+	// desparation word completion: matching word with best path score
+	if (match_last_partial_word_desparately && !prefix_has_final_space && !successful_partial_word_completion && word_score[ prefix[prefix.size()-1] ] == 0) {
+		string best;
+		float best_score = -9e9;
+		bool best_case_sensitive = false;
+		// for all words in vocabulary
 
-			for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
-				// word known in different casing, use it
-				if (equal_case_insensitive(iter->first, last_token) &&
-				    word_score[ iter->second ] != 0) {
+		for (map<string, Word>::iterator iter = lexicon.begin(); iter != lexicon.end(); iter++) {
+			// word known in different casing, use it
+			if (equal_case_insensitive(iter->first, last_token) &&
+			    word_score[ iter->second ] != 0) {
+				best = iter->first;
+				best_score = 0;
+				break;
+			}
+			if (iter->first.length() >= last_token.length() &&
+			    word_score[ iter->second ] != 0 &&
+			    word_score[ iter->second ] > best_score &&
+			    equal_case_insensitive(iter->first.substr(0,last_token.length()), last_token)) {
+				// prefer case-sensitive match
+				if (iter->first.substr(0,last_token.length()) == last_token) {
+					best_case_sensitive = true;
 					best = iter->first;
-					best_score = 0;
-					break;
+					best_score = word_score[ iter->second ];
 				}
-				if (iter->first.length() >= last_token.length() &&
-				    word_score[ iter->second ] != 0 &&
-				    word_score[ iter->second ] > best_score &&
-				    equal_case_insensitive(iter->first.substr(0,last_token.length()), last_token)) {
-					// prefer case-sensitive match
-					if (iter->first.substr(0,last_token.length()) == last_token) {
-						best_case_sensitive = true;
-						best = iter->first;
-						best_score = word_score[ iter->second ];
-					}
-				        if (!best_case_sensitive) {
-						best = iter->first;
-						best_score = word_score[ iter->second ];
-					}
+			        if (!best_case_sensitive) {
+					best = iter->first;
+					best_score = word_score[ iter->second ];
 				}
 			}
-			if (best_score > -8e9) {
-				cout << best.substr(last_token.length());
-				successful_partial_word_completion = true;
-			}
 		}
+		if (best_score > -8e9) {
+			cout << best.substr(last_token.length());
+			successful_partial_word_completion = true;
+		}
+	}
 
-		//cerr << "predicted suffix:";
-		//for( int i=0; i<predictedSuffix.size(); i++) {
-		//	cerr << " " << surface[ predictedSuffix[i] ];
-		//}
-		//cerr << endl;
-		//cerr << "matched prefix:";
-		//for( int i=0; i<matchedPrefix.size(); i++) {
-		//		cerr << " " << surface[ matchedPrefix[i] ];
-		//}
-		//cerr << endl;
+	//cerr << "predicted suffix:";
+	//for( int i=0; i<predictedSuffix.size(); i++) {
+	//	cerr << " " << surface[ predictedSuffix[i] ];
+	//}
+	//cerr << endl;
+	//cerr << "matched prefix:";
+	//for( int i=0; i<matchedPrefix.size(); i++) {
+	//		cerr << " " << surface[ matchedPrefix[i] ];
+	//}
+	//cerr << endl;
 
-		// output results
-		for( int i=0; i<predictedSuffix.size(); i++) {
-			if (i>0 || !prefix_has_final_space) { cout << " "; }
-			cout << surface[ predictedSuffix[i] ];
-		}
+	// output results
+	for( int i=0; i<predictedSuffix.size(); i++) {
+		if (i>0 || !prefix_has_final_space) { cout << " "; }
+		cout << surface[ predictedSuffix[i] ];
+	}
 
-		// if no prediction, just output space
-		if (predictedSuffix.size() == 0) {
-			cout << " ";
-		}
-		cout << endl << flush;
+	// if no prediction, just output space
+	if (predictedSuffix.size() == 0) {
+		cout << " ";
+	}
+	cout << endl << flush;
 
-		// clear out search
-		for( int state = 0; state < states.size(); state++ ) {
-			states[state].back.clear();
-		}
-		for (int errorAllowed = 0; errorAllowed < 1000; errorAllowed++ ) {
-			best[errorAllowed].from_state = -1;
-		}
-		request_id++;
-	 }
-}	
+	// clear out search
+	for( int state = 0; state < states.size(); state++ ) {
+		states[state].back.clear();
+	}
+	for (int errorAllowed = 0; errorAllowed < 1000; errorAllowed++ ) {
+		best[errorAllowed].from_state = -1;
+	}
+}
 
 // helper function to get BackTranstition that reached 
 // * a particular state 
@@ -830,6 +930,11 @@ void load_states_transitions( float threshold ){
 		fwrite(line.c_str(),1,line.size(),log_in);
 		fputc((int)'\n', log_in);
 	} 
+	// compact columnar format
+	if (line == "SGB1") {
+		load_states_transitions_binary( threshold );
+		return;
+	}
 	int i=0;
  		
 	while (line.find("ENDSG") != 0)
@@ -904,3 +1009,116 @@ void load_states_transitions( float threshold ){
 	}
 	cerr << "graph has " << states.size() << " states, pruned down from " << i << endl;
 }	
+
+// read a block of raw bytes from stdin (and copy it to the log)
+void read_block( void *buffer, size_t size ) {
+	if (size == 0) {
+		return;
+	}
+	cin.read( (char*) buffer, size );
+	if (log_in) {
+		fwrite(buffer,1,size,log_in);
+	}
+}
+
+// read a column of n values
+template< class T >
+void read_column( vector< T > &column, int n ) {
+	column.resize( n );
+	if (n > 0) {
+		read_block( &column[0], n * sizeof( T ) );
+	}
+}
+
+// read n strings, stored as their total length followed by the strings joined by newlines
+void read_phrases( vector< string > &phrases, int n ) {
+	unsigned int length;
+	read_block( &length, sizeof( length ) );
+	string joined( length, ' ' );
+	if (length > 0) {
+		read_block( &joined[0], length );
+	}
+	phrases.clear();
+	string::size_type start = 0;
+	for(int i=0; i<n; i++) {
+		string::size_type end = joined.find( '\n', start );
+		if (end == string::npos) {
+			end = joined.size();
+		}
+		phrases.push_back( joined.substr( start, end-start ) );
+		start = end + 1;
+	}
+}
+
+// load search graph in the compact columnar format written by cat-server.py (serialize_search_graph in predictpool.py)
+// header: number of states kept and pruned, forward state and score of the initial state
+// kept states: columns hyp, back, recombined, forward (int32), score, transition, fscore (float32), then output phrases
+// pruned states: column of path scores (float32), then output phrases -- these only contribute to the vocabulary
+void load_states_transitions_binary( float threshold ) {
+	int kept, pruned, initial_forward;
+	float best_path_score;
+	read_block( &kept, sizeof( kept ) );
+	read_block( &pruned, sizeof( pruned ) );
+	read_block( &initial_forward, sizeof( initial_forward ) );
+	read_block( &best_path_score, sizeof( best_path_score ) );
+
+	vector< int > hyp, back, recombined, forward;
+	vector< float > backward_score, transition_score, forward_score, pruned_score;
+	vector< string > out, pruned_out;
+	read_column( hyp, kept );
+	read_column( back, kept );
+	read_column( recombined, kept );
+	read_column( forward, kept );
+	read_column( backward_score, kept );
+	read_column( transition_score, kept );
+	read_column( forward_score, kept );
+	read_phrases( out, kept );
+	read_column( pruned_score, pruned );
+	read_phrases( pruned_out, pruned );
+	if (log_in) {
+		fflush(log_in);
+	}
+
+	// initial state does have no transition, but contains the best path score
+	State initialState( initial_forward, best_path_score, best_path_score );
+	states.push_back( initialState );
+	stateId2hypId.push_back( 0 );
+
+	map< int, int> recombination;
+	for(int i=0; i<kept; i++) {
+		// if not within threshold of best path score, just record words
+		if (backward_score[i] + forward_score[i] + threshold < best_path_score) {
+			tokenize( out[i], backward_score[i] + forward_score[i] );
+			continue;
+		}
+		int to_state = hyp[i];
+		if (recombined[i] >= 0) {
+			recombination[ hyp[i] ] = recombined[i];
+			to_state = recombined[i];
+		}
+		Transition newTransition( to_state, transition_score[i], out[i], backward_score[i] + forward_score[i] );
+		states[ hypId2stateId[ back[i] ] ].transitions.push_back( newTransition );
+		if (recombined[i] == -1) {
+			State newState( forward[i], forward_score[i], backward_score[i] + forward_score[i] );
+			states.push_back( newState );
+			hypId2stateId[ hyp[i] ] = stateId2hypId.size();
+			stateId2hypId.push_back( hyp[i] );
+		}
+	}
+	for(int i=0; i<pruned; i++) {
+		tokenize( pruned_out[i], pruned_score[i] );
+	}
+
+	// renumber from hypothesis ids (contained in search graph) to state ids (consecutive)
+	for(int state=0; state<states.size(); state++) {
+		int forward_hyp = states[state].forward;
+		if (recombination.count(forward_hyp)) {
+			forward_hyp = recombination[ forward_hyp ];
+		}
+		states[state].forward = hypId2stateId[ forward_hyp ];
+		for ( transIter transition = states[state].transitions.begin(); transition != states[state].transitions.end(); transition++ ) {
+			transition->to_state = hypId2stateId[ transition->to_state ];
+		}
+	}
+	cerr << "graph has " << states.size() << " states, pruned down from " << (kept + pruned + 1) << endl;
+}
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+
+"""
+Management of the `predict' child processes, one per search graph (i.e. per source segment).
+
+The pool bounds the number of live processes and their combined memory, kills and reaps processes when they are evicted or have
+been idle for too long, and lets a connection release the processes it was using when it closes.
+
+All communication with the processes goes through non-blocking pipes on the IOLoop, so a slow or stuck predictor only delays the
+requests that are waiting for it.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import array
+import collections
+import cStringIO
+import os
+import struct
+import time
+
+from tornado import gen, ioloop
+from tornado.process import Subprocess
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+PREDICT_CMD = '/opt/cat-server/predict'
+
+# States whose best path scores worse than the best overall path by more than this are ignored by predict (its -t switch). We
+# apply the same pruning before serializing the graph, so that predict doesn't need to parse those states in the first place.
+SEARCH_GRAPH_THRESHOLD = 0.4
+
+PREDICT_ARGS = ['-W','-s','3','3','-t',str(SEARCH_GRAPH_THRESHOLD),'-f','5','-m','0.1']
+
+# Serialization formats of the search graph we send to predict. See `serialize_search_graph'
+GRAPH_FORMATS = ('binary', 'csv')
+
+# Version of each serialization format, to be bumped when the format changes. Serialized graphs that are kept across restarts or
+# shared between processes are stored under keys that include it (see `graph_format_id'), so that a predict is never handed a
+# graph in a format it doesn't expect
+GRAPH_FORMAT_VERSIONS = { 'binary': 1, 'csv': 1 }
+
+# Number of long-lived predict processes (-S) that hold the search graphs. 0 starts one process per segment instead, which is the
+# only mode that predict binaries built before predict.cpp had a server mode support
+DAEMONS = 0
+
+MAX_PROCESSES = 100
+MAX_MEMORY = 2048 * 1024 * 1024 # bytes, summed over all live processes
+IDLE_TIMEOUT = 30 * 60 # seconds
+
+# How often the pool looks for idle processes, in seconds
+REAP_INTERVAL = 60
+
+# In daemon mode, the memory taken up by a loaded graph is estimated as this many times the size of its serialization
+GRAPH_MEMORY_FACTOR = 4
+
+# Seconds allowed for predict to answer a prefix. The first query also includes loading the search graph, so it gets more time.
+QUERY_TIMEOUT = 1.0
+FIRST_QUERY_TIMEOUT = 3.0
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class PredictTimeout (Exception):
+    """ Raised when predict doesn't answer a query in time """
+    pass
+
+class PredictError (Exception):
+    """ Raised when the predict process is gone, e.g. it crashed or was killed while a query was pending """
+    pass
+
+
+class PredictChild (object):
+    """
+    A running `predict' binary, talked to one line at a time. predict answers its requests in order, so the Futures of the
+    pending requests are kept in a queue and resolved as the answers come in.
+    """
+
+    def __init__ (self, cmd, log_name, log_dir):
+        t = time.time()
+        self.err = open ("%s/predict.%s.%s.err" % (log_dir,log_name,t), "w")
+        log = "%s/predict.%s.%s.in" % (log_dir,log_name,t)
+        try:
+            self.proc = Subprocess (
+                cmd + ['-l', log],
+                stdin = Subprocess.STREAM,
+                stdout = Subprocess.STREAM,
+                stderr = self.err,
+                preexec_fn = lambda: os.nice(10),
+                )
+        except:
+            self.err.close()
+            raise
+        self.stdin = self.proc.stdin   # PipeIOStream
+        self.stdout = self.proc.stdout # PipeIOStream
+        self.pid = self.proc.pid
+        self.created = self.last_used = t
+        # Futures of the requests that are waiting for their line of output, oldest first
+        self.pending = collections.deque()
+        self.stdout.set_close_callback (self._on_stdout_closed)
+
+    def touch (self):
+        self.last_used = time.time()
+
+    def is_alive (self):
+        return self.proc.proc.poll() is None
+
+    def request (self, *chunks):
+        """
+        Writes the given chunks to predict's stdin, and returns a Future for the line it answers with (without the EOL). The Future
+        fails with PredictError if the process dies before answering.
+        """
+        self.touch()
+        future = Future()
+        try:
+            for chunk in chunks:
+                self.stdin.write (chunk)
+        except StreamClosedError:
+            future.set_exception (PredictError ("predict process %d is gone" % self.pid))
+            return future
+        self.pending.append (future)
+        if len (self.pending) == 1:
+            self.stdout.read_until ('\n', self._on_line)
+        return future
+
+    def write (self, *chunks):
+        """ Writes the given chunks to predict's stdin without expecting an answer """
+        for chunk in chunks:
+            self.stdin.write (chunk)
+
+    def _on_line (self, line):
+        future = self.pending.popleft()
+        if not future.done():
+            future.set_result (line[:-1])
+        if self.pending:
+            self.stdout.read_until ('\n', self._on_line)
+
+    def _on_stdout_closed (self):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception (PredictError ("predict process %d is gone" % self.pid))
+
+    def rss (self):
+        """ Resident set size of the process, in bytes, or 0 if it can't be determined (e.g. not on Linux, or process is gone) """
+        try:
+            with open ('/proc/%d/status' % self.pid) as status:
+                for line in status:
+                    if line.startswith ('VmRSS:'):
+                        return int (line.split()[1]) * 1024
+        except (IOError, OSError, ValueError):
+            pass
+        return 0
+
+    def kill (self):
+        """ Kills the process and reaps it, so that it doesn't linger as a zombie. Pending requests fail with PredictError """
+        if self.is_alive():
+            try:
+                self.proc.proc.kill()
+            except OSError:
+                pass # already gone
+        self.proc.proc.wait()
+        self.stdin.close()
+        self.stdout.close()
+        self.err.close()
+
+
+class PredictProcess (PredictChild):
+    """ A `predict' binary dedicated to the search graph of one segment """
+
+    def __init__ (self, sg_id, cmd, search_graph, log_dir):
+        super(PredictProcess,self).__init__ (cmd, sg_id, log_dir)
+        self.sg_id = sg_id
+        self.answered = 0
+        self.owners = set()
+        self.write (*search_graph)
+
+    def query (self, prefix, timeout):
+        """
+        Sends a tokenized prefix to predict. Returns a Future for the line predict answers with, which fails with PredictTimeout if
+        there's no answer within `timeout' seconds, or with PredictError if the process dies.
+        """
+        future = self.request (prefix + '\n')
+        future.add_done_callback (self._count_answer)
+        return with_deadline (future, timeout)
+
+    def _count_answer (self, future):
+        self.answered += 1
+
+    def info (self):
+        now = time.time()
+        return {
+            'sgId': self.sg_id,
+            'pid': self.pid,
+            'alive': self.is_alive(),
+            'rss': self.rss(),
+            'age': now - self.created,
+            'idle': now - self.last_used,
+            'owners': len (self.owners),
+            'pending': len (self.pending),
+            }
+
+
+class PredictDaemon (PredictChild):
+    """
+    A long-lived `predict' binary in server mode (-S), holding the search graphs of many segments. Graphs are loaded, queried and
+    dropped with commands over its stdin; see `run_server' in predict.cpp.
+    """
+
+    def __init__ (self, index, cmd, log_dir):
+        # the pid tells apart the logs of the daemons of different cat-server.py workers
+        super(PredictDaemon,self).__init__ (cmd + ['-S'], 'daemon%d.%d' % (index, os.getpid()), log_dir)
+        self.graphs = set() # ids of the graphs we've loaded
+
+    def load (self, sg_id, search_graph):
+        self.graphs.add (sg_id)
+        return self.request ('LOAD %s\n' % sg_id, *search_graph)
+
+    @gen.coroutine
+    def predict (self, sg_id, prefix):
+        answer = yield self.request ('PREDICT %s %s\n' % (sg_id, prefix))
+        if not answer.startswith ('PRED '):
+            raise PredictError ("predict daemon %d: %s" % (self.pid, answer))
+        raise gen.Return (answer[5:])
+
+    def drop (self, sg_id):
+        if sg_id in self.graphs:
+            self.graphs.discard (sg_id)
+            if self.is_alive():
+                self.request ('DROP %s\n' % sg_id)
+
+
+class DaemonGraph (object):
+    """
+    A search graph loaded into a PredictDaemon. Offers the same interface as PredictProcess, so that the pool and its users don't
+    need to care which of the two they have.
+    """
+
+    def __init__ (self, sg_id, daemon, search_graph):
+        self.sg_id = sg_id
+        self.daemon = daemon
+        self.pid = daemon.pid
+        self.created = self.last_used = time.time()
+        self.answered = 0
+        self.owners = set()
+        # predict doesn't report per-graph memory, so we estimate it from the size of the serialized graph
+        self.estimated_size = GRAPH_MEMORY_FACTOR * sum (len(chunk) for chunk in search_graph)
+        daemon.load (sg_id, search_graph)
+
+    def touch (self):
+        self.last_used = time.time()
+
+    def is_alive (self):
+        return self.daemon.is_alive() and self.sg_id in self.daemon.graphs
+
+    @property
+    def pending (self):
+        # the daemon answers the queries of all its graphs in order
+        return self.daemon.pending
+
+    def query (self, prefix, timeout):
+        self.touch()
+        future = self.daemon.predict (self.sg_id, prefix)
+        future.add_done_callback (self._count_answer)
+        result = with_deadline (future, timeout)
+        result.add_done_callback (self._check_deadline)
+        return result
+
+    def _count_answer (self, future):
+        self.answered += 1
+
+    def _check_deadline (self, result):
+        if isinstance (result.exception(), PredictTimeout) and self.daemon.is_alive():
+            # The daemon answers in order, so whatever it's stuck on holds up the queries of all its graphs. Killing it fails
+            # those (with PredictError), and the pool starts a new daemon when a graph is next loaded
+            self.daemon.kill()
+
+    def rss (self):
+        return self.estimated_size
+
+    def kill (self):
+        self.daemon.drop (self.sg_id)
+
+    def info (self):
+        now = time.time()
+        return {
+            'sgId': self.sg_id,
+            'pid': self.pid,
+            'alive': self.is_alive(),
+            'rss': self.rss(),
+            'age': now - self.created,
+            'idle': now - self.last_used,
+            'owners': len (self.owners),
+            'pending': len (self.pending),
+            }
+
+
+class PredictPool (object):
+    """
+    Keeps one PredictProcess per search graph id, up to `max_processes' processes and `max_memory' bytes of combined RSS. When
+    either bound is exceeded the least recently used processes are killed. Processes that haven't been used for `idle_timeout'
+    seconds are killed too, as are the processes whose owners (connections) have all been released.
+
+    If `daemons' is more than 0, the graphs are instead loaded into that many long-lived PredictDaemons (each new graph goes to the
+    daemon holding the fewest), and the same bounds apply to the loaded graphs, with their memory estimated. This saves starting a
+    process on the first keystroke of every segment. A daemon that misses a query's deadline is killed, along with the graphs it
+    holds, and replaced when a graph is next loaded, so that it doesn't hold up the queries queued behind it.
+    """
+
+    def __init__ (self, cmd=PREDICT_CMD, args=PREDICT_ARGS, log_dir='.', max_processes=MAX_PROCESSES,
+                  max_memory=MAX_MEMORY, idle_timeout=IDLE_TIMEOUT, query_timeout=QUERY_TIMEOUT,
+                  first_query_timeout=FIRST_QUERY_TIMEOUT, daemons=DAEMONS):
+        self.cmd = [cmd] + list (args)
+        self.log_dir = log_dir
+        self.daemons = [None] * daemons
+        self.query_timeout = query_timeout
+        self.first_query_timeout = first_query_timeout
+        self.max_processes = max_processes
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.processes = collections.OrderedDict () # sg_id -> PredictProcess, LRU first
+        self.counters = collections.Counter ()
+        self.reaper = None
+
+    def __len__ (self):
+        return len (self.processes)
+
+    def __contains__ (self, sg_id):
+        return sg_id in self.processes
+
+    def get (self, sg_id, owner=None):
+        """ Returns the live process for the given search graph id, or None. The process becomes the MRU one """
+        process = self.processes.get (sg_id)
+        if process is not None and not process.is_alive():
+            self.discard (sg_id)
+            process = None
+        if process is not None:
+            del self.processes[sg_id]
+            self.processes[sg_id] = process
+            process.touch()
+            if owner is not None:
+                process.owners.add (owner)
+        return process
+
+    def spawn (self, sg_id, search_graph, owner=None):
+        """ Starts a new process (or loads a daemon) for the given search graph, replacing any existing one, and returns it """
+        self.discard (sg_id)
+        if self.daemons:
+            process = DaemonGraph (sg_id, self._least_busy_daemon(), search_graph)
+        else:
+            process = PredictProcess (sg_id, self.cmd, search_graph, self.log_dir)
+        if owner is not None:
+            process.owners.add (owner)
+        self.processes[sg_id] = process
+        self.counters['spawned'] += 1
+        self._start_reaper()
+        self._enforce_bounds (keep=sg_id)
+        return process
+
+    def timeout_for (self, process):
+        """ Returns the number of seconds the given process should be allowed for answering a query """
+        if process.answered == 0:
+            return max (self.query_timeout, self.first_query_timeout)
+        return self.query_timeout
+
+    def discard (self, sg_id):
+        """ Kills and forgets the process for the given search graph id, if any """
+        process = self.processes.pop (sg_id, None)
+        if process is not None:
+            process.kill()
+            self.counters['killed'] += 1
+
+    def release_owner (self, owner):
+        """ Called when a connection closes. Kills the processes that no other connection is using """
+        for sg_id,process in self.processes.items():
+            if owner in process.owners:
+                process.owners.discard (owner)
+                if not process.owners:
+                    self.discard (sg_id)
+                    self.counters['released'] += 1
+
+    def reap_idle (self):
+        """ Kills the processes that have been idle for longer than `idle_timeout', or that have died """
+        now = time.time()
+        for sg_id,process in self.processes.items():
+            if not process.is_alive() or now - process.last_used > self.idle_timeout:
+                self.discard (sg_id)
+                self.counters['reaped'] += 1
+
+    def shutdown (self):
+        if self.reaper is not None:
+            self.reaper.stop()
+            self.reaper = None
+        for sg_id in self.processes.keys():
+            self.discard (sg_id)
+        for i,daemon in enumerate (self.daemons):
+            if daemon is not None:
+                daemon.kill()
+                self.daemons[i] = None
+
+    def _least_busy_daemon (self):
+        """ Returns the daemon holding the fewest graphs, (re)starting daemons that aren't running """
+        for i,daemon in enumerate (self.daemons):
+            if daemon is None or not daemon.is_alive():
+                if daemon is not None:
+                    daemon.kill()
+                    self.counters['daemon_restarts'] += 1
+                self.daemons[i] = PredictDaemon (i, self.cmd, self.log_dir)
+        return min (self.daemons, key=lambda daemon: len(daemon.graphs))
+
+    def _enforce_bounds (self, keep):
+        while len (self.processes) > self.max_processes:
+            self._evict_lru (keep)
+        if self.max_memory:
+            while len (self.processes) > 1 and self.total_rss() > self.max_memory:
+                if not self._evict_lru (keep):
+                    break
+
+    def _evict_lru (self, keep):
+        for sg_id in self.processes:
+            if sg_id != keep:
+                self.discard (sg_id)
+                self.counters['evicted'] += 1
+                return True
+        return False
+
+    def _start_reaper (self):
+        if self.reaper is None and self.idle_timeout:
+            self.reaper = ioloop.PeriodicCallback (self.reap_idle, REAP_INTERVAL * 1000)
+            self.reaper.start()
+
+    def total_rss (self):
+        return sum (process.rss() for process in self.processes.itervalues())
+
+    def stats (self):
+        """ Returns the pool counters along with a description of each live process """
+        processes = [process.info() for process in self.processes.itervalues()]
+        stats = dict (self.counters)
+        stats.update ({
+            'live': len (processes),
+            'rss': sum (p['rss'] for p in processes),
+            'max_processes': self.max_processes,
+            'max_memory': self.max_memory,
+            'processes': processes,
+            'daemons': [
+                { 'pid': daemon.pid, 'rss': daemon.rss(), 'graphs': len(daemon.graphs), 'pending': len(daemon.pending) }
+                for daemon in self.daemons if daemon is not None
+                ],
+            })
+        return stats
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# search graph serialization
+
+# Slack added to the pruning threshold, so that rounding differences between our double precision scores and predict's single
+# precision ones never make us drop a state that predict would have kept. predict applies the exact threshold itself.
+PRUNING_SLACK = 1e-3
+
+def serialize_search_graph (sg, graph_format='csv', threshold=SEARCH_GRAPH_THRESHOLD):
+    """
+    Serializes the search graph returned by server.py (a list of dicts, the initial state first) for the predict binary. Returns
+    a tuple of byte strings, to be written to predict's stdin one after the other.
+
+    The 'binary' format is columnar: after a 'SGB1' line and a header of native int32/float32 values, each field of the states
+    within `threshold' of the best path is stored as one array, followed by their output phrases, joined by newlines. The states
+    outside the threshold only contribute words to predict's vocabulary, so for those only the path score and the output phrase
+    are stored. The 'csv' format is the original one, one line per state, and the only one that predict binaries built before
+    predict.cpp knew about 'binary' can read.
+    """
+    if graph_format == 'csv':
+        return (serialize_search_graph_csv (sg),)
+
+    initial = sg[0]
+    best_path_score = float (initial['fscore'])
+    limit = best_path_score - threshold - PRUNING_SLACK
+    kept = []
+    pruned = []
+    for row in sg[1:]:
+        if row['score'] + row['fscore'] >= limit:
+            kept.append (row)
+        else:
+            pruned.append (row)
+
+    chunks = [
+        'SGB1\n',
+        struct.pack ('=iiif', len(kept), len(pruned), int(initial['forward']), best_path_score),
+        ]
+    for typecode,column in (
+        ('i', [row['hyp'] for row in kept]),
+        ('i', [row['back'] for row in kept]),
+        ('i', [row.get('recombined',-1) for row in kept]),
+        ('i', [int(row['forward']) for row in kept]),
+        ('f', [row['score'] for row in kept]),
+        ('f', [row['transition'] for row in kept]),
+        ('f', [row['fscore'] for row in kept]),
+        ):
+        chunks.append (array.array (typecode, column).tostring())
+    chunks.extend (_serialize_phrases (kept))
+    chunks.append (array.array ('f', [row['score'] + row['fscore'] for row in pruned]).tostring())
+    chunks.extend (_serialize_phrases (pruned))
+    return tuple (chunks)
+
+def _serialize_phrases (rows):
+    phrases = '\n'.join (_utf8 (row['out']) for row in rows)
+    return (struct.pack ('=I', len(phrases)), phrases)
+
+def serialize_search_graph_csv (sg):
+    """ Serializes the search graph into the CSV format, one line per state """
+    output = cStringIO.StringIO()
+    firstLine = True
+    for row in sg:
+        if firstLine:
+            output.write("hyp,stack,back,score,transition,recombined,forward,fscore,covered-start,covered-end,out\n")
+            output.write(str(row["hyp"])+','+str(row["stack"])+',0,0,-1,'+ str(int(row["forward"]))+','+str(row["fscore"])+'\n')
+            firstLine = False
+        else:
+            output.write(','.join ((
+                str(row["hyp"]), str(row["stack"]), str(row["back"]), str(row["score"]), str(row["transition"]),
+                str(row.get("recombined",-1)), str(int(row["forward"])), str(row["fscore"]),
+                str(row["cover-start"]), str(row["cover-end"]), '"'+_utf8(row["out"])+'"\n',
+                )))
+    output.write("ENDSG\n")
+    serialized = output.getvalue()
+    output.close()
+    return serialized
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# utils
+
+def graph_format_id (graph_format):
+    """ Returns the name and version of a serialization format, e.g. 'binary.1' """
+    return '%s.%d' % (graph_format, GRAPH_FORMAT_VERSIONS[graph_format])
+
+def with_deadline (future, timeout, io_loop=None, error=None):
+    """
+    Returns a Future that resolves like `future', or fails with `error' (by default a PredictTimeout) if `future' isn't done within
+    `timeout' seconds
+    """
+    io_loop = io_loop or ioloop.IOLoop.current()
+    result = Future()
+
+    def on_timeout ():
+        if not result.done():
+            result.set_exception (error or PredictTimeout ("no answer from predict within %g seconds" % timeout))
+    handle = io_loop.add_timeout (time.time() + timeout, on_timeout)
+
+    def on_done (future):
+        io_loop.remove_timeout (handle)
+        if not result.done():
+            if future.exception() is not None:
+                result.set_exception (future.exception())
+            else:
+                result.set_result (future.result())
+    future.add_done_callback (on_done)
+
+    return result
+
+def _utf8 (string):
+    if isinstance (string, unicode):
+        string = string.encode ('UTF-8')
+    return string
+
+#----------------------------------------------------------------------------------------------------------------------------------
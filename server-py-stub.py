@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the Moses MT server (server.py), for testing cat-server.py without a translation model.
+
+It answers all the actions that cat-server.py uses, with responses of the same shape as server.py's, plus the /batch URL (see
+mtclient.py). The "translation" of a sentence is each of its words spelled backwards, and text processing is done by splitting
+on whitespace, so the results are predictable. A latency can be added to every response, or to the responses of some actions
+(e.g. translate, to simulate decoding), to simulate a loaded server.
+
+    ./server-py-stub.py --port 9000 --latency 0.05 --action-latency translate=0.5
+
+GET /stats returns the number of requests received, by action.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import argparse
+import collections
+import re
+import sys
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tornado import gen, ioloop, web
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# globals
+
+# seconds added to every response
+latency = 0.0
+
+# seconds added to the responses of some actions instead of `latency', by action. A batch waits for its slowest action
+action_latencies = {}
+
+# number of requests received, by action ('batch' counts the batches, the requests they contain are counted by their own action)
+request_counts = collections.Counter()
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# actions
+
+def token_spans (text):
+    """ Token spans as server.py gives them: [start,end] with the end inclusive """
+    return [[m.start(), m.end()-1] for m in re.finditer (r'\S+', text)]
+
+def translate_word (word):
+    return word[::-1]
+
+def translate (q, **params):
+    words = q.split()
+    target = ' '.join (map (translate_word, words))
+    n = len (words)
+    # a search graph with the best path, plus an uppercased alternative for each word, recombined into the best path
+    search_graph = [{ 'hyp': 0, 'stack': 0, 'forward': 1 if n else -1, 'fscore': -float(n) }]
+    for i,word in enumerate (words):
+        search_graph.append ({
+            'hyp': i+1, 'stack': i+1, 'back': i, 'score': -float(i+1), 'transition': -1.0,
+            'forward': i+2 if i+1 < n else -1, 'fscore': -float(n-i-1),
+            'cover-start': i, 'cover-end': i, 'out': translate_word (word),
+            })
+    for i,word in enumerate (words):
+        search_graph.append ({
+            'hyp': n+i+1, 'stack': i+1, 'back': i, 'score': -float(i+1)-0.5, 'transition': -1.5, 'recombined': i+1,
+            'forward': i+2 if i+1 < n else -1, 'fscore': -float(n-i-1),
+            'cover-start': i, 'cover-end': i, 'out': word.upper(),
+            })
+    options = []
+    for i,word in enumerate (words):
+        options.append ({ 'start': i, 'end': i, 'fscore': -1.0, 'scores': [0.1, 0.2], 'phrase': translate_word (word) })
+        if i+1 < n:
+            options.append ({
+                'start': i, 'end': i+1, 'fscore': -1.5, 'scores': [0.1, 0.2],
+                'phrase': translate_word (word) + ' ' + translate_word (words[i+1]),
+                })
+    return { 'data': { 'translations': [{
+        'translatedText': target,
+        'tokenization': { 'src': token_spans (q), 'tgt': token_spans (target) },
+        'searchGraph': search_graph,
+        'topt': options,
+        }]}}
+
+def tokenize (q, t='', **params):
+    return { 'data': {
+        'tokenizedSource': ' '.join (q.split()),
+        'tokenizedTarget': ' '.join (t.split()),
+        'tokenization': { 'src': token_spans (q), 'tgt': token_spans (t) },
+        }}
+
+def detokenize (q, **params):
+    return { 'data': { 'translations': [{ 'detokenizedText': ' '.join (q.split()) }] }}
+
+def detruecase (q, **params):
+    return { 'data': { 'translations': [{ 'detruecasedText': q[:1].upper() + q[1:] }] }}
+
+def align (q, t='', **params):
+    n = min (len(q.split()), len(t.split()))
+    return { 'data': {
+        'tokenization': { 'src': token_spans (q), 'tgt': token_spans (t) },
+        'alignment': [{ 'src_idx': i, 'tgt_idx': i } for i in range(n)],
+        }}
+
+def confidence (q, t='', **params):
+    return { 'data': {
+        'tokenization': { 'src': token_spans (q), 'tgt': token_spans (t) },
+        'confidence': { 'word': [0.5] * len(t.split()), 'sent': 0.5 },
+        }}
+
+def update (q, t='', **params):
+    return { 'data': {} }
+
+ACTIONS = {
+    'translate': translate,
+    'tokenize': tokenize,
+    'detokenize': detokenize,
+    'detruecase': detruecase,
+    'align': align,
+    'confidence': confidence,
+    'update': update,
+    }
+
+def run_action (action, params):
+    """ Returns the JSON response to a request for `action' """
+    request_counts[action] += 1
+    if action not in ACTIONS:
+        raise web.HTTPError (404)
+    return json.dumps (ACTIONS[action] (**params))
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# handlers
+
+class StubHandler (web.RequestHandler):
+
+    @gen.coroutine
+    def delay (self, *actions):
+        seconds = max ([action_latencies.get (action, latency) for action in actions] or [latency])
+        if seconds:
+            yield gen.Task (ioloop.IOLoop.current().add_timeout, time.time() + seconds)
+
+
+class ActionHandler (StubHandler):
+
+    @gen.coroutine
+    def get (self, action):
+        yield self.delay (action)
+        params = dict ((name, self.get_argument(name)) for name in self.request.arguments)
+        self.write (run_action (action, params))
+
+
+class BatchHandler (StubHandler):
+
+    @gen.coroutine
+    def post (self):
+        items = json.loads (self.request.body)['requests']
+        yield self.delay (*[item['action'] for item in items])
+        request_counts['batch'] += 1
+        responses = []
+        for item in items:
+            params = dict ((str(name), val) for name,val in item.iteritems() if name != 'action')
+            responses.append (run_action (item['action'], params))
+        self.write ({ 'responses': responses })
+
+
+class StatsHandler (web.RequestHandler):
+
+    def get (self):
+        self.write (dict (request_counts))
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description=__doc__.strip().split('\n')[0])
+    parser.add_argument ('--port', help='port to bind to, default 9000', type=int, default=9000)
+    parser.add_argument ('--latency', help='seconds added to every response, default 0', type=float, default=0.0)
+    parser.add_argument ('--action-latency', help='seconds added to the responses of an action instead, as ACTION=SECONDS (can be repeated)', action='append', default=[])
+    settings = parser.parse_args (sys.argv[1:])
+    latency = settings.latency
+    for spec in settings.action_latency:
+        action,seconds = spec.split ('=', 1)
+        action_latencies[action.strip()] = float (seconds)
+
+    application = web.Application ([
+        (r'/batch', BatchHandler),
+        (r'/stats', StatsHandler),
+        (r'/(\w+)', ActionHandler),
+        ])
+    application.listen (settings.port)
+    ioloop.IOLoop.instance().start()
+
+#----------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Processing of the translation options (`topt') that server.py returns with a translation, for display in the CAT interface.
+Same algorithm as in Caitra: each option is scored with a future cost estimate, and the options are stacked into levels under
+the source words, best first.
+
+The future cost table is computed with NumPy when it's installed, and with plain lists otherwise. Both give the same results.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# Cost of a span of source words for which there's no option, per word
+UNCOVERED_WORD_COST = -100
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+def process_options (options, words_length, max_level):
+    """
+    Returns the options that fit within `max_level' levels, each a copy of the given option without its 'fscore' and 'scores', and
+    with its 'full_cost' (the future score of the best translation that uses it, relative to the best overall) and 'level' (the
+    row in which the interface shows it). Options are sorted by start position. `words_length' is the number of source tokens.
+    """
+    if not options:
+        return []
+    words_length = max (words_length, max (option['end'] for option in options) + 1)
+    if numpy is not None:
+        full_costs = full_costs_numpy (options, words_length)
+    else:
+        full_costs = full_costs_lists (options, words_length)
+
+    processed = []
+    for option,full_cost in zip (options, full_costs):
+        option = dict (option)
+        option['full_cost'] = full_cost
+        # remove unnecessary items from the dict
+        option.pop ('fscore', None)
+        option.pop ('scores', None)
+        processed.append (option)
+
+    # sort options by full cost (stable, so that ties stay in server.py's order)
+    processed.sort (key=lambda option: option['full_cost'], reverse=True)
+    filtered = assign_levels (processed, words_length, max_level)
+    filtered.sort (key=lambda option: option['start'])
+    return filtered
+
+
+def assign_levels (options, words_length, max_level):
+    """
+    Puts each option on the lowest level that is above all the options already placed over its source span, and drops the ones
+    that would end up higher than `max_level'. `filled[i]' is the highest level used over source word i; since options cover
+    contiguous spans, it's read and updated one span at a time.
+    """
+    filled = [-1] * words_length
+    saturated = 0 # number of source words whose column is full
+    filtered = []
+    for option in options:
+        start,end = option['start'], option['end']+1
+        level = max (filled[start:end]) + 1
+        if level <= max_level:
+            if level == max_level:
+                saturated += sum (1 for f in filled[start:end] if f < max_level)
+            filled[start:end] = [level] * (end-start)
+            option['level'] = level
+            filtered.append (option)
+            if saturated == words_length:
+                # all columns are full, none of the remaining options can be placed
+                break
+    return filtered
+
+
+def full_costs_numpy (options, words_length):
+    """ Returns the full cost of each option, computing the future cost table with NumPy arrays """
+    n = words_length
+    starts = numpy.array ([option['start'] for option in options], dtype=int)
+    ends = numpy.array ([option['end'] for option in options], dtype=int)
+    fscores = numpy.array ([option['fscore'] for option in options], dtype=float)
+
+    # cost[start,end] of covering source words start..end (inclusive). Cells with end < start are unused
+    index = numpy.arange (n)
+    cost = UNCOVERED_WORD_COST * (1.0 + index[None,:] - index[:,None])
+    # get cheapest costs from options
+    numpy.maximum.at (cost, (starts, ends), fscores)
+
+    # get cheapest (binary) combination, one span size at a time, for all start positions and split points at once
+    for size in xrange (2, n+1):
+        span_starts = numpy.arange (n - size + 1)[:,None]
+        middles = numpy.arange (1, size)[None,:]
+        combined = cost[span_starts, span_starts+middles-1] + cost[span_starts+middles, span_starts+size-1]
+        span_starts = span_starts[:,0]
+        cost[span_starts, span_starts+size-1] = numpy.maximum (cost[span_starts, span_starts+size-1], combined.max (axis=1))
+    path_cost = cost[0,n-1]
+
+    # include future cost estimate in full cost of each option
+    before = numpy.where (starts > 0, cost[0, numpy.maximum(starts-1, 0)], 0.0)
+    after = numpy.where (ends+1 < n, cost[numpy.minimum(ends+1, n-1), n-1], 0.0)
+    return (fscores - path_cost + before + after).tolist()
+
+
+def full_costs_lists (options, words_length):
+    """ Same as `full_costs_numpy', with a list of lists for the future cost table """
+    n = words_length
+    cost = [[UNCOVERED_WORD_COST * (1+end-start) for end in xrange (n)] for start in xrange (n)]
+    for option in options:
+        row = cost[option['start']]
+        if row[option['end']] < option['fscore']:
+            row[option['end']] = option['fscore']
+
+    for size in xrange (2, n+1):
+        for start in xrange (0, n - size + 1):
+            end = start + size - 1
+            row = cost[start]
+            cheapest = row[end]
+            for middle in xrange (start+1, end+1):
+                combined = row[middle-1] + cost[middle][end]
+                if combined > cheapest:
+                    cheapest = combined
+            row[end] = cheapest
+    path_cost = cost[0][n-1]
+
+    full_costs = []
+    for option in options:
+        full_cost = option['fscore'] - path_cost
+        if option['start'] > 0:
+            full_cost += cost[0][option['start']-1]
+        if option['end']+1 < n:
+            full_cost += cost[option['end']+1][n-1]
+        full_costs.append (full_cost)
+    return full_costs
+
+#----------------------------------------------------------------------------------------------------------------------------------
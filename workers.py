@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Multi-process mode of cat-server.py.
+
+The master process binds the listening socket, then forks worker processes that all accept connections on it (see
+`tornado.process.fork_processes', which also restarts the workers that die). Each worker has its own socket.io sessions, caches
+and predict processes. The workers coordinate through a SharedStore (see catcache.py):
+
+ - Session affinity. A socket.io client first does its handshake over plain HTTP, then opens its websocket, and the two may well
+   be accepted by different workers. Session ids are therefore signed with a secret that all the workers share, so that the worker
+   that accepts the websocket can take the session over (see `AffinityRouter'). From then on the whole session lives in that
+   worker. Polling transports, which spread a session over many HTTP requests, are disabled.
+
+ - Segment ownership. The first worker that needs a predict process for a segment claims the segment (see `Cluster.claim'). The
+   other workers forward their prefix completion requests for that segment to the owner, on its internal port, so that the
+   segment's keystrokes all go to the one worker that holds its predict process and its completions.
+
+ - The translate responses and search graphs are cached in the SharedStore, so that a document decoded by one worker is a cache
+   hit for all of them.
+"""
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# includes
+
+import collections
+import hashlib
+import hmac
+import os
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tornado import gen, process
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornadio2 import TornadioRouter, persistent, router, session
+
+#----------------------------------------------------------------------------------------------------------------------------------
+# constants
+
+# socket.io transports that keep a session on a single connection, and therefore on a single worker
+PERSISTENT_PROTOCOLS = ('websocket', 'flashsocket')
+
+# Seconds a worker waits for another one to answer a forwarded request
+FORWARD_TIMEOUT = 10.0
+
+# Number of segment owners a worker remembers before it starts over (the store has them all)
+MAX_KNOWN_OWNERS = 100000
+
+#----------------------------------------------------------------------------------------------------------------------------------
+
+class Cluster (object):
+    """
+    The worker processes of a cat-server.py, as seen from one of them. `index' is the worker's number, from 0 to `workers'-1, and
+    worker i listens for forwarded requests on 127.0.0.1, port `internal_port'+i.
+    """
+
+    def __init__ (self, workers, internal_port, store):
+        self.workers = workers
+        self.internal_port = internal_port
+        self.store = store
+        self.secret = os.urandom (16)
+        self.index = None
+        # owners of the segments we've already asked about, with the time we learned them. A claim doesn't change until it expires
+        # (see `SharedStore.claim'), so these are only trusted for as long as a claim lasts
+        self.owners = {}
+        self.counters = collections.Counter()
+
+    def fork (self):
+        """
+        Forks the workers, and returns in each of them, with `index' set. The master process never returns: it restarts the
+        workers that die, and exits when they all have exited normally.
+        """
+        self.store.clear_claims()
+        self.index = process.fork_processes (self.workers)
+        return self.index
+
+    def new_session_id (self):
+        key = os.urandom (12).encode ('hex')
+        return '%s-%s' % (key, self._sign (key))
+
+    def verify_session_id (self, session_id):
+        """ True if the session id was made by one of the workers, see `new_session_id' """
+        key,sep,signature = session_id.partition ('-')
+        return bool (sep) and hmac.compare_digest (signature, self._sign (key))
+
+    def _sign (self, key):
+        return hmac.new (self.secret, key, hashlib.sha1).hexdigest()[:16]
+
+    def owner (self, sg_id):
+        """ Returns the index of the worker that owns the segment, or None if no worker has claimed it yet """
+        owner = self._known_owner (sg_id)
+        if owner is None:
+            owner = self.store.owner (sg_id)
+            if owner is not None:
+                self._remember (sg_id, owner)
+        return owner
+
+    def claim (self, sg_id):
+        """
+        Claims the segment for this worker, unless another worker already owns it. Returns the index of the owner, which is this
+        worker's own if the store can't be reached.
+        """
+        owner = self._known_owner (sg_id)
+        if owner is None:
+            owner = self.store.claim (sg_id, self.index)
+            if owner is None:
+                return self.index
+            self._remember (sg_id, owner)
+            self.counters['claimed' if owner == self.index else 'claimed_by_others'] += 1
+        return owner
+
+    def _known_owner (self, sg_id):
+        known = self.owners.get (sg_id)
+        if known is not None and time.time() - known[1] < self.store.claim_max_age:
+            return known[0]
+        return None
+
+    def _remember (self, sg_id, owner):
+        if len (self.owners) >= MAX_KNOWN_OWNERS:
+            self.owners.clear()
+        self.owners[sg_id] = (owner, time.time())
+
+    def internal_url (self, index, path):
+        return 'http://127.0.0.1:%d%s' % (self.internal_port + index, path)
+
+    @gen.coroutine
+    def forward (self, index, path, struct, timeout=FORWARD_TIMEOUT):
+        """ POSTs a JSON struct to another worker's internal port, and returns its parsed JSON response """
+        self.counters['forwarded'] += 1
+        response = yield AsyncHTTPClient().fetch (HTTPRequest (
+            self.internal_url (index, path),
+            method = 'POST',
+            body = json.dumps (struct),
+            request_timeout = timeout,
+            ))
+        raise gen.Return (json.loads (response.body))
+
+    def stats (self):
+        return dict (self.counters, index=self.index, workers=self.workers, store=self.store.stats())
+
+
+class AffinityRouter (TornadioRouter):
+    """
+    TornadioRouter for a worker process: session ids are signed (see `Cluster.new_session_id'), and a worker that receives the
+    persistent connection of a session that was created by another worker's handshake takes that session over. Only the persistent
+    transports are enabled.
+    """
+
+    def __init__ (self, connection, cluster, user_settings=None, **kwargs):
+        settings = dict (user_settings or {})
+        settings['enabled_protocols'] = [
+            name for name in settings.get ('enabled_protocols', router.DEFAULT_SETTINGS['enabled_protocols'])
+            if name in PERSISTENT_PROTOCOLS
+            ]
+        TornadioRouter.__init__ (self, connection, settings, **kwargs)
+        self.cluster = cluster
+        self._transport_urls = [
+            (url, ADOPTING_HANDLERS.get (handler, handler), handler_kwargs)
+            for url,handler,handler_kwargs in self._transport_urls
+            ]
+
+    def create_session (self, request, session_id=None):
+        sess = session.Session (self._connection, self, request, self.settings.get ('session_expiry'))
+        sess.session_id = session_id or self.cluster.new_session_id()
+        self._sessions.add (sess)
+        return sess
+
+    def adopt_session (self, session_id, request):
+        """ Creates the session here if it was handed out by another worker's handshake """
+        if self.get_session (session_id) is None and self.cluster.verify_session_id (session_id):
+            self.create_session (request, session_id)
+            self.cluster.counters['adopted_sessions'] += 1
+
+
+def _adopting_handler (handler_class):
+    """ Returns a subclass of a persistent transport handler that has the router adopt the session before opening it """
+    class AdoptingHandler (handler_class):
+        def open (self, session_id):
+            self.server.adopt_session (session_id, self.request)
+            return handler_class.open (self, session_id)
+    AdoptingHandler.__name__ = 'Adopting' + handler_class.__name__
+    return AdoptingHandler
+
+ADOPTING_HANDLERS = dict (
+    (handler, _adopting_handler (handler))
+    for handler in (persistent.TornadioWebSocketHandler, persistent.TornadioFlashSocketHandler)
+    )
+
+#----------------------------------------------------------------------------------------------------------------------------------